@@ -0,0 +1,313 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Offline analytics of a game from Ursula's journal (ursula.py --journal, with
+# --keep-journal to have the whole game and not only what came after the last
+# snapshot). Needs NumPy.
+#
+# The journal is read in chunks (journal.EventReader) and replayed with Ursula's
+# rules (settle_fight), so memory does not grow with its size: the event tables
+# are written every FLUSH_ROWS rows, only the totals per ship and per cell stay
+# in memory. Out of it, in --out:
+#
+#   ships         seq, pid, event, x, y, food, gold: one row per INIT, MOVE,
+#                 TERMINATE and fight of a ship (event = protocol type, or
+#                 WON / LOST), its trajectory and its gold and food over time
+#   fights        seq, x, y, winner, ships, needed, paid, treasure, drawdown
+#   heatmap       x, y, fights, gold_paid: fights per cell
+#   ship_summary  pid, moves, won, lost, x, y, food, gold, max_gold, alive
+#   summary.json  totals, treasure at the start, the end and its largest drawdown
+#
+# seq is the number of the event in the journal. --format csv writes <table>.csv,
+# --format columnar a directory per table with one little-endian int64 file per
+# column and _schema.json, to read with numpy:
+#   np.fromfile("report/ships/gold.i64", dtype="<i8")
+#
+#   python3 analytics.py ursula.journal --out report [--format csv|columnar] [--ships pid ...]
+
+import os
+import sys
+import json
+import argparse
+from array import array
+
+import protocol
+from journal import Journal, EventReader, MESSAGE, TICK, segments
+from ursula import settle_fight
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+TREASURE = 100          #Ursula's gold at the start of a game
+FLUSH_ROWS = 1 << 18    #rows of the ships table kept before they are written
+FORMATS = ("csv", "columnar")
+WON, LOST = 10, 11      #event of a ship in a fight, next to the protocol types
+
+SHIP_COLUMNS = ("seq", "pid", "event", "x", "y", "food", "gold")
+FIGHT_COLUMNS = ("seq", "x", "y", "winner", "ships", "needed", "paid", "treasure", "drawdown")
+HEATMAP_COLUMNS = ("x", "y", "fights", "gold_paid")
+SUMMARY_COLUMNS = ("pid", "moves", "won", "lost", "x", "y", "food", "gold", "max_gold", "alive")
+
+
+class Table:
+    #an output table, written in pieces: write() appends rows given as columns
+    def __init__(self, out, name, columns, fmt):
+        self.columns = columns
+        self.fmt = fmt
+        self.rows = 0
+        if fmt == "csv":
+            self.file = open(os.path.join(out, name + ".csv"), "w")
+            self.file.write(",".join(columns) + "\n")
+        else:
+            self.dir = os.path.join(out, name)
+            os.makedirs(self.dir, exist_ok=True)
+            self.files = [open(os.path.join(self.dir, column + ".i64"), "wb") for column in columns]
+
+    def write(self, columns):
+        #columns: int64 arrays of the same length, in the order of self.columns
+        columns = [np.asarray(column, dtype="<i8") for column in columns]
+        if not len(columns[0]):
+            return
+        if self.fmt == "csv":
+            np.savetxt(self.file, np.column_stack(columns), fmt="%d", delimiter=",")
+        else:
+            for f, column in zip(self.files, columns):
+                column.tofile(f)
+        self.rows += len(columns[0])
+
+    def close(self):
+        if self.fmt == "csv":
+            self.file.close()
+            return
+        for f in self.files:
+            f.close()
+        with open(os.path.join(self.dir, "_schema.json"), "w") as f:
+            json.dump({"rows": self.rows, "dtype": "<i8", "columns": list(self.columns)}, f, indent=2)
+
+
+class Analyzer:
+    def __init__(self, out, fmt="csv", treasure=TREASURE, pids=None):
+        self.pids = None if pids is None else np.array(sorted(pids), dtype=np.int64)
+        self.ships_table = Table(out, "ships", SHIP_COLUMNS, fmt)
+        self.fights_table = Table(out, "fights", FIGHT_COLUMNS, fmt)
+        self.out, self.fmt = out, fmt
+        # Ursula's view, one row per ship as in a ShipTable (lists, settle_fight uses them)
+        self.index = {}     #pid -> row
+        self.x, self.y, self.food, self.gold = [], [], [], []
+        self.alive, self.won, self.lost = [], [], []
+        self.moves = np.zeros(0, dtype=np.int64)
+        self.max_gold = np.zeros(0, dtype=np.int64)
+        self.treasure = self.start_treasure = treasure
+        self.captains = {}
+        self.messages = {}
+        self.heat = {}      #(x, y) -> [fights, gold paid]
+        self.seq = 0
+        self.end_of_world = None
+        self.tick_fights = 0    #fights left of a tick (ursula.py --tick) and whether it was paid
+        self.tick_paid = True
+        # rows not written yet, column by column
+        self.rows = [array('q') for _ in SHIP_COLUMNS]
+        self.ship_rows = array('q')     #row of the ship of every ships row
+        self.fight_rows = [array('q') for _ in FIGHT_COLUMNS]
+
+    def start_from(self, state):
+        #a snapshot (Journal.load_snapshot) instead of an empty sea
+        self.treasure = self.start_treasure = state["treasure"]
+        self.captains = {pid: alive for pid, alive in state["captains"]}
+        for pid, x, y, food, gold in state["ships"]:
+            self.ship(pid, x, y, food, gold, protocol.INIT)
+
+    def ship(self, pid, x, y, food, gold, event):
+        #INIT or MOVE of a ship: its new state and a row
+        row = self.index.get(pid)
+        if row is None:
+            row = self.index[pid] = len(self.x)
+            for column in (self.x, self.y, self.food, self.gold, self.won, self.lost):
+                column.append(0)
+            self.alive.append(1)
+        self.x[row], self.y[row], self.food[row], self.gold[row] = x, y, food, gold
+        if event == protocol.INIT:
+            self.alive[row] = 1
+        self.add_row(pid, row, event)
+
+    def add_row(self, pid, row, event):
+        for column, value in zip(self.rows, (self.seq, pid, event, self.x[row], self.y[row], self.food[row], self.gold[row])):
+            column.append(value)
+        self.ship_rows.append(row)
+        if len(self.ship_rows) >= FLUSH_ROWS:
+            self.flush()
+
+    def feed(self, kind, event):
+        if kind == MESSAGE:
+            msg_type, _, pid, x, y, food, gold = event
+            self.messages[msg_type] = self.messages.get(msg_type, 0) + 1
+            if msg_type in (protocol.MOVE, protocol.INIT):
+                self.ship(pid, x, y, food, gold, msg_type)
+            elif msg_type == protocol.TERMINATE and pid in self.index:
+                row = self.index[pid]
+                self.alive[row] = 0
+                self.add_row(pid, row, msg_type)
+            elif msg_type == protocol.INIT_CAPT:
+                self.captains[pid] = True
+            elif msg_type == protocol.END_CAPT:
+                self.captains[pid] = False
+        elif kind == TICK:
+            # Paid at once or not at all, Ursula ends the world without paying any of them
+            self.tick_fights, needed = event
+            self.tick_paid = self.treasure >= needed
+            if not self.tick_paid and self.end_of_world is None:
+                self.end_of_world = self.seq
+        else:
+            self.fight(*event)
+        self.seq += 1
+
+    def fight(self, winner, losers):
+        rows = [self.index[pid] for pid in (winner, *losers)]
+        _, needed = settle_fight(self.food, self.gold, rows[0], rows[1:])
+        paid = 0
+        if self.tick_fights:
+            self.tick_fights -= 1
+            if self.tick_paid:
+                self.treasure -= needed
+                paid = needed
+        elif needed:
+            if self.treasure >= needed:
+                self.treasure -= needed
+                paid = needed
+            elif self.end_of_world is None:
+                self.end_of_world = self.seq
+        self.won[rows[0]] += 1
+        for row in rows[1:]:
+            self.lost[row] += 1
+        for column, value in zip(self.fight_rows, (self.seq, self.x[rows[0]], self.y[rows[0]], winner, len(rows),
+                                                   needed, paid, self.treasure, self.start_treasure - self.treasure)):
+            column.append(value)
+        for pid, row in zip((winner, *losers), rows):
+            self.add_row(pid, row, WON if pid == winner else LOST)
+
+    def flush(self):
+        #writes the rows kept so far, and adds them to the totals per ship and per cell
+        columns = [np.frombuffer(column, dtype=np.int64) for column in self.rows]
+        rows = np.frombuffer(self.ship_rows, dtype=np.int64)
+        if len(rows):
+            n = len(self.x)
+            if len(self.moves) < n:
+                self.moves = np.concatenate([self.moves, np.zeros(n - len(self.moves), dtype=np.int64)])
+                self.max_gold = np.concatenate([self.max_gold, np.zeros(n - len(self.max_gold), dtype=np.int64)])
+            event, gold = columns[2], columns[6]
+            self.moves += np.bincount(rows[event == protocol.MOVE], minlength=n)
+            np.maximum.at(self.max_gold, rows, gold)
+            if self.pids is not None:
+                wanted = np.isin(columns[1], self.pids)
+                columns = [column[wanted] for column in columns]
+            self.ships_table.write(columns)
+
+        fights = [np.frombuffer(column, dtype=np.int64) for column in self.fight_rows]
+        if len(fights[0]):
+            fx, fy, paid = fights[1], fights[2], fights[6]
+            cells, inverse = np.unique(np.stack([fx, fy], axis=1), axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            counts = np.bincount(inverse, minlength=len(cells))
+            gold = np.bincount(inverse, weights=paid, minlength=len(cells))
+            for (cx, cy), count, g in zip(cells.tolist(), counts.tolist(), gold.tolist()):
+                cell = self.heat.setdefault((cx, cy), [0, 0])
+                cell[0] += count
+                cell[1] += int(g)
+            self.fights_table.write(fights)
+
+        del columns, rows, fights   #the arrays are views of the buffers
+        self.rows = [array('q') for _ in SHIP_COLUMNS]
+        self.ship_rows = array('q')
+        self.fight_rows = [array('q') for _ in FIGHT_COLUMNS]
+
+    def finish(self):
+        self.flush()
+        self.ships_table.close()
+        self.fights_table.close()
+
+        heat = sorted(self.heat.items(), key=lambda item: (-item[1][0], item[0]))
+        table = Table(self.out, "heatmap", HEATMAP_COLUMNS, self.fmt)
+        table.write([[cell[0] for cell, _ in heat], [cell[1] for cell, _ in heat],
+                     [v[0] for _, v in heat], [v[1] for _, v in heat]])
+        table.close()
+
+        pids = sorted(self.index, key=self.index.get)
+        n = len(pids)
+        table = Table(self.out, "ship_summary", SUMMARY_COLUMNS, self.fmt)
+        table.write([pids, self.moves[:n], self.won, self.lost, self.x, self.y, self.food, self.gold,
+                     self.max_gold[:n], self.alive])
+        table.close()
+
+        drawdown = self.start_treasure - self.treasure      #the treasure only goes down
+        summary = {
+            "events": self.seq,
+            "messages": {protocol.TYPE_NAMES.get(t, str(t)): n for t, n in sorted(self.messages.items())},
+            "captains": len(self.captains),
+            "ships": n,
+            "ships_alive": sum(self.alive),
+            "fights": self.fights_table.rows,
+            "cells_with_fights": len(self.heat),
+            "gold_paid": drawdown,
+            "treasure_start": self.start_treasure,
+            "treasure_end": self.treasure,
+            "max_drawdown": drawdown,
+            "max_drawdown_pct": 100.0 * drawdown / self.start_treasure if self.start_treasure else 0.0,
+            "end_of_world_seq": self.end_of_world,
+            "gold_in_circulation": sum(g for g, alive in zip(self.gold, self.alive) if alive),
+        }
+        with open(os.path.join(self.out, "summary.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+def open_game(path):
+    #the readers of every journal file of the game, in order, and the state they start
+    #from: None (an empty sea) or the snapshot before the first one
+    readers = [EventReader(name) for name in segments(path)]
+    readers = [reader for reader in readers if reader.generation is not None]
+    if not readers:
+        raise ValueError(f"no journal at '{path}'")
+    for before, after in zip(readers, readers[1:]):
+        if after.generation != before.generation + 1:
+            raise ValueError(f"generation {before.generation + 1} of the journal is missing")
+    if readers[0].generation == 0:
+        return readers, None
+    state = Journal(path).load_snapshot()
+    if state is None or state["generation"] != readers[0].generation:
+        raise ValueError(f"the journal starts at generation {readers[0].generation} and there is no snapshot of it, "
+                         "run Ursula with --keep-journal to keep the whole game")
+    return readers, state
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Trajectories, gold, fights and treasure of a game, from Ursula's journal")
+    ap.add_argument("journal", help="journal of ursula.py --journal (its archived generations are read too)")
+    ap.add_argument("--out", type=str, default="report", help="output directory")
+    ap.add_argument("--format", choices=FORMATS, default="csv", help="csv files or a directory of int64 columns per table")
+    ap.add_argument("--ships", type=int, nargs="+", help="only these pids in the ships table (the totals count every ship)")
+    ap.add_argument("--treasure", type=int, default=TREASURE, help="Ursula's gold at the start of the game")
+    args = ap.parse_args()
+    if np is None:
+        sys.exit("analytics.py needs NumPy")
+
+    try:
+        readers, state = open_game(args.journal)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Error happened: {e}")
+    os.makedirs(args.out, exist_ok=True)
+    analyzer = Analyzer(args.out, args.format, args.treasure, args.ships)
+    if state is not None:
+        analyzer.start_from(state)
+    for reader in readers:
+        for kind, event in reader:
+            analyzer.feed(kind, event)
+        if reader.torn:
+            print(f"{reader.path}: {reader.torn} bytes after the last whole event skipped", file=sys.stderr)
+    summary = analyzer.finish()
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Benchmark: captain commands per second to a whole fleet.
+#
+# Each fake ship is a child process that answers every command frame with an
+# OK reply after --latency ms, like a slow ship. "serial" sends one command and
+# waits for its reply before the next ship (send_command), "pipelined" sends the
+# command to every ship at once and matches the replies as they arrive
+# (captain5.broadcast), "batched" also puts --batch moves in each frame.
+#
+# Usage: python3 benchmarks/bench_dispatch.py [--rounds N] [--latency ms] [--batch N]
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import selectors
+import protocol
+import captain5
+
+ROUTE = ("up", "down")     #back and forth, the ships never leave their cell for long
+
+
+class OpenSea:
+    #no rocks and no other fleets, so only the dispatch is measured
+    shared = False
+
+    def get_cell_type(self, x, y):
+        return "."
+
+    def set_ship(self, x, y):
+        return True
+
+    def remove_ship(self, x, y):
+        return None
+
+
+def fake_ship(cmd_r, reply_w, latency, x):
+    y = 0
+    while True:
+        frame = protocol.read_command(cmd_r)
+        if frame is None:
+            os._exit(0)
+        ship_id, seq, commands = frame
+        time.sleep(latency)
+        for command in commands:
+            y += 1 if command == "up" else -1
+        os.write(reply_w, protocol.pack_reply(ship_id, seq, "OK", len(commands), x, y, 10**9, 0))
+
+
+def start_fleet(ships, latency):
+    captain5.mapa = OpenSea()
+    captain5.selector = selectors.DefaultSelector()
+    for n in range(ships):
+        cmd_r, cmd_w = os.pipe()
+        r_pipe, reply_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(cmd_w)
+            os.close(r_pipe)
+            for ship in captain5.ship_dict.values():    #or the older ships never see EOF
+                os.close(ship["channel"]["w_pipe"])
+                os.close(ship["channel"]["r_pipe"])
+            fake_ship(cmd_r, reply_w, latency, n * 10)
+        os.close(cmd_r)
+        os.close(reply_w)
+        captain5.add_ship(str(n + 1), n * 10, 0, captain5.add_channel(pid, cmd_w, r_pipe))
+
+
+def stop_fleet():
+    for shipId in list(captain5.ship_dict):
+        pid = captain5.ship_dict[shipId]["pid"]
+        if captain5.forget_ship(shipId):
+            os.waitpid(pid, 0)
+
+
+def measure(ships, rounds, latency, pipelined, batch=1):
+    start_fleet(ships, latency)
+    sys.stderr = open(os.devnull, "w")      #captain5 logs every move
+    sys.stdout = sys.stderr
+    start = time.perf_counter()
+    for i in range(rounds):
+        command = ROUTE[i % len(ROUTE)]
+        if batch > 1:
+            for shipId in list(captain5.ship_dict):
+                captain5.dispatch(shipId, *(ROUTE * batch)[:batch])
+            captain5.wait_replies()
+        elif pipelined:
+            captain5.broadcast(command)
+        else:
+            for shipId in list(captain5.ship_dict):
+                captain5.send_command(shipId, command)
+    elapsed = time.perf_counter() - start
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    stop_fleet()
+    return ships * rounds * batch / elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fleet commands per second, serial vs pipelined dispatch")
+    ap.add_argument("--rounds", type=int, default=20, help="commands sent to every ship")
+    ap.add_argument("--latency", type=float, default=2.0, help="ms a ship takes to answer")
+    ap.add_argument("--batch", type=int, default=8, help="moves per frame in the batched run")
+    args = ap.parse_args()
+
+    print(f"{'ships':>6} {'serial moves/s':>15} {'pipelined moves/s':>18} {'batched moves/s':>16}")
+    for ships in (1, 4, 16, 64, 256):
+        serial = measure(ships, args.rounds, args.latency / 1000, False)
+        pipelined = measure(ships, args.rounds, args.latency / 1000, True)
+        batched = measure(ships, args.rounds, args.latency / 1000, True, args.batch)
+        print(f"{ships:>6} {serial:>15,.0f} {pipelined:>18,.0f} {batched:>16,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Benchmark: message rate to Ursula's named pipe.
+#
+# "old" opens the FIFO, writes one line and closes it for every message, and
+# the reader reopens the FIFO every time it reaches EOF (the old Ursula.run).
+# "new" keeps one FifoWriter open and the reader holds its own dummy writer
+# (transport.open_fifo_reader), so the FIFO is opened once per process.
+#
+# Usage: python3 benchmarks/bench_fifo.py [--messages N]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import transport
+
+MESSAGE = "12345,MOVE,10,20,95,10"
+
+
+def old_reader(path, total):
+    received = 0
+    while received < total:
+        with open(path, "r") as pipe:
+            for line in pipe:
+                received += 1
+
+
+def new_reader(path, total):
+    read_fd, dummy_fd = transport.open_fifo_reader(path)
+    received = 0
+    while received < total:
+        received += os.read(read_fd, 65536).count(b"\n")
+    os.close(read_fd)
+    os.close(dummy_fd)
+
+
+def old_writer(path, total):
+    for _ in range(total):
+        with open(path, "w") as fifo:
+            fifo.write(MESSAGE + "\n")
+            fifo.flush()
+
+
+def new_writer(path, total, batch):
+    writer = transport.FifoWriter(path)
+    for i in range(total):
+        writer.send(MESSAGE, flush=(i + 1) % batch == 0)
+    writer.close()
+
+
+def measure(reader, writer, total, *extra):
+    path = os.path.join(tempfile.mkdtemp(), "bench_pipe")
+    os.mkfifo(path)
+    proc = multiprocessing.Process(target=reader, args=(path, total))
+    proc.start()
+    start = time.perf_counter()
+    writer(path, total, *extra)
+    proc.join()
+    elapsed = time.perf_counter() - start
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+    return total / elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser(description="FIFO message rate, open/close per message vs persistent writer")
+    ap.add_argument("--messages", type=int, default=20000, help="messages per run")
+    args = ap.parse_args()
+
+    print(f"{'path':<28} {'messages/s':>12}")
+    print(f"{'open/write/close':<28} {measure(old_reader, old_writer, args.messages):>12,.0f}")
+    for batch in (1, 16, 128):
+        rate = measure(new_reader, new_writer, args.messages, batch)
+        print(f"{f'persistent (flush every {batch})':<28} {rate:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Benchmark: MOVE throughput of Ursula as the fleet grows.
+#
+# Every ship is registered with INIT and then a fixed number of MOVE messages
+# go through Ursula.process_message. With the cell index the cost of a MOVE
+# only depends on the ships sharing the destination cell, so moves/sec should
+# stay flat from 10 to 10,000 ships. The old linear scan is measured too.
+#
+# The per-move status dump is O(N) on purpose (it prints every ship), so it is
+# disabled here to measure only the message handling and fight detection.
+#
+# Usage: python3 benchmarks/bench_fight.py [--moves N] [--sizes 10 100 ...]
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ursula import Ursula
+
+
+class QuietUrsula(Ursula):
+    def print_ship_status(self):
+        pass
+
+    def check_termination(self):
+        pass
+
+
+class LinearScanUrsula(QuietUrsula):
+    #old fight detection: scans every ship on each MOVE
+    def handle_fight(self, ship_pid, x, y):
+        ships_in_cell = []
+        for pid, (sx, sy, food, gold) in self.ships.items():
+            if pid != ship_pid and sx == x and sy == y:
+                ships_in_cell.append(pid)
+        if ships_in_cell:
+            Ursula.handle_fight(self, ship_pid, x, y)
+
+
+def run(cls, n_ships, n_moves, side):
+    rng = random.Random(n_ships)
+    ursula = cls("unused_pipe")
+    ursula.treasure = 10 ** 12   #never reach the end of the world
+    for pid in range(1, n_ships + 1):
+        ursula.process_message(f"{pid},INIT,{rng.randrange(side)},{rng.randrange(side)},100,0")
+    moves = [f"{rng.randint(1, n_ships)},MOVE,{rng.randrange(side)},{rng.randrange(side)},100,0"
+             for _ in range(n_moves)]
+    start = time.perf_counter()
+    for msg in moves:
+        ursula.process_message(msg)
+    return n_moves / (time.perf_counter() - start)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Ursula MOVE throughput vs fleet size")
+    ap.add_argument("--moves", type=int, default=20000, help="MOVE messages per run")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000], help="fleet sizes")
+    ap.add_argument("--linear", action="store_true", help="also measure the old linear scan")
+    args = ap.parse_args()
+
+    stderr = sys.stderr
+    print(f"{'ships':>8} {'indexed moves/s':>16}" + (f" {'linear moves/s':>16}" if args.linear else ""))
+    for n in args.sizes:
+        side = max(10, int(n ** 0.5) * 4)   #keep the fleet density constant
+        sys.stderr = open(os.devnull, "w")
+        try:
+            indexed = run(QuietUrsula, n, args.moves, side)
+            linear = run(LinearScanUrsula, n, args.moves, side) if args.linear else None
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+        line = f"{n:>8} {indexed:>16,.0f}"
+        if linear is not None:
+            line += f" {linear:>16,.0f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Benchmark: Ursula's journal (journal.py), writing it and recovering from it.
+#
+# A fleet is INITed and then moves at random, with a fight every --fight-every
+# moves, all written through Journal with a group commit (write + fsync) every
+# --group events, as Ursula does once per wakeup. Then a new Ursula recovers the
+# whole state from the journal alone, and once more from a snapshot of it plus
+# a tail of --tail events. Both recoveries must give the state of the writer.
+#
+# Usage: python3 benchmarks/bench_journal.py [--events 1000000] [--ships 10000] [--group 256]
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import log
+import protocol
+from journal import Journal
+from ursula import Ursula
+
+
+def write(path, events, ships, group, fight_every, rng):
+    #the journal of a game, and the state it leaves: {pid: (x, y, food, gold)}
+    journal = Journal(path, snapshot_every=events + 1)
+    journal.load_snapshot()
+    for _ in journal.replay():
+        pass
+    state = {}
+    journal.message(protocol.INIT_CAPT, 0, 1, 0, 0, 0, 0)
+    for pid in range(2, ships + 2):
+        state[pid] = (rng.randrange(1000), rng.randrange(1000), 100, 0)
+        journal.message(protocol.INIT, 0, pid, *state[pid])
+    pids = list(state)
+    start = time.perf_counter()
+    for n in range(events - ships - 1):
+        pid = rng.choice(pids)
+        if n % fight_every == 0:
+            loser = rng.choice(pids)
+            if loser != pid:
+                journal.fight(pid, [loser])
+        else:
+            x, y, food, gold = state[pid]
+            state[pid] = (x + rng.choice((-1, 1)), y, food, gold)
+            journal.message(protocol.MOVE, 0, pid, *state[pid])
+        if n % group == 0:
+            journal.commit()
+    journal.commit()
+    elapsed = time.perf_counter() - start
+    return journal, elapsed
+
+
+def recover(path):
+    ursula = Ursula(path, status=False, journal=path)
+    ursula.treasure = 10 ** 12
+    start = time.perf_counter()
+    ursula.recover()
+    elapsed = time.perf_counter() - start
+    ursula.journal.close()
+    return ursula, elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Journal write rate and recovery time")
+    ap.add_argument("--events", type=int, default=1000000, help="events in the journal")
+    ap.add_argument("--ships", type=int, default=10000, help="ships of the fleet")
+    ap.add_argument("--group", type=int, default=256, help="events per group commit (fsync)")
+    ap.add_argument("--fight-every", type=int, default=50, help="one fight every this many events")
+    ap.add_argument("--tail", type=int, default=10000, help="events after the snapshot")
+    args = ap.parse_args()
+    log.logger.level = log.WARNING     #no line per recovery
+
+    path = os.path.join(tempfile.mkdtemp(), "ursula.journal")
+    journal, elapsed = write(path, args.events, args.ships, args.group, args.fight_every, random.Random(1))
+    size = journal.size()
+    print(f"write    {args.events:>9,} events {args.events / elapsed:>12,.0f} events/s "
+          f"{journal.fsyncs:>6} fsyncs {size / 2**20:>7.1f} MB")
+
+    ursula, elapsed = recover(path)
+    state = {pid: ship for pid, ship in ursula.ships.items()}
+    print(f"replay   {args.events:>9,} events {args.events / elapsed:>12,.0f} events/s {elapsed:>8.2f} s")
+
+    # snapshot of that state, then a tail of moves
+    journal = Journal(path, snapshot_every=1)
+    journal.load_snapshot()
+    for _ in journal.replay():
+        pass
+    start = time.perf_counter()
+    snap = journal.snapshot(ursula.treasure, [(1, True)], [(pid, *ship) for pid, ship in state.items()])
+    elapsed = time.perf_counter() - start
+    print(f"snapshot {len(state):>9,} ships  {elapsed:>12.3f} s      {snap / 2**20:>14.1f} MB")
+    rng = random.Random(2)
+    pids = list(state)
+    for _ in range(args.tail):
+        pid = rng.choice(pids)
+        x, y, food, gold = state[pid]
+        state[pid] = (x, y + 1, food, gold)
+        journal.message(protocol.MOVE, 0, pid, *state[pid])
+    journal.close()
+
+    ursula, elapsed = recover(path)
+    same = {pid: ship for pid, ship in ursula.ships.items()} == state
+    print(f"recover  snapshot + {args.tail:,} events {elapsed:>8.2f} s, same state: {same}")
+
+    directory = os.path.dirname(path)
+    for name in os.listdir(directory):
+        os.unlink(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Benchmark: Map as a flat bytearray vs the old list of lists.
+#
+# Writes a random sea map of the given size to a temporary file and, for each
+# representation, loads it in a fresh process and reports the load time, the
+# RSS growth of that process and the latency of can_sail / get_cell_type.
+# "compiled" is the bytearray Map loaded from its .mapc cache with mmap, which
+# is what every ship does after the first process compiled the map.
+#
+# Usage: python3 benchmarks/bench_map.py [--size 2000] [--calls 200000]
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import functools
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from map import Map, compile_map, cache_path
+
+
+class ListMap:
+    #the old representation: one list of 1-char strings per row
+    ROCK = '#'
+
+    def __init__(self, filename):
+        with open(filename, 'r') as f:
+            self.map = [list(line.strip()) for line in f if line.strip()]
+        self.height = len(self.map)
+        self.width = len(self.map[0]) if self.map else 0
+
+    def can_sail(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.map[y][x] != ListMap.ROCK
+        return False
+
+    def get_cell_type(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.map[y][x]
+        return None
+
+
+def rss():
+    #resident set size of this process in bytes (Linux)
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure(cls, filename, calls, results):
+    before = rss()
+    start = time.perf_counter()
+    mapa = cls(filename)
+    load_time = time.perf_counter() - start
+    grown = rss() - before
+
+    rng = random.Random(7)
+    points = [(rng.randrange(mapa.width), rng.randrange(mapa.height)) for _ in range(calls)]
+    start = time.perf_counter()
+    for x, y in points:
+        mapa.can_sail(x, y)
+    sail_ns = (time.perf_counter() - start) / calls * 1e9
+    start = time.perf_counter()
+    for x, y in points:
+        mapa.get_cell_type(x, y)
+    type_ns = (time.perf_counter() - start) / calls * 1e9
+    results.put((load_time, grown, sail_ns, type_ns))
+
+
+def write_map(path, size):
+    rng = random.Random(size)
+    with open(path, "w") as f:
+        for _ in range(size):
+            f.write(''.join(rng.choices(".#PI", weights=(90, 8, 1, 1), k=size)) + "\n")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Map load time, memory and latency")
+    ap.add_argument("--size", type=int, default=2000, help="map width and height")
+    ap.add_argument("--calls", type=int, default=200000, help="calls per latency measure")
+    args = ap.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench_map.txt")
+    write_map(path, args.size)
+    print(f"{args.size}x{args.size} map ({os.path.getsize(path) / 2**20:.1f} MB file)")
+    print(f"{'map':<12} {'load s':>8} {'RSS MB':>8} {'can_sail ns':>12} {'cell_type ns':>13}")
+    compile_map(path)
+    loaders = (("list", ListMap),
+               ("bytearray", functools.partial(Map, use_cache=False)),
+               ("compiled", Map))
+    for name, cls in loaders:
+        results = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=measure, args=(cls, path, args.calls, results))
+        proc.start()
+        load_time, grown, sail_ns, type_ns = results.get()
+        proc.join()
+        print(f"{name:<12} {load_time:>8.3f} {grown / 2**20:>8.1f} {sail_ns:>12.0f} {type_ns:>13.0f}")
+    os.unlink(path)
+    os.unlink(cache_path(path))
+    os.rmdir(os.path.dirname(path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Benchmark: MOVE throughput of Ursula split in regions (shards.py) as the number
+# of shards grows.
+#
+# The load generators of bench_ursula.py (captain processes on a Unix socket)
+# send a random walk of the fleet over a --side x --side sea, to one Ursula
+# (shards 0 in the table) and to a router with 1, 2, 4... shards. The time is
+# from the first generator started until Ursula, or the router with all its
+# shards, has handled the last message and ended. The ships walk over the
+# borders, so the handoffs are part of the cost. The treasure never runs out.
+#
+# Every shard is one process, the scaling needs as many free cores as shards
+# plus the router and the generators (os.cpu_count() is printed with the
+# results).
+#
+# Usage: python3 benchmarks/bench_shards.py [--shards 0 1 2 4] [--ships 1000] [--messages 200000]
+
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import log
+import transport
+from ursula import Ursula
+from shards import Ledger, Regions, Router
+from bench_ursula import captain, wait_ready
+
+
+def run_ursula(target, shards, side):
+    log.logger.level = log.WARNING     #no line per message
+    if shards:
+        ursula = Router(target, Regions(side, side, shards), seed=1, status=False)
+        ursula.ledger = Ledger(10 ** 12)    #never reach the end of the world
+    else:
+        ursula = Ursula(target, seed=1, status=False)
+        ursula.treasure = 10 ** 12
+    ursula.run()
+
+
+def measure(shards, ships, captains, messages, side):
+    tmp = tempfile.mkdtemp()
+    target = transport.SOCKET_PREFIX + os.path.join(tmp, "sea.sock")
+    ursula = multiprocessing.Process(target=run_ursula, args=(target, shards, side))
+    ursula.start()
+    wait_ready(target)
+
+    moves = max(1, messages // ships)
+    barrier = multiprocessing.Barrier(captains)
+    generators = [multiprocessing.Process(target=captain, args=(target, i, ships // captains + (i < ships % captains),
+                                                                moves, 0, side, barrier))
+                  for i in range(captains)]
+    start = time.perf_counter()
+    for generator in generators:
+        generator.start()
+    for generator in generators:
+        generator.join()
+    ursula.join()
+    wall = time.perf_counter() - start
+    os.rmdir(tmp)
+    return moves * ships, wall
+
+
+def main():
+    ap = argparse.ArgumentParser(description="MOVE throughput of Ursula split in regions")
+    ap.add_argument("--shards", type=int, nargs="+", default=[0, 1, 2, 4], help="shard counts, 0 = one Ursula, no router")
+    ap.add_argument("--ships", type=int, default=1000, help="ships of the fleet")
+    ap.add_argument("--captains", type=int, default=4, help="load generator processes")
+    ap.add_argument("--messages", type=int, default=200000, help="MOVE messages per run")
+    ap.add_argument("--side", type=int, default=200, help="side of the sea")
+    args = ap.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.ships} ships, {args.messages:,} moves, sea {args.side}x{args.side}")
+    print(f"{'shards':>6} {'moves/s':>10} {'seconds':>8} {'speedup':>8} {'CPU s':>7}")
+    base = None
+    for shards in args.shards:
+        cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+        moves, wall = measure(shards, args.ships, min(args.captains, args.ships), args.messages, args.side)
+        used = resource.getrusage(resource.RUSAGE_CHILDREN)
+        rate = moves / wall
+        base = base or rate
+        print(f"{shards:>6} {rate:>10,.0f} {wall:>8.2f} {rate / base:>7.2f}x "
+              f"{used.ru_utime + used.ru_stime - cpu.ru_utime - cpu.ru_stime:>7.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Benchmark: Ursula's ship state, dict of dicts vs ShipTable columns.
+#
+# Builds the state of N ships (INIT), applies N MOVE updates and computes the
+# fleet-wide totals (gold in circulation, starving ships). Memory is measured
+# with tracemalloc. ShipTable uses NumPy columns when NumPy is installed and
+# array.array columns otherwise; the backend in use is printed.
+#
+# Usage: python3 benchmarks/bench_ship_table.py [--ships N]
+
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ship_table
+from ship_table import ShipTable
+
+
+class DictShips:
+    #the old representation, one dict per ship
+    def __init__(self):
+        self.ships = {}
+
+    def add(self, pid, x, y, food, gold):
+        self.ships[pid] = {'x': x, 'y': y, 'food': food, 'gold': gold, 'captain_pid': None}
+
+    def update(self, pid, x, y, food, gold):
+        self.ships[pid].update({'x': x, 'y': y, 'food': food, 'gold': gold})
+
+    def total_gold(self):
+        return sum(ship['gold'] for ship in self.ships.values())
+
+    def starving(self):
+        return sum(1 for ship in self.ships.values() if ship['food'] < 5)
+
+
+def run(cls, inits, moves):
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = cls()
+    for msg in inits:
+        store.add(*msg)
+    init_time = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for msg in moves:
+        store.update(*msg)
+    move_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(10):
+        store.total_gold()
+        store.starving()
+    totals_time = (time.perf_counter() - start) / 10
+    return memory, len(inits) / init_time, len(moves) / move_time, totals_time
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Ship state memory and throughput")
+    ap.add_argument("--ships", type=int, default=100000, help="number of ships")
+    args = ap.parse_args()
+
+    rng = random.Random(1)
+    inits = [(pid, rng.randrange(1000), rng.randrange(1000), 100, 0) for pid in range(1, args.ships + 1)]
+    moves = [(rng.randint(1, args.ships), rng.randrange(1000), rng.randrange(1000), rng.randrange(100), rng.randrange(50))
+             for _ in range(args.ships)]
+
+    backend = "numpy" if ship_table.np is not None else "array"
+    print(f"{args.ships:,} ships, ShipTable backend: {backend}")
+    print(f"{'store':<12} {'memory MB':>10} {'B/ship':>8} {'inits/s':>12} {'moves/s':>12} {'totals ms':>10}")
+    for name, cls in (("dict", DictShips), ("ShipTable", ShipTable)):
+        memory, init_rate, move_rate, totals_time = run(cls, inits, moves)
+        print(f"{name:<12} {memory / 2**20:>10.1f} {memory / args.ships:>8.0f} {init_rate:>12,.0f} "
+              f"{move_rate:>12,.0f} {totals_time * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Benchmark: ship-moves per second of the headless simulation (simulation.py).
+#
+# A random-walk fleet on an open sea with islands and ports, every ship with
+# its own speed. "exact" is Simulation (one move at a time, the rules of the
+# processes), "batch" is BatchSimulation (NumPy, every due ship at once).
+# The same seed gives the same result twice, checked on every run.
+#
+# Usage: python3 benchmarks/bench_simulation.py [--steps 50] [--sizes 100 1000 10000] [--size 1000]
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from map import Map
+import simulation
+
+
+def write_map(path, size, rng):
+    #open sea with a rock border, 1% islands and 0.5% ports
+    with open(path, "w") as f:
+        f.write("#" * size + "\n")
+        for _ in range(size - 2):
+            row = rng.choices(".IP", weights=(985, 10, 5), k=size - 2)
+            f.write("#" + "".join(row) + "#\n")
+        f.write("#" * size + "\n")
+
+
+def fleet(n, size, rng):
+    return [(i + 1, rng.randrange(1, size - 1), rng.randrange(1, size - 1), rng.choice((0.1, 0.25, 0.5, 1)))
+            for i in range(n)]
+
+
+def measure(engine, path, ships, steps):
+    start = time.perf_counter()
+    result = engine(Map(path), ships, 1, treasure=10**12).run(steps)
+    elapsed = time.perf_counter() - start
+    again = engine(Map(path), ships, 1, treasure=10**12).run(steps)
+    return result["moves"] / elapsed, result["fights"], result == again
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Headless simulation ship-moves per second")
+    ap.add_argument("--steps", type=int, default=50, help="random moves of every ship")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="fleet sizes")
+    ap.add_argument("--size", type=int, default=1000, help="side of the (square) map")
+    args = ap.parse_args()
+
+    rng = random.Random(1)
+    path = os.path.join(tempfile.mkdtemp(), "bench_map.txt")
+    write_map(path, args.size, rng)
+    Map(path)   #writes the compiled cache once
+
+    engines = [("exact", simulation.Simulation)]
+    if simulation.np is not None:
+        engines.append(("batch", simulation.BatchSimulation))
+    print(f"{'ships':>6} {'engine':>6} {'moves/s':>12} {'fights':>8} {'repeatable':>10}")
+    for n in args.sizes:
+        ships = fleet(n, args.size, rng)
+        for name, engine in engines:
+            rate, fights, same = measure(engine, path, ships, args.steps)
+            print(f"{n:>6} {name:>6} {rate:>12,.0f} {fights:>8} {str(same):>10}", flush=True)
+
+    for name in os.listdir(os.path.dirname(path)):
+        os.unlink(os.path.join(os.path.dirname(path), name))
+    os.rmdir(os.path.dirname(path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# Benchmark: spatial queries on a large map (spatial.py) against scanning.
+#
+# A random --size x --size sea with islands and ports gets --ships ships with
+# set_ship. Then, at random points, the index answers within_radius (ships,
+# ports and islands), within_box and k_nearest. The same questions are also
+# answered the old way: every ship of the fleet and every port / island of
+# cells_of_type, each one checked. Both must give the same cells. The time to
+# build the index (first query) is shown apart.
+#
+# Usage: python3 benchmarks/bench_spatial.py [--size 2000] [--ships 10000] [--radius 20] [--queries 1000]
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from map import Map, cache_path
+from spatial import KINDS
+
+
+def write_map(path, size, rng):
+    #water with 1% islands and 0.1% ports, rocks around
+    with open(path, "w") as f:
+        for y in range(size):
+            row = []
+            for x in range(size):
+                if x in (0, size - 1) or y in (0, size - 1):
+                    row.append("#")
+                else:
+                    roll = rng.random()
+                    row.append("I" if roll < 0.01 else "P" if roll < 0.011 else ".")
+            f.write("".join(row) + "\n")
+
+
+def scan_radius(mapa, ships, features, x, y, r, kind):
+    #the old way: every candidate checked
+    cells = ships if kind == "ship" else features[kind]
+    found = sorted(((cx - x) ** 2 + (cy - y) ** 2, cy, cx) for cx, cy in cells
+                   if (cx - x) ** 2 + (cy - y) ** 2 <= r * r)
+    return [(cx, cy) for _, cy, cx in found]
+
+
+def timed(function, points):
+    start = time.perf_counter()
+    results = [function(*point) for point in points]
+    return (time.perf_counter() - start) / len(points), results
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Spatial index against scanning")
+    ap.add_argument("--size", type=int, default=2000, help="side of the sea")
+    ap.add_argument("--ships", type=int, default=10000, help="ships on the map")
+    ap.add_argument("--radius", type=int, default=20, help="radius of within_radius")
+    ap.add_argument("--k", type=int, default=5, help="k of k_nearest")
+    ap.add_argument("--queries", type=int, default=1000, help="queries of every kind")
+    args = ap.parse_args()
+
+    rng = random.Random(7)
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, "sea.txt")
+    write_map(path, args.size, rng)
+    mapa = Map(path)
+    # One ship per cell, as the captain keeps its fleet (the map marks a cell, it does not count)
+    ships = []
+    while len(ships) < args.ships:
+        x, y = rng.randrange(args.size), rng.randrange(args.size)
+        if mapa.get_cell_type(x, y) in (Map.WATER, Map.PORT, Map.ISLAND):
+            mapa.set_ship(x, y)
+            ships.append((x, y))
+
+    start = time.perf_counter()
+    mapa.within_radius(0, 0, 1, "port")     #builds the index
+    build = time.perf_counter() - start
+    # Moves after the index exists keep it up to date
+    for i in range(0, len(ships), 2):
+        x, y = ships[i]
+        if mapa.get_cell_type(x, y + 1) in (Map.WATER, Map.PORT, Map.ISLAND):
+            mapa.remove_ship(x, y)
+            mapa.set_ship(x, y + 1)
+            ships[i] = (x, y + 1)
+    features = {"port": mapa.cells_of_type(Map.PORT) + mapa.cells_of_type(Map.HOME),
+                "island": mapa.cells_of_type(Map.ISLAND) + mapa.cells_of_type(Map.BAR)}
+    ship_cells = sorted(ships)
+    print(f"{args.size}x{args.size} sea, {len(ship_cells)} ship cells, {len(features['port'])} ports, "
+          f"{len(features['island'])} islands, index built in {build * 1000:.1f} ms")
+
+    points = [(rng.randrange(args.size), rng.randrange(args.size)) for _ in range(args.queries)]
+    r, half = args.radius, args.radius
+    print(f"{'query':>24} {'index us':>10} {'scan us':>10} {'speedup':>8} {'same':>5}")
+    for kind in KINDS:
+        index, found = timed(lambda x, y: mapa.within_radius(x, y, r, kind), points)
+        scan, expected = timed(lambda x, y: scan_radius(mapa, ship_cells, features, x, y, r, kind), points)
+        print(f"{f'within_radius {kind}':>24} {index * 1e6:>10.1f} {scan * 1e6:>10.1f} {scan / index:>7.0f}x "
+              f"{str(found == expected):>5}")
+    index, found = timed(lambda x, y: mapa.within_box(x - half, y - half, x + half, y + half, "ship"), points)
+    scan, expected = timed(lambda x, y: sorted(((cx, cy) for cx, cy in ship_cells
+                                                 if abs(cx - x) <= half and abs(cy - y) <= half),
+                                                key=lambda cell: (cell[1], cell[0])), points)
+    print(f"{'within_box ship':>24} {index * 1e6:>10.1f} {scan * 1e6:>10.1f} {scan / index:>7.0f}x {str(found == expected):>5}")
+    for kind in ("ship", "port"):
+        index, found = timed(lambda x, y: mapa.k_nearest(x, y, args.k, kind), points)
+        scan, expected = timed(lambda x, y: scan_radius(mapa, ship_cells, features, x, y, 2 * args.size, kind)[:args.k],
+                               points)
+        # Equal distances may come in another order, the distances must match
+        same = all([(cx - x) ** 2 + (cy - y) ** 2 for cx, cy in a] == [(cx - x) ** 2 + (cy - y) ** 2 for cx, cy in b]
+                   for (x, y), a, b in zip(points, found, expected))
+        print(f"{f'k_nearest {kind} k={args.k}':>24} {index * 1e6:>10.1f} {scan * 1e6:>10.1f} {scan / index:>7.0f}x "
+              f"{str(same):>5}")
+
+    for name in (path, cache_path(path)):
+        if os.path.exists(name):
+            os.unlink(name)
+    os.rmdir(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Benchmark: time until a whole fleet is ready, and its memory, per spawn mode.
+#
+# "exec" forks and execs a new python3 running ship5.py for every ship (each one
+# imports everything and loads the map again). "fork" only forks: the ship runs
+# in a copy of the captain, which already imported the modules and loaded the map.
+# "host" forks one ship host per CPU (captain5.py --hosts), each one runs its share
+# of the fleet in a single process.
+# A fleet is ready when every ship has answered its first command.
+#
+# RSS counts the shared pages once per ship, PSS splits them between the ships
+# that share them, so PSS is the real memory of the fleet.
+#
+# Usage: python3 benchmarks/bench_spawn.py [--ships 10 50 200] [--size 1000]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import selectors
+import captain5
+import log
+from map import Map
+
+
+def write_map(path, size):
+    #open sea with a rock border, size x size
+    with open(path, "w") as f:
+        f.write("#" * size + "\n")
+        for _ in range(size - 2):
+            f.write("#" + "." * (size - 2) + "#\n")
+        f.write("#" * size + "\n")
+
+
+def memory_kb(pid):
+    #(rss, pss) of a process in kB, pss is None without smaps_rollup
+    rss = pss = None
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Rss:"):
+                    rss = int(line.split()[1])
+                elif line.startswith("Pss:"):
+                    pss = int(line.split()[1])
+    except OSError:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+    return rss, pss
+
+
+def measure(path, ships, mode, size):
+    hosts = os.cpu_count() if mode == "host" else 0
+    args = argparse.Namespace(map=path, wire="binary", tile_budget=64, ursula=None, random=False, seed=None,
+                              spawn="exec" if mode == "exec" else "fork", hosts=hosts,
+                              log_level="info", quiet=False, log_rate=log.RATE)
+    captain5.selector = selectors.DefaultSelector()
+    start = time.perf_counter()
+    captain5.mapa = Map(path)
+    fleet = [(str(n + 1), 1 + n % (size - 2), 1 + n // (size - 2), 1) for n in range(ships)]
+    if hosts:
+        for i in range(min(hosts, ships)):
+            captain5.spawn(fleet[i::hosts], args)
+    else:
+        for shipId, x, y, speed in fleet:
+            captain5.spawn_ship(shipId, x, y, args, speed)
+    for shipId in list(captain5.ship_dict):
+        captain5.dispatch(shipId, "up")
+    captain5.wait_replies()
+    elapsed = time.perf_counter() - start
+
+    rss = pss = 0
+    for pid in {ship["pid"] for ship in captain5.ship_dict.values()}:
+        ship_rss, ship_pss = memory_kb(pid)
+        rss += ship_rss
+        pss += ship_pss or 0
+    for shipId in list(captain5.ship_dict):
+        pid = captain5.ship_dict[shipId]["pid"]
+        if captain5.forget_ship(shipId):    #closing its pipes makes the ship (host) exit
+            os.waitpid(pid, 0)
+    return elapsed, rss / 1024, pss / 1024
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fleet start-up time and memory, fork+exec vs fork vs ship hosts")
+    ap.add_argument("--ships", type=int, nargs="+", default=[10, 50, 200], help="fleet sizes")
+    ap.add_argument("--size", type=int, default=1000, help="side of the (square) map")
+    args = ap.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench_map.txt")
+    write_map(path, args.size)
+    Map(path)   #writes the compiled cache once, both modes use it
+
+    stderr = os.dup(2)
+    print(f"{'ships':>6} {'mode':>5} {'ready s':>8} {'ms/ship':>8} {'RSS MB':>8} {'PSS MB':>8}")
+    for ships in args.ships:
+        for mode in ("exec", "fork", "host"):
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 2)     #the captain and the ships log every step
+            os.close(devnull)
+            elapsed, rss, pss = measure(path, ships, mode, args.size)
+            log.flush()     #the captain's lines still queued go to /dev/null too
+            os.dup2(stderr, 2)
+            print(f"{ships:>6} {mode:>5} {elapsed:>8.2f} {elapsed / ships * 1000:>8.1f} {rss:>8.0f} {pss:>8.0f}", flush=True)
+
+    for name in os.listdir(os.path.dirname(path)):
+        os.unlink(os.path.join(os.path.dirname(path), name))
+    os.rmdir(os.path.dirname(path))
+
+
+if __name__ == "__main__":
+    main()
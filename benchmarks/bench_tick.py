@@ -0,0 +1,106 @@
+# Benchmark: Ursula settling the fights after every MOVE against once per tick
+# (ursula.py --tick), with dense fleets.
+#
+# N ships on a --side x --side sea (few cells per ship, many fights) move
+# --moves-per-tick times per tick. The same binary records go through
+# Ursula.process_buffer in wakeups of 256 messages. In tick mode the end of
+# every tick is called by hand after its messages (resolve_tick), not by the
+# clock, so both modes see exactly the same messages.
+#
+# Per MOVE Ursula fights and, with the status on (as she runs by default), dumps
+# every ship: O(N) per message. Per tick only the last move of every ship is
+# applied, every crowded cell fights once and there is one dump. The logs and
+# dumps go to /dev/null, their cost is measured but not their output.
+#
+# Usage: python3 benchmarks/bench_tick.py [--ships 100 1000] [--side 10] [--ticks 20] [--no-status]
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import log
+import protocol
+from ursula import Ursula
+
+WAKEUP = 256    #messages handled per wakeup of the loop
+
+
+class CountingUrsula(Ursula):
+    def __init__(self, status, tick):
+        super().__init__("bench", seed=1, status=status, tick=tick)
+        self.treasure = 10 ** 12    #never reach the end of the world
+        self.dumps = 0
+
+    def print_ship_status(self):
+        self.dumps += 1
+        super().print_ship_status()
+
+    def check_termination(self):
+        pass
+
+
+def fleet_messages(ships, side, ticks, moves_per_tick, rng):
+    #the INITs and, per tick, the MOVE records of a random walk of every ship
+    pos = {pid: (rng.randrange(side), rng.randrange(side)) for pid in range(1, ships + 1)}
+    init = b"".join(protocol.pack(protocol.INIT, pid, x, y, 100, 0) for pid, (x, y) in pos.items())
+    steps = []
+    for _ in range(ticks):
+        tick = bytearray()
+        for _ in range(moves_per_tick):
+            for pid in rng.sample(sorted(pos), ships):
+                x, y = pos[pid]
+                dx, dy = rng.choice(((0, 1), (1, 0), (0, -1), (-1, 0)))
+                pos[pid] = x, y = min(side - 1, max(0, x + dx)), min(side - 1, max(0, y + dy))
+                tick += protocol.pack(protocol.MOVE, pid, x, y, 100, 0)
+        steps.append(bytes(tick))
+    return init, steps
+
+
+def measure(init, steps, status, tick):
+    ursula = CountingUrsula(status, tick)
+    ursula.process_buffer(bytearray(init))
+    start = time.perf_counter()
+    for step in steps:
+        buffer = bytearray(step)
+        while buffer:
+            ursula.process_buffer(buffer, WAKEUP)
+        if tick:
+            ursula.resolve_tick()
+    log.flush()
+    elapsed = time.perf_counter() - start
+    return elapsed, ursula.metrics.counters.get(("fights", None), 0), ursula.dumps
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fights after every MOVE against once per tick")
+    ap.add_argument("--ships", type=int, nargs="+", default=[100, 1000], help="fleet sizes")
+    ap.add_argument("--side", type=int, default=10, help="side of the sea, smaller means more fights")
+    ap.add_argument("--ticks", type=int, default=20, help="ticks of moves")
+    ap.add_argument("--moves-per-tick", type=int, default=2, help="MOVEs of every ship per tick")
+    ap.add_argument("--no-status", action="store_true", help="no status dump (after every MOVE or tick)")
+    args = ap.parse_args()
+
+    log.logger.rate = 0     #every line of both modes is written (to /dev/null)
+    stderr = os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    print(f"{'ships':>6} {'mode':>8} {'moves/s':>10} {'seconds':>8} {'fights':>7} {'dumps':>6} {'speedup':>8}")
+    for ships in args.ships:
+        init, steps = fleet_messages(ships, args.side, args.ticks, args.moves_per_tick, random.Random(ships))
+        moves = ships * args.ticks * args.moves_per_tick
+        base = None
+        for mode, tick in (("message", 0.0), ("tick", 1.0)):
+            os.dup2(devnull, 2)
+            try:
+                elapsed, fights, dumps = measure(init, steps, not args.no_status, tick)
+            finally:
+                os.dup2(stderr, 2)
+            base = base or elapsed
+            print(f"{ships:>6} {mode:>8} {moves / elapsed:>10,.0f} {elapsed:>8.2f} {fights:>7} {dumps:>6} "
+                  f"{base / elapsed:>7.1f}x", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+# Benchmark: load generator for Ursula, throughput and latency as the fleet grows.
+#
+# Ursula runs in a child process on a temporary FIFO or Unix socket. N captain
+# processes (load generators) share the fleet: each one sends INIT_CAPT and the
+# INIT of its ships, waits for the others, sends the MOVEs of a random walk at
+# its share of --rate messages/s (0 = as fast as it can) and ends with the
+# TERMINATEs and END_CAPT. Ursula then ends by herself (check_termination).
+#
+# Inside Ursula every handle_message is timed (processing latency) and so is
+# every handle_fight that ends in a fight (fight cost). She reports messages/s
+# from her first to her last message and her peak RSS.
+#
+# The treasure is never exhausted and the O(N) status dump of every MOVE is off
+# (--status to include it). The results go to stdout and, with --json, to a file
+# with the git commit, so runs of two versions can be compared.
+#
+# Usage: python3 benchmarks/bench_ursula.py [--transport fifo|socket] [--ships 10 100 1000]
+#            [--captains 4] [--messages 20000] [--rate 0] [--json results.json]
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import protocol
+import transport
+from ursula import Ursula
+
+BATCH = 64      #messages per write of a generator
+
+
+class MeasuredUrsula(Ursula):
+    def __init__(self, target, status):
+        super().__init__(target, seed=1, status=status)
+        self.treasure = 10 ** 12    #never reach the end of the world
+        self.latency = array('q')   #ns per message
+        self.fight_cost = array('q')
+        self.first = self.last = None
+
+    def handle_message(self, msg_type, arg, pid, x, y, food, gold):
+        start = time.perf_counter_ns()
+        super().handle_message(msg_type, arg, pid, x, y, food, gold)
+        end = time.perf_counter_ns()
+        self.latency.append(end - start)
+        if self.first is None:
+            self.first = start
+        self.last = end
+
+    def handle_fight(self, ship_pid, x, y):
+        if len(self.cells.get((x, y), ())) < 2:
+            return super().handle_fight(ship_pid, x, y)
+        start = time.perf_counter_ns()
+        super().handle_fight(ship_pid, x, y)
+        self.fight_cost.append(time.perf_counter_ns() - start)
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_ursula(target, status, result_path):
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)     #Ursula logs every message
+    ursula = MeasuredUrsula(target, status)
+    ursula.run()
+    latency = sorted(ursula.latency)
+    fights = sorted(ursula.fight_cost)
+    elapsed = (ursula.last - ursula.first) / 1e9 if latency else 0.0
+    result = {
+        "messages": len(latency),
+        "seconds": elapsed,
+        "messages_per_s": len(latency) / elapsed if elapsed else 0.0,
+        "latency_us": {name: percentile(latency, q) / 1000 for name, q in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))},
+        "fights": len(fights),
+        "fight_us": {
+            "mean": sum(fights) / len(fights) / 1000 if fights else 0.0,
+            "p99": percentile(fights, 0.99) / 1000,
+        },
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    with open(result_path, "w") as f:
+        json.dump(result, f)
+
+
+def wait_ready(target, timeout=5.0):
+    #a socket accepts connections only once Ursula listens, a FIFO writer just blocks
+    path = transport.socket_path(target)
+    deadline = time.monotonic() + timeout
+    while path is not None:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+        finally:
+            probe.close()
+
+
+def captain(target, index, ships, moves, rate, side, barrier):
+    #one load generator: a captain with its ships, rate in messages/s (0: no limit)
+    rng = random.Random(index)
+    writer = transport.get_writer(target)
+    captain_pid = os.getpid()
+    pids = [(captain_pid << protocol.HOST_SHIP_BITS) | i for i in range(ships)]
+    pos = {pid: (rng.randrange(side), rng.randrange(side)) for pid in pids}
+    writer.send_bytes(protocol.pack(protocol.INIT_CAPT, captain_pid), flush=False)
+    for pid in pids:
+        writer.send_bytes(protocol.pack(protocol.INIT, pid, *pos[pid], 100, 0), flush=False)
+    writer.flush()
+    barrier.wait()      #every captain registered before the first one can end
+
+    start = time.perf_counter()
+    sent = 0
+    for _ in range(moves):
+        for pid in pids:
+            x, y = pos[pid]
+            dx, dy = rng.choice(((0, 1), (1, 0), (0, -1), (-1, 0)))
+            pos[pid] = x, y = min(side - 1, max(0, x + dx)), min(side - 1, max(0, y + dy))
+            sent += 1
+            writer.send_bytes(protocol.pack(protocol.MOVE, pid, x, y, 100, 0), flush=sent % BATCH == 0)
+            if rate and sent % BATCH == 0:
+                ahead = sent / rate - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+    for pid in pids:
+        writer.send_bytes(protocol.pack(protocol.TERMINATE, pid), flush=False)
+    writer.send_bytes(protocol.pack(protocol.END_CAPT, captain_pid))
+    writer.close()
+
+
+def measure(kind, ships, captains, messages, rate, side, status):
+    tmp = tempfile.mkdtemp()
+    if kind == "socket":
+        target = transport.SOCKET_PREFIX + os.path.join(tmp, "sea.sock")
+    else:
+        target = os.path.join(tmp, "sea_pipe")
+        os.mkfifo(target)
+    result_path = os.path.join(tmp, "result.json")
+    ursula = multiprocessing.Process(target=run_ursula, args=(target, status, result_path))
+    ursula.start()
+    wait_ready(target)
+
+    captains = min(captains, ships)
+    moves = max(1, messages // ships)
+    barrier = multiprocessing.Barrier(captains)
+    generators = [multiprocessing.Process(target=captain, args=(target, i, ships // captains + (i < ships % captains),
+                                                                moves, rate / captains, side, barrier))
+                  for i in range(captains)]
+    start = time.perf_counter()
+    for generator in generators:
+        generator.start()
+    for generator in generators:
+        generator.join()
+    ursula.join()
+    wall = time.perf_counter() - start
+
+    with open(result_path) as f:
+        result = json.load(f)
+    result.update(ships=ships, captains=captains, moves_per_ship=moves, wall_seconds=wall)
+    for name in os.listdir(tmp):
+        os.unlink(os.path.join(tmp, name))
+    os.rmdir(tmp)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Ursula load generator: messages/s, latency, fight cost, peak RSS")
+    ap.add_argument("--transport", choices=("fifo", "socket"), default="fifo", help="how the captains reach Ursula")
+    ap.add_argument("--ships", type=int, nargs="+", default=[10, 100, 1000], help="fleet sizes")
+    ap.add_argument("--captains", type=int, default=4, help="load generator processes")
+    ap.add_argument("--messages", type=int, default=20000, help="MOVE messages per run")
+    ap.add_argument("--rate", type=float, default=0, help="target MOVE messages/s of all the captains, 0 = no limit")
+    ap.add_argument("--side", type=int, default=50, help="side of the sea, smaller means more fights")
+    ap.add_argument("--status", action="store_true", help="keep Ursula's status dump after every MOVE")
+    ap.add_argument("--json", type=str, help="file to save the results")
+    args = ap.parse_args()
+
+    runs = []
+    print(f"{'ships':>6} {'msg/s':>10} {'p50 us':>8} {'p99 us':>8} {'p999 us':>8} {'fights':>7} {'fight us':>9} {'RSS MB':>7}")
+    for ships in args.ships:
+        r = measure(args.transport, ships, args.captains, args.messages, args.rate, args.side, args.status)
+        runs.append(r)
+        lat = r["latency_us"]
+        print(f"{ships:>6} {r['messages_per_s']:>10,.0f} {lat['p50']:>8.1f} {lat['p99']:>8.1f} {lat['p999']:>8.1f} "
+              f"{r['fights']:>7} {r['fight_us']['mean']:>9.1f} {r['peak_rss_mb']:>7.1f}", flush=True)
+
+    if args.json:
+        report = {
+            "benchmark": "bench_ursula",
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": git_commit(),
+            "python": platform.python_version(),
+            "protocol": protocol.VERSION,
+            "params": {key: value for key, value in vars(args).items() if key != "json"},
+            "runs": runs,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved in {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Check: the headless simulation (simulation.py) against the processes.
+#
+# For every seed a random fleet of fast ships (many of them due in the same tick)
+# is run twice on the same map: once by Simulation, once by ursula.py <pipe> <seed>
+# + captain5.py --random --seed --hosts 1. The fights and Ursula's treasure at the
+# end must be the same. Ursula's are read from her log (--log-rate 0 keeps every
+# line).
+#
+# Usage: python3 benchmarks/check_simulation.py [--map map.txt] [--ships 20] [--steps 40] [--seeds 1 7 42]
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from map import Map
+import simulation
+
+
+def write_fleet(path, mapa, n, rng):
+    #n ships on water cells, one move every 0.05 or 0.1 s
+    water = mapa.cells_of_type(Map.WATER)
+    fleet = [(i + 1, *rng.choice(water), rng.choice((0.05, 0.1))) for i in range(n)]
+    with open(path, "w") as f:
+        for shipId, x, y, speed in fleet:
+            f.write(f"{shipId} ({x},{y}) {speed}\n")
+    return fleet
+
+
+def run_processes(map_path, ships_path, steps, seed, tmp):
+    #(fights, treasure) of Ursula after the fleet has done its steps
+    pipe = os.path.join(tmp, "sea_pipe")
+    log_path = os.path.join(tmp, "ursula.log")     #a pipe would fill up and stop her
+    with open(log_path, "w") as log_file:
+        ursula = subprocess.Popen([sys.executable, os.path.join(ROOT, "ursula.py"), pipe, str(seed),
+                                   "--no-status", "--log-rate", "0"], stdout=subprocess.DEVNULL, stderr=log_file)
+    while not os.path.exists(pipe):
+        time.sleep(0.01)
+    captain = subprocess.Popen([sys.executable, os.path.join(ROOT, "captain5.py"), "--map", map_path,
+                                "--ships", ships_path, "--random", "--steps", str(steps), "--seed", str(seed),
+                                "--hosts", "1", "--ursula", pipe, "--quiet"],
+                               stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               text=True)
+    # The captain waits for commands while it has ships, an empty line makes it look
+    # again. End of input would be exit, which stops the ships before their steps
+    while captain.poll() is None:
+        try:
+            captain.stdin.write("\n")
+            captain.stdin.flush()
+        except BrokenPipeError:
+            break
+        time.sleep(0.1)
+    captain.wait()
+    ursula.wait(timeout=60)
+    with open(log_path) as f:
+        log = f.read()
+    fights = log.count("Fight detected")
+    paid = re.findall(r"\(remaining: (\d+)\)", log)
+    return fights, int(paid[-1]) if paid else simulation.TREASURE
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Same seed, same fights and treasure in simulation.py and the processes")
+    ap.add_argument("--map", type=str, default=os.path.join(ROOT, "map.txt"), help="map file path")
+    ap.add_argument("--ships", type=int, default=20, help="ships of the fleet")
+    ap.add_argument("--steps", type=int, default=40, help="random moves of every ship")
+    ap.add_argument("--seeds", type=str, nargs="+", default=["1", "7", "42"], help="seeds to compare")
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    ships_path = os.path.join(tmp, "ships.txt")
+    print(f"{'seed':>6} {'sim fights':>10} {'sim treasure':>12} {'fights':>8} {'treasure':>8} {'same':>5}")
+    failed = 0
+    for seed in args.seeds:
+        fleet = write_fleet(ships_path, Map(args.map), args.ships, random.Random(seed))
+        result = simulation.Simulation(Map(args.map), fleet, seed).run(args.steps)
+        fights, treasure = run_processes(args.map, ships_path, args.steps, seed, tmp)
+        same = (fights, treasure) == (result["fights"], result["treasure"])
+        failed += not same
+        print(f"{seed:>6} {result['fights']:>10} {result['treasure']:>12} {fights:>8} {treasure:>8} {str(same):>5}", flush=True)
+
+    for name in os.listdir(tmp):
+        os.unlink(os.path.join(tmp, name))
+    os.rmdir(tmp)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,26 @@
 import map
 import os 
+import time
+import random
 import argparse, sys, signal
-from map import Map   #lo añadí pq si no no te deja entrar a argumento map
+import atexit
+import selectors
+import protocol
+import transport
+import pathfinding
+import spatial
+import ship5
+import log
+from collections import deque
+from map import Map
+from shared_map import SharedMap
+from tiled_map import TiledMap, TILE_SUFFIX, open_map   #lo añadí pq si no no te deja entrar a argumento map
 
 ship_dict = {}    #dictionary del capitan to control los ships
+fleet_index = {}  #(x, y) -> shipId, where each ship will be after its outstanding commands
+pid_index = {}    #pid -> channel of that process, to know which ships SIGCHLD is about
+alive_ships = 0   #ships still sailing, kept up to date instead of counting ship_dict
+reaped = deque()  #pids reaped by handler_sigchld, their ships are forgotten by reap_ships
 mapa = None
 ursula_pipe = None
 all_finished = False
@@ -15,18 +32,25 @@ def arguments():
     ap.add_argument("--map", type=str, default="map.txt", help="map file path")
     ap.add_argument("--ships", type=str, default="ships.txt", help="ship info file path")
     ap.add_argument("--random", action= "store_true", default=0, help="if flag given, move randomly") # action only to use the captain command when it's present and if not, random movement
+    ap.add_argument("--steps", type=int, default=100, help="moves of every ship with --random, one every <speed> seconds of ships.txt")
+    ap.add_argument("--seed", type=str, help="repeatable random moves, the same as simulation.py with this seed")
     ap.add_argument("--ursula", type=str, help="Pipe for ursula.py, ursula_pipe")
+    ap.add_argument("--no-shared-map", action="store_true", help="every ship loads its own copy of the map file")
+    ap.add_argument("--tile-budget", type=int, default=64, help="MB of map tiles kept in memory (.tiles maps)")
+    ap.add_argument("--wire", choices=protocol.WIRES, default="binary", help="message format, text is for debugging")
+    ap.add_argument("--spawn", choices=("fork", "exec"), default="fork", help="fork: ships reuse the captain's interpreter and map, exec: a new python3 per ship")
+    ap.add_argument("--hosts", type=int, default=0, help="run the fleet in this many ship host processes (0: one process per ship)")
+    log.add_arguments(ap)
     return ap.parse_args()  #returns arguments 
 
-def send_to_ursula(message, ursula_pipe):
+def send_to_ursula(ursula_pipe, msg_type, pid):
+    #the connection stays open for the whole life of the captain (see transport.py)
     if ursula_pipe:
         try:
-            with open(ursula_pipe, "w") as fifo:
-                fifo.write(message + "\n")
-                fifo.flush()
-            print(f"Captain: sent message to Ursula: {message}", file=sys.stderr)
+            transport.send_record(ursula_pipe, msg_type, pid)
+            log.info(f"Captain: sent message to Ursula: {protocol.to_text(msg_type, pid)}", "ursula")
         except OSError as e:
-            print(f"Error happened: {e}", file=sys.stderr)
+            log.error(f"Error happened: {e}")
 
 def read_ship_info(file_path):
 #argumentos:
@@ -48,16 +72,19 @@ def read_ship_info(file_path):
                 position = parts[1].strip("()").split(",") #this is an array that stores the positions so we can later separate them into two directions
                 x = position[0]
                 y = position[1]
-                #For the speed:
+                #For the speed: seconds between moves with --random, fractions too (0.25)
                 speed = parts[2]
+                try:
+                    float(speed)
+                except ValueError:
+                    log.warning(f"Invalid speed {speed} for ship {shipId}.")
+                    continue
                 ship.append((shipId, x, y, speed))
 
-                print(f"Ship ID: {shipId}, Pos: ({x},{y}), Speed: {speed}", file=sys.stderr)
-                sys.stderr.flush()
+                log.info(f"Ship ID: {shipId}, Pos: ({x},{y}), Speed: {speed}")
             return ship
     except OSError as e:
-        print(f"Error happened: {e}", file=sys.stderr)
-        sys.stderr.flush()
+        log.error(f"Error happened: {e}")
         sys.exit(1)
 
 
@@ -66,253 +93,715 @@ def handler_sigint(signo, frame):
     global ursula_pipe
     signame = signal.strsignal(signo)
     sigpid = os.getpid()
-    print(f'[{sigpid}] Caught signal {signame} ({signo})')
-    sys.stderr.flush()
-    print("Captain will finish. Sending SIGQUIT to all ships...")
-    sys.stderr.flush()
+    log.info(f'[{sigpid}] Caught signal {signame} ({signo})')
+    log.info("Captain will finish. Sending SIGQUIT to all ships...")
 
-    #send SIGQUIT to ships (kill them)
-    for ship in ship_dict.values():
+    #send SIGQUIT to ships (kill them). A ship host ends all its ships
+    reap_ships()
+    processes = list(pid_index)     #the ones not reaped yet by handler_sigchld
+    for pid in processes:
         try: 
-            os.kill(ship["pid"], signal.SIGQUIT)
+            os.kill(pid, signal.SIGQUIT)
         except OSError as e:
-         print(f"Error happened: {e}", file=sys.stderr)
-         sys.stderr.flush()
+         log.error(f"Error happened: {e}")
 
     #wait until ships are terminated
-    for ship in list(ship_dict.values()):
+    for pid in processes:
         try:
-            pid_fin, status = os.waitpid(ship["pid"], 0)   #waits for each ship. not use os.wait() bc it may show the ship in the wrong order
+            pid_fin, status = os.waitpid(pid, 0)   #waits for each ship. not use os.wait() bc it may show the ship in the wrong order
             if os.WIFEXITED(status):
                 code = os.WEXITSTATUS(status)   #exit code
-                print(f"Ship {pid_fin} exited with code {code}")
-                sys.stderr.flush()
+                log.info(f"Ship {pid_fin} exited with code {code}")
             else:
-                print(f"Ship {pid_fin} not terminated as expected")
-                sys.stderr.flush()
+                log.warning(f"Ship {pid_fin} not terminated as expected")
+        except ChildProcessError:   #reaped meanwhile by handler_sigchld
+            pass
         except OSError as e:
-            print(f"Error happened: {e}", file=sys.stderr)
-            sys.stderr.flush()
+            log.error(f"Error happened: {e}")
+    for shipId in ship_dict:    #off the map
+        ship_gone(shipId)
 
     if ursula_pipe:
-        send_to_ursula(f"{os.getpid()},END_CAPT", ursula_pipe)
-        for ship in ship_dict.values():
-            try:
-                end_msg = f"{os.getpid()},END_CAPT\n"
-                os.close(ship["w_pipe"])
-                os.close(ship["r_pipe"])
-                print("Captain: Sent termination to Ursula", file=sys.stderr)
-            except OSError as e:
-                print(f"Error sending termination to Ursula: {e}", file=sys.stderr)
-
-    print("All ships finished. Captain exits.")
-    sys.stderr.flush()
+        send_to_ursula(ursula_pipe, protocol.END_CAPT, os.getpid())
+        for channel in {id(ship["channel"]): ship["channel"] for ship in ship_dict.values()}.values():
+            close_channel(channel)
+        log.info("Captain: Sent termination to Ursula")
+
+    log.info("All ships finished. Captain exits.")
     sys.exit(0)   #0 for all exited correctly, 1 when exited with problems
 
 
 def handler_sigchld(signo, frame):      #ESTO SALE DISTINTO
-    print("Captain received SIGCHLD", file=sys.stderr)
-    sys.stderr.flush()
+    log.info("Captain received SIGCHLD", "child")
     signame = signal.strsignal(signo)           #signal name
     sigpid = os.getpid()      
-    print(f'[{sigpid}] Caught signal {signame} ({signo})')
-    sys.stderr.flush()
-    if (signo == signal.SIGCHLD):
-        pid_fin, status = os.wait()
-    if os.WIFEXITED(status) :
-        print(f'Child {pid_fin} exit code: {os.WEXITSTATUS(status)}')
-        sys.stderr.flush()
-    else:
-        print(f'Child {pid_fin} completed')
-        sys.stderr.flush()
+    log.info(f'[{sigpid}] Caught signal {signame} ({signo})')
+    #WNOHANG: only the children that already exited. os.wait() would block forever here
+    #once the ships are reaped, the resource tracker of the shared map is also our child
+    while True:
+        try:
+            pid_fin, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid_fin == 0:
+            return
+        if os.WIFEXITED(status) :
+            log.info(f'Child {pid_fin} exit code: {os.WEXITSTATUS(status)}', "child")
+        else:
+            log.info(f'Child {pid_fin} completed', "child")
+        #the handler can run in the middle of anything (e.g. apply_reply), the ships
+        #are only changed from the main loop
+        reaped.append(pid_fin)
+
+def reap_ships():
+    #the ships of the processes reaped by handler_sigchld are gone
+    while reaped:
+        channel = pid_index.pop(reaped.popleft(), None)
+        if channel is None:     #already forgotten after its exit reply
+            continue
+        for shipId in channel["ships"]:     #every ship of a host dies with it
+            ship_gone(shipId)
+            ship_dict[shipId]["pending"].clear()
+        close_channel(channel)
 
 #PIPES
-def send_command(shipId, command):
+#The captain does not wait for one ship before talking to the next one. Every command
+#goes to the ship's queue of outstanding commands (ship["pending"]) and the replies
+#are read with a selector over all the r_pipes, in whatever order the ships answer.
+#Commands and replies are frames with a sequence number (protocol.py), a command can
+#carry a batch of moves and its reply brings the real position, food and gold of the ship.
+#The pipes belong to a channel, one per ship process: a ship of its own, or a ship host
+#(--hosts) with many ships on the same pipes. Frames and replies carry the ship id.
+selector = selectors.DefaultSelector()
+MOVES = {"up": (0, 1), "down": (0, -1), "right": (1, 0), "left": (-1, 0), "exit": (0, 0)}
+MOVES.update((control, (0, 0)) for control in protocol.CONTROLS)   #supply, damage, quit, status
+LAST = ("exit", "quit")     #nothing can come after them in a batch
+
+def write_command(shipId, ship, seq, commands):
+    if transport.wire == "text":
+        os.write(ship["channel"]["w_pipe"], protocol.command_line(int(shipId), seq, commands).encode())
+    else:
+        os.write(ship["channel"]["w_pipe"], protocol.pack_command(int(shipId), seq, commands))
+
+def split_replies(channel):
+    #complete replies in the channel's input buffer, the rest waits for the next read
+    replies, end = protocol.decode_replies(channel["inbuf"], transport.wire)
+    del channel["inbuf"][:end]
+    return replies
+
+def add_channel(pid, w_pipe, r_pipe):
+    channel = pid_index[pid] = {
+        "pid": pid,
+        "w_pipe": w_pipe,
+        "r_pipe": r_pipe,
+        "inbuf": bytearray(),   #replies read but not complete yet
+        "ships": set(),         #ids of its ships still in ship_dict
+        "closed": False,        #pipes closed, their fd numbers may belong to something else now
+    }
+    selector.register(r_pipe, selectors.EVENT_READ, channel)
+    return channel
+
+def close_channel(channel):
+    #closes the pipes once. The pid stays in pid_index until the process is reaped
+    if channel["closed"]:
+        return
+    channel["closed"] = True
+    if channel["r_pipe"] in selector.get_map():
+        selector.unregister(channel["r_pipe"])
+    for fd in (channel["w_pipe"], channel["r_pipe"]):
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+#FLEET INDEX
+#fleet_index has one cell per live ship: the cell where it will be once its outstanding
+#commands are done (ship["target"]). Collision checks are one dict lookup instead of
+#a scan of the whole fleet.
+def add_ship(shipId, x, y, channel, moves_alone=False):
+    global alive_ships
+    ship = ship_dict[shipId] = {
+        "pid": channel["pid"],  #of the ship's process, shared by the ships of a host
+        "pos": (x, y),
+        "target": None,         #where it will be after the pending commands
+        "food": 100,
+        "gold": 0,
+        "channel": channel,     #pipes of its process
+        "seq": 0,               #sequence number of the last command frame
+        "pending": deque(),     #(seq, commands) sent and not answered yet, oldest first
+        "random": moves_alone,  #--random, it takes no commands
+    }
+    channel["ships"].add(shipId)
+    set_target(shipId, ship, (x, y))
+    if not mapa.shared:     #the shared map gets it from the ship itself
+        mapa.set_ship(x, y)
+    alive_ships += 1
+    return ship
+
+def set_target(shipId, ship, cell):
+    old = ship["target"]
+    if old is not None and fleet_index.get(old) == shipId:
+        del fleet_index[old]
+    if cell is not None:
+        fleet_index[cell] = shipId
+    ship["target"] = cell
+
+def ship_gone(shipId):
+    #the ship exited or died, it no longer takes a cell nor counts as alive
+    global alive_ships
+    ship = ship_dict[shipId]
+    if ship["pos"] is not None:
+        if not mapa.shared:
+            mapa.remove_ship(*ship["pos"])
+        set_target(shipId, ship, None)
+        ship["pos"] = None
+        alive_ships -= 1
+
+def taken_by_other(shipId, cell):
+    return fleet_index.get(cell, shipId) != shipId
+
+class FleetCells:
+    #cells of the rest of the fleet (and the claimed ones) for pathfinding, without copying the index
+    def __init__(self, shipId, claimed=()):
+        self.shipId = shipId
+        self.claimed = claimed
+
+    def __contains__(self, cell):
+        return cell in self.claimed or taken_by_other(self.shipId, cell)
+
+def projected_pos(ship):
+    #where the ship will be if every outstanding move is OK
+    x, y = ship["pos"]
+    for _, commands in ship["pending"]:
+        for command in commands:
+            dx, dy = MOVES[command]
+            x, y = x + dx, y + dy
+    return x, y
+
+def dispatch(shipId, *commands):
+    #checks and sends one command frame (one or more moves) without waiting for
+    #the reply. True if it was sent
     global mapa   #to be able to access map
     shipId_dict = ship_dict.get(shipId)     #get each ship Id del dictionary
     if not shipId_dict:     #if ship doesnt exist, return
-        print("Invalid ship ID.", file=sys.stderr)
-        return
-
-    if command not in ["up", "down", "left", "right", "exit"]:  #if command isnt one of the established, return
-        print("Invalid command.", file=sys.stderr)
-        return
+        log.warning("Invalid ship ID.")
+        return False
+    if shipId_dict["pos"] is None:
+        log.warning(f"Ship {shipId} is not alive.")
+        return False
+    if shipId_dict["random"]:
+        log.warning(f"Ship {shipId} moves on its own (--random).")
+        return False
+
+    #if command isnt one of the established, return. Nothing can come after exit / quit
+    if not commands or any(command not in MOVES for command in commands) or any(command in LAST for command in commands[:-1]):
+        log.warning("Invalid command.")
+        return False
+    if len(commands) > protocol.MAX_BATCH:
+        log.warning(f"Too many moves in one command (max {protocol.MAX_BATCH}).")
+        return False
 
     #Verificar si puede moverse el barco --> captain. 
     #Mover el barco --> ships
     #Simulate movement to check for collision --> captain has to coordinate all ships. Cannot be only in ships.py bc a ship doesnt know the position of other ships
-    # new position of ship
-    x, y = shipId_dict["pos"]        #Usas el shipId del diccionario para saber de que ship hablas. x, y son la posicion inicial del ship q coge del dict y luego la actualiza sumando o restando al mover
-    new_x , new_y = x, y
-    if command == "up": new_y += 1
-    elif command == "down": new_y -= 1
-    elif command == "right": new_x += 1
-    elif command == "left": new_x -= 1
-    new_pos = (new_x, new_y)    #esta es la pos final del ship, pero no la actualiza al ship, sino q es para verificar si se puede mover ahí el barco
-
-    print(f"Sending action {command} to ship {shipId}", file=sys.stderr)
-    sys.stderr.flush()
-    #to avoid collisions
-    if command != "exit":
-        #HAY QUE CONSEGUIR QUE NO VEA A LOS SHIPS DE OTRAS FLOTAS COMO ROCKS
-        if mapa.get_cell_type(new_pos[0], new_pos[1]) == Map.ROCK: #verifica si es una roca u otro barco de otra flota
-            print(f"Invalid move: Cell ({new_pos[0]},{new_pos[1]}) is a rock.", file=sys.stderr)
-            return
-        
-        #if not mapa.can_sail(new_pos[0], new_pos[1]):   #checks if its not a rock
-        #    print("Invalid move: cannot sail there.", file=sys.stderr)
-        #    return
-        if any(s["pos"] == new_pos for sid, s in ship_dict.items() if sid != shipId):    #si hay algún ship ya con la misma pos, colision
-            print(f"Move {command} for ship {shipId} is not possible due to own fleet collision.", file=sys.stderr)
-            sys.stderr.flush()
-            return
-        print(f"Ship {shipId} new position: {new_pos}", file=sys.stderr)
-        sys.stderr.flush()
-    try:  
-        os.write(shipId_dict["w_pipe"], f"{command}\n".encode())
+    # positions of the ship after each move, starting after the commands still on their way
+    log.info(f"Sending action {' '.join(commands)} to ship {shipId}")
+    new_pos = shipId_dict["target"]
+    for command in commands:
+        if command in LAST:
+            break
+        dx, dy = MOVES[command]
+        if (dx, dy) == (0, 0):  #control message, the ship stays where it is
+            continue
+        new_pos = (new_pos[0] + dx, new_pos[1] + dy)    #esta es la pos final del ship, pero no la actualiza al ship, sino q es para verificar si se puede mover ahí el barco
+        #to avoid collisions
+        if mapa.get_cell_type(new_pos[0], new_pos[1]) == Map.ROCK: #verifica si es una roca
+            log.info(f"Invalid move: Cell ({new_pos[0]},{new_pos[1]}) is a rock.")
+            return False
+        if taken_by_other(shipId, new_pos):    #si hay algún ship ya con la misma pos, colision
+            log.info(f"Move {command} for ship {shipId} is not possible due to own fleet collision.")
+            return False
+        if mapa.shared and mapa.ships_at(new_pos[0], new_pos[1]):   #the shared map has the ships of every fleet
+            log.info(f"Cell ({new_pos[0]},{new_pos[1]}) has a ship of another fleet, there will be a fight.")
+    seq = shipId_dict["seq"] = (shipId_dict["seq"] + 1) % 2**32
+    try:
         #envía el command (up, down, left, right) desde w_pipe. utiliza lo sel ship_dict pq necesita saber el id y todo del barco del q envía la info
-        response = os.read(shipId_dict["r_pipe"], 1024).decode().strip() #recibe la respuesta del ship (Ok or NOK). 1024 es pq lee hasta 1024 bytes
+        write_command(shipId, shipId_dict, seq, commands)
     except OSError as e:
-        print(f"Error happened: {e}", file=sys.stderr)
+        log.error(f"Error happened: {e}")
+        return False
+    shipId_dict["pending"].append((seq, commands))
+    set_target(shipId, shipId_dict, new_pos)
+    return True
+
+def apply_reply(shipId, commands, reply):
+    #updates the captain's view of the ship with the reply to its oldest command.
+    #the reply has the real state of the ship, nothing is guessed here
+    shipId_dict = ship_dict[shipId]
+    _, response, done, new_x, new_y, food, gold = reply
+    if shipId_dict["pos"] is None:      #its process was reaped before the reply was read
+        if response == "exit":
+            forget_ship(shipId)
         return
-
-    if response == "OK":  #ship moved to desired pos, everything correctly
-        mapa.remove_ship(x, y)  #quita ell ship de dnd estaba antes
-        mapa.set_ship(new_pos[0], new_pos[1])   #pone el ship en la posicion nueva
+    x, y = shipId_dict["pos"]
+    if response in ("OK", "NOK"):
+        new_pos = (new_x, new_y)
+        if new_pos != (x, y) and not mapa.shared:     #with the shared map the ship itself updates it
+            mapa.remove_ship(x, y)  #quita ell ship de dnd estaba antes
+            mapa.set_ship(new_pos[0], new_pos[1])   #pone el ship en la posicion nueva
         shipId_dict["pos"] = new_pos  #actualiza la pos del ship en el dictionary
-        shipId_dict["food"] -= 5  #actualiza el food en el dict (-5 pq se ha movido)
+        shipId_dict["food"] = food
+        shipId_dict["gold"] = gold
+        if done < len(commands):    #stopped short, the rest of its queue starts from here
+            set_target(shipId, shipId_dict, projected_pos(shipId_dict))
+        if response == "OK":  #ship moved to desired pos, everything correctly
+            log.info(f"Ship {shipId} new position: {new_pos}")
+        else:
+            log.info(f"Ship {shipId} stopped at {new_pos} after {done} of {len(commands)} moves.")
     elif response == "exit":   #eliminar zombie process
-        os.waitpid(shipId_dict["pid"], 0)  #OS lo retiene hasta q el padre lo recibe para evitar zombies
-        mapa.remove_ship(x, y)  #removes ship
-        del shipId_dict[shipId]   #removes ship's ID from dictionary (ship is removed)
-    elif response == "NOK":
-        print("Ship stays in the same position.")
+        if forget_ship(shipId):   #removes ship's ID from dictionary (and the ship from the map)
+            try:
+                os.waitpid(shipId_dict["pid"], 0)  #OS lo retiene hasta q el padre lo recibe para evitar zombies
+            except ChildProcessError:   #already reaped by handler_sigchld
+                pass
+    else:
+        log.info(f"Ship {shipId}: no reply to {' '.join(commands)}.")
+        if shipId_dict["pos"] is not None and not shipId_dict["pending"]:
+            set_target(shipId, shipId_dict, shipId_dict["pos"])
+
+def forget_ship(shipId):
+    #True if it was the last ship of its process, whose pipes are closed then
+    ship_gone(shipId)
+    channel = ship_dict.pop(shipId)["channel"]
+    channel["ships"].discard(shipId)
+    if channel["ships"]:
+        return False
+    pid_index.pop(channel["pid"], None)     #the caller waits for it
+    close_channel(channel)
+    return True
+
+NO_REPLY = (0, "", 0, 0, 0, 0, 0)
+
+def collect_replies(timeout=None):
+    #reads the replies that have arrived, [(shipId, commands, reply)] in arrival order.
+    #reply is (seq, status, done, x, y, food, gold), status "" if the ship never answered
+    done = []
+    for key, _ in selector.select(timeout):
+        channel = key.data
+        try:
+            data = os.read(channel["r_pipe"], 65536)
+        except OSError as e:
+            log.error(f"Error happened: {e}")
+            data = b""
+        if data:
+            channel["inbuf"] += data
+            try:
+                replies = split_replies(channel)
+            except ValueError as e:     #the stream cannot be trusted any more
+                log.error(f"Error happened: {e}")
+                data = b""
+        if not data:
+            #the process is gone (SIGQUIT, crash), the outstanding commands of its ships get no reply
+            for shipId in channel["ships"]:
+                ship = ship_dict[shipId]
+                done += [(shipId, commands, NO_REPLY) for _, commands in ship["pending"]]
+                ship["pending"].clear()
+                ship_gone(shipId)
+            close_channel(channel)
+            continue
+        for ship_id, *reply in replies:
+            shipId = str(ship_id)
+            if shipId not in channel["ships"]:
+                log.info(f"Reply for unknown ship {shipId}.")
+                continue
+            ship = ship_dict[shipId]
+            #replies come in order, a command older than the reply's lost its own
+            while ship["pending"] and ship["pending"][0][0] != reply[0]:
+                _, commands = ship["pending"].popleft()
+                log.info(f"Ship {shipId}: no reply to {' '.join(commands)}.")
+            if ship["pending"]:
+                done.append((shipId, ship["pending"].popleft()[1], reply))
+    for shipId, commands, reply in done:
+        if shipId in ship_dict:
+            apply_reply(shipId, commands, reply)
+    return done
+
+def outstanding():
+    return any(ship["pending"] for ship in ship_dict.values())
+
+def wait_replies():
+    #until every command sent has its reply
+    while outstanding():
+        collect_replies()
+
+def send_command(shipId, *commands):
+    #one command frame, waiting for its reply. Returns the reply (OK, NOK, exit), None if not sent
+    if not dispatch(shipId, *commands):
+        return None
+    ship = ship_dict[shipId]
+    while shipId in ship_dict and ship["pending"]:
+        for sid, _, reply in collect_replies():
+            if sid == shipId and not ship["pending"]:
+                return reply[1]
+    return "exit" if shipId not in ship_dict else None
+
+def broadcast(command):
+    #the same command to every ship at once, then the replies as they come
+    sent = [shipId for shipId in list(ship_dict) if dispatch(shipId, command)]
+    wait_replies()
+    log.info(f"Command {command} sent to {len(sent)} ships.")
+
+
+def fleet_cells(shipId, claimed=()):
+    #cells taken by the other ships of the fleet, the routes go around them
+    return FleetCells(shipId, claimed)
+
+def follow_routes(routes):
+    #routes: {shipId: [commands]}. Every ship sails its route at the same time, each
+    #one in frames of up to MAX_BATCH moves: the next frame of a ship is sent as soon
+    #as it answers the previous one with OK
+    routes = {shipId: deque(commands) for shipId, commands in routes.items() if commands}
+    total = {shipId: len(commands) for shipId, commands in routes.items()}
+
+    def send_next(shipId):
+        left = routes[shipId]
+        batch = [left.popleft() for _ in range(min(len(left), protocol.MAX_BATCH))]
+        if not dispatch(shipId, *batch):
+            log.info(f"Ship {shipId} stopped after {total[shipId] - len(left) - len(batch)} of {total[shipId]} moves.")
+            del routes[shipId]
+
+    for shipId in list(routes):
+        send_next(shipId)
+    while routes:
+        for shipId, commands, reply in collect_replies():
+            if shipId not in routes:
+                continue
+            left = routes[shipId]
+            if reply[1] != "OK":
+                log.info(f"Ship {shipId} stopped after {total[shipId] - len(left) - len(commands) + reply[2]} of {total[shipId]} moves.")
+                del routes[shipId]
+            elif left:
+                send_next(shipId)
+            else:
+                del routes[shipId]
+    wait_replies()
+
+
+def plan_goto(shipId, x, y):
+    ship = ship_dict.get(shipId)
+    if not ship:
+        log.warning("Invalid ship ID.")
+        return None
+    commands = pathfinding.find_path(mapa, ship["target"], (x, y), fleet_cells(shipId))
+    if commands is None:
+        log.info(f"No route for ship {shipId} to ({x},{y}).")
+        return None
+    log.info(f"Route of ship {shipId} to ({x},{y}): {len(commands)} moves")
+    return commands
+
+def plan_nearest(shipId, kind, claimed=()):
+    #claimed: targets already given to other ships
+    ship = ship_dict.get(shipId)
+    if not ship:
+        log.warning("Invalid ship ID.")
+        return None
+    if kind not in pathfinding.TARGETS:
+        log.warning("Invalid command.")
+        return None
+    found = pathfinding.nearest(mapa, ship["target"], kind, fleet_cells(shipId, claimed))
+    if found is None:
+        log.info(f"No {kind} reachable for ship {shipId}.")
+        return None
+    target, commands = found
+    log.info(f"Nearest {kind} of ship {shipId}: {target}, {len(commands)} moves")
+    return commands
+
+def goto(shipId, x, y):
+    commands = plan_goto(shipId, x, y)
+    if commands is not None:
+        follow_routes({shipId: commands})
+
+def go_nearest(shipIds, kind):
+    #one ship or the whole fleet ("all") to its nearest port / island
+    routes = {}
+    claimed = set()     #two ships never go to the same cell
+    for shipId in shipIds:
+        commands = plan_nearest(shipId, kind, claimed)
+        if commands is not None:
+            routes[shipId] = commands
+            claimed.add(pathfinding.walk(ship_dict[shipId]["target"], commands))
+    follow_routes(routes)
 
 
 def print_status():
+    lines = []
     for shipId, ship in ship_dict.items():
           if ship["pos"]:
             status = "Alive"
           else:
             status = "Terminated"
 
-          print(f"Ship {shipId} {status} (PID: {ship['pid']}) At: {ship['pos']} "
-              f"Food: {ship['food']} Gold: {ship['gold']}", file=sys.stderr)
-          sys.stderr.flush()  # ensure output shows immediately
+          lines.append(f"Ship {shipId} {status} (PID: {ship['pid']}) At: {ship['pos']} "
+              f"Food: {ship['food']} Gold: {ship['gold']}\n")
+    if isinstance(mapa, TiledMap):
+        lines.append(f"Map tiles: {mapa.stats()}\n")
+    log.write("".join(lines))     #asked for, shown whatever the log level
+
+#SPATIAL QUERIES (spatial.py): what is around a cell, from the map's index, not a scan
+#near x y r: ships, ports and islands at most r cells away
+#box x0 y0 x1 y1: the same inside a box
+#closest x y k ship|port|island: the k nearest of one kind
+
+def near(x, y, r):
+    start = time.perf_counter()
+    found = {kind: mapa.within_radius(x, y, r, kind) for kind in spatial.KINDS}
+    show_cells(f"Within {r} of ({x},{y})", found, time.perf_counter() - start)
+
+def box(x0, y0, x1, y1):
+    start = time.perf_counter()
+    found = {kind: mapa.within_box(x0, y0, x1, y1, kind) for kind in spatial.KINDS}
+    show_cells(f"In ({x0},{y0})-({x1},{y1})", found, time.perf_counter() - start)
+
+def closest(x, y, k, kind):
+    if kind not in spatial.KINDS:
+        log.warning("Invalid command.")
+        return
+    start = time.perf_counter()
+    found = {kind: mapa.k_nearest(x, y, k, kind)}
+    show_cells(f"{k} nearest {kind}s to ({x},{y})", found, time.perf_counter() - start)
+
+def show_cells(title, found, elapsed):
+    #a ship cell shows the ids of the own ships there, or how many ships of other fleets (shared map)
+    own = {}
+    for shipId, ship in ship_dict.items():
+        if ship["pos"]:
+            own.setdefault(tuple(ship["pos"]), []).append(shipId)
+    index = mapa.spatial()
+    lines = [f"{title}, {elapsed * 1000:.3f} ms:\n"]
+    for kind, cells in found.items():
+        if kind == "ship":
+            shown = [f"({x},{y}) ship {','.join(own[(x, y)])}" if (x, y) in own else f"({x},{y}) {index.ships_at(x, y)} ship(s)"
+                     for x, y in cells]
+        else:
+            shown = [f"({x},{y})" for x, y in cells]
+        lines.append(f"  {kind}s: {len(cells)}{': ' if shown else ''}{', '.join(shown)}\n")
+    log.write("".join(lines))     #asked for, shown whatever the log level
+
+#SPAWN
+#--spawn exec (the original way): fork and exec a new python3 running ship5.py.
+#--spawn fork: fork only, the child runs ship5.main() with the modules already imported
+#and, for a map in memory, the map the captain already loaded (copy-on-write).
+#--hosts N: the fleet is spread over N ship hosts (ship5.py --host), each one runs its
+#share of the ships in one process, instead of a process per ship.
+#--random: the ships move on their own, one move every <speed> seconds (ships.txt).
+def ship_arguments(ships, args):
+    #ships: [(shipId, x, y, speed)], more than one (or --hosts) makes it a ship host
+    if args.hosts or len(ships) > 1:
+        placement = ["--host"]
+        for shipId, x, y, speed in ships:
+            placement += ["--ship", str(shipId), str(x), str(y), str(speed)]
+        mode = ["--random", str(args.steps), "1"] if args.random else ["--captain"]
+    else:
+        shipId, x, y, speed = ships[0]
+        placement = ["--id", str(shipId), "--pos", str(x), str(y)]
+        mode = ["--random", str(args.steps), str(speed)] if args.random else ["--captain"]
+    return placement + mode + [
+        "--map", args.map,
+        "--wire", args.wire,
+        "--tile-budget", str(args.tile_budget),
+    ] + (["--shm", mapa.name] if mapa.shared else []) + [
+    ] + (["--ursula", args.ursula] if args.ursula else []) + (["--seed", args.seed] if args.seed else []) + log.arguments(args)
+
+def spawn_ship(shipId, x, y, args, speed=1):
+    return spawn([(shipId, x, y, speed)], args)
+
+def spawn(ships, args):
+    #starts one ship process (a ship or a ship host) with its two pipes and returns its pid
+    r_pipe, w_pipe = os.pipe()    #pipe to receive answers from ship
+    cmd_r, cmd_w = os.pipe()      #pipe to send commands to ship
+    sys.stdout.flush()            #or the child would print the captain's buffered output again
+    try:         
+        child = os.fork()
+    except OSError as e:
+            log.error(f"Error happened: {e}")
+            sys.exit(1)
+
+    if child == 0:  #child process. En pipes, el hijo escribe y el padre lee
+        try:
+            #PIPES: 
+            os.dup2(cmd_r, 0)   #reads orders from captain. 0 bc the stdin.
+            os.dup2(w_pipe, 1)  #sends answers to captain. 1 is bc of the stdout.
+            #if not using --> os.close()
+            os.close(cmd_w)   #uses cmd_r
+            os.close(r_pipe)  #uses r_pipe
+
+            if args.spawn == "fork":
+                run_forked_ship(ship_arguments(ships, args))
+            #execvp here bc if not, the process will be replaced
+            cmd = ["python3", "-u", os.path.join(os.path.dirname(__file__), "ship5.py")] + ship_arguments(ships, args)
+            os.execvp("python3", cmd)    #child executes ship.py, execvp replaces the process
+        except OSError as e:
+            log.error(f"Error happened: {e}")
+            log.flush()     #os._exit skips atexit
+            os._exit(1)
+    #parent process
+    try:
+        #PIPES
+        #parent doesnt use os.dup2, only closes
+        os.close(cmd_r)
+        os.close(w_pipe)
+
+        channel = add_channel(child, cmd_w, r_pipe)
+        for shipId, x, y, speed in ships:
+            add_ship(shipId, int(x), int(y), channel, args.random)
+    except OSError as e:
+            log.error(f"Error happened: {e}")
+            sys.exit(1)
+    return child
+
+def run_forked_ship(argv):
+    #child of --spawn fork: becomes the ship without exec. Never returns
+    signal.signal(signal.SIGINT, signal.default_int_handler)   #the captain's handlers are not the ship's
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    for channel in {id(ship["channel"]): ship["channel"] for ship in ship_dict.values()}.values():
+        #pipes of the other ships, or they would never see EOF
+        if channel["closed"]:
+            continue
+        for fd in (channel["w_pipe"], channel["r_pipe"]):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+    selector.close()
+    if hasattr(mapa, "close"):
+        atexit.unregister(mapa.close)   #the captain's atexit, the ship registers its own
+    transport.after_fork()              #the ship opens its own connection to Ursula
+    random.seed()                       #every ship its own random moves
+    sys.stdin = open(0, "r", closefd=False)
+    sys.stdout = open(1, "w", buffering=1, closefd=False)
+    #a map in memory is shared copy-on-write. The shared memory mapping stays shared after
+    #fork, the ship uses it as it is (attaching again would go through the captain's
+    #resource tracker). A tiled map is opened again, read-only
+    child_map = None
+    if mapa.shared:
+        mapa.owner = False      #the captain's resource tracker is not the ship's
+        mapa.attach()           #one more user, the ship's close() lets it go
+        child_map = mapa
+    elif type(mapa) is Map:
+        child_map = mapa
+    ship5.main(argv, child_map)
+    sys.exit(0)
 
 def main():
     args = arguments()  #parse arguments and prepare data
     global ursula_pipe
     ursula_pipe = args.ursula
+    transport.wire = args.wire
+    log.configure(args)
     global mapa
-    mapa = Map(args.map)    #to access to map (to know if collision with rocks)
+    if args.no_shared_map or args.map.endswith(TILE_SUFFIX):
+        #a .tiles map is loaded lazily, tile by tile (tiled_map.py)
+        mapa = open_map(args.map, args.tile_budget * 2**20, writable=True)    #to access to map (to know if collision with rocks)
+        if isinstance(mapa, TiledMap):
+            atexit.register(mapa.close)
+    else:
+        #terrain + ships of every fleet in shared memory, the ships attach to it by name
+        mapa = SharedMap.open(args.map)
+        atexit.register(mapa.close)
     
 
     signal.signal(signal.SIGINT, handler_sigint)
     signal.signal(signal.SIGCHLD, handler_sigchld)
 
-    print(f"Captain: {args.name} PID {os.getpid()}", file=sys.stderr)   #file=sys.stderr is to handle errors
+    log.info(f"Captain: {args.name} PID {os.getpid()}")
 
     if ursula_pipe:
-        send_to_ursula(f"{os.getpid()},INIT_CAPT", ursula_pipe)
+        send_to_ursula(ursula_pipe, protocol.INIT_CAPT, os.getpid())
 
     fileShips = read_ship_info(args.ships)  #get data from ships.txt
     children = []
 
-    for shipId, x, y, speed in fileShips:    
-        r_pipe, w_pipe = os.pipe()    #pipe to receive answers from ship
-        cmd_r, cmd_w = os.pipe()      #pipe to send commands to ship
-        try:         
-            child = os.fork()
-            #ships.append(shipId)   #for every shipID that is in the file, you add it to the list ship that you will use in the handlers
-        except OSError as e:
-                print(f"Error happened: {e}", file=sys.stderr)
-                sys.exit(1)
-
-        if child == 0:  #child process. En pipes, el hijo escribe y el padre lee
-            try:
-                #PIPES: 
-                os.dup2(cmd_r, 0)   #reads orders from captain. 0 bc the stdin.
-                os.dup2(w_pipe, 1)  #sends answers to captain. 1 is bc of the stdout.
-                #if not using --> os.close()
-                os.close(cmd_w)   #uses cmd_r
-                os.close(r_pipe)  #uses r_pipe
-
-                #execvp here bc if not, the process will be replaced
-                cmd = [
-                    "python3", "-u",
-                    os.path.join(os.path.dirname(__file__), "ship5.py"),
-                    "--id", str(shipId),
-                    "--map", args.map,
-                    "--pos", str(x), str(y),
-                    "--captain",
-                ] + (["--ursula", args.ursula] if args.ursula else [])
-                
-                os.execvp("python3", cmd)    #child executes ship.py, execvp replaces the process
-            except OSError as e:
-                print(f"Error happened: {e}", file=sys.stderr)
-                sys.stderr.flush()
-                sys.exit(1)
-        else:  #parent process
-            try:
-                #print(f"Ship PID: {child}", file=sys.stderr)
-                children.append((shipId, child))
-
-                #PIPES
-                #parent doesnt use os.dup2, only closes
-                os.close(cmd_r)
-                os.close(w_pipe)
-
-                ship_dict[shipId] = {
-                    "pid": child,
-                    "pos": (int(x), int(y)),
-                    "food": 100,
-                    "gold": 0,
-                    "w_pipe": cmd_w,
-                    "r_pipe": r_pipe
-                }
-            except OSError as e:
-                    print(f"Error happened: {e}", file=sys.stderr)
-                    sys.exit(1)
+    if args.hosts:
+        #round-robin, every host gets about the same number of ships
+        groups = [fileShips[i::args.hosts] for i in range(args.hosts)]
+    else:
+        groups = [[ship] for ship in fileShips]
+    for ships in groups:
+        if ships:
+            child = spawn(ships, args)
+            children.append((" ".join(ship[0] for ship in ships), child))
     
     #SEND COMMANDS
-    while ship_dict:   #while there are ships in the dictionary
+    reap_ships()
+    while alive_ships:   #while there are ships sailing
         try:
-            print("Enter command [exit | status | (Num, up/down/right/left/exit]:")
+            log.flush()     #the answers to the last command before the prompt
+            print("Enter command [exit | status | (Num, up/down/right/left/exit ...) | (Num, supply/damage/status/quit) | (Num, goto x y) | (Num/all, nearest island/port) | (all, up/down/right/left/exit) | near x y r | box x0 y0 x1 y1 | closest x y k ship/port/island]:")
             #sys.stderr.flush()
-            command = sys.stdin.readline().strip()
+            command = sys.stdin.readline()
+            reap_ships()    #the ships that died while we waited for the command
+            if not command:     #end of the input, same as exit
+                command = "exit"
+            command = command.strip()
+            if not command:
+                continue
            # input("> ").strip()   #lee desde lo q se escribe en la terminal hasta el enter del usuario (up, down, lo q sea)
             # o command = input().strip()
             if command == "exit":
-                print("Exiting and terminating all ships.", file=sys.stderr)
-                sys.stderr.flush()
+                log.info("Exiting and terminating all ships.")
                 handler_sigint(signal.SIGINT, None)   #se va a sigint pq está el os.kill y manda el sigQuit
             elif command == "status":
                 print_status()
-                sys.stderr.flush()
             else:
                 #user enters [number, command] --> [1, up] --> ship 1 goes y += 1
                 entered = command.split()   #divides btw shipId and cmd
-                shipId, cmd = entered   #[1, up]
-                send_command(shipId, cmd)
-                sys.stderr.flush()
+                if entered[0] in ("near", "box", "closest"):    #[near, 3, 4, 5] spatial queries
+                    try:
+                        if entered[0] == "near" and len(entered) == 4:
+                            near(*[int(value) for value in entered[1:]])
+                        elif entered[0] == "box" and len(entered) == 5:
+                            box(*[int(value) for value in entered[1:]])
+                        elif entered[0] == "closest" and len(entered) == 5:
+                            closest(*[int(value) for value in entered[1:4]], entered[4])
+                        else:
+                            log.warning("Invalid command.")
+                    except ValueError:
+                        log.warning("Invalid position.")
+                elif len(entered) == 4 and entered[1] == "goto":     #[1, goto, 3, 4]
+                    try:
+                        goto(entered[0], int(entered[2]), int(entered[3]))
+                    except ValueError:
+                        log.warning("Invalid position.")
+                elif len(entered) == 3 and entered[1] == "nearest":  #[1, nearest, port]
+                    go_nearest(list(ship_dict) if entered[0] == "all" else [entered[0]], entered[2])
+                elif len(entered) == 2 and entered[0] == "all":     #[all, up] every ship at once
+                    broadcast(entered[1])
+                elif len(entered) >= 2:
+                    shipId, *cmds = entered   #[1, up] or a batch [1, up, up, right]
+                    send_command(shipId, *cmds)
+                else:
+                    log.warning("Invalid command.")
 
-            alive = 0   
             #no vale len(ships) pq cuenta todos los barcos que han existido, vivos o muertos.
-            for ship in ship_dict.values(): #searches for every ship in the dictionary that has a pos
-                if ship.get("pos") is not None: #if that ship has a position (is alive)
-                    alive += 1
-            print(f"Number of ships alive: {alive}\n", file=sys.stderr)
-            sys.stderr.flush()
+            #alive_ships is updated when a ship exits or is reaped, no need to count them
+            reap_ships()
+            log.info(f"Number of ships alive: {alive_ships}\n")
         except OSError as e:
-            print(f"Error happened: {e}", file=sys.stderr)
+            log.error(f"Error happened: {e}")
             sys.exit(1)
         
     for shipId, child in children:              #wait for each child in stored list
-            waited_pid, status = os.waitpid(child, 0)
+            try:
+                waited_pid, status = os.waitpid(child, 0)
+            except ChildProcessError:   #already reaped when it answered exit
+                continue
             exit_status = os.WEXITSTATUS(status)
-            print(f"Ship {shipId}, with pid {waited_pid} finished with status {exit_status}", file=sys.stderr)
-            sys.stderr.flush()
+            log.info(f"Ship {shipId}, with pid {waited_pid} finished with status {exit_status}")
+
+    #every ship ended by itself (--random), Ursula waits for this to finish
+    if ursula_pipe:
+        send_to_ursula(ursula_pipe, protocol.END_CAPT, os.getpid())
+        log.info("Captain: Sent termination to Ursula")
 
     
 if __name__ == "__main__":
@@ -0,0 +1,279 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Append-only journal of Ursula, to survive a crash (ursula.py --journal <path>).
+#
+# Every message that changes Ursula's state (INIT_CAPT, END_CAPT, INIT, MOVE,
+# TERMINATE) is appended as it was received, in a protocol.RECORD, and so is the
+# outcome of every fight (winner and losers), so the random choice of the winner
+# is not needed again. Events are buffered and written with one write and one
+# fsync per wakeup of Ursula's loop (group commit), not one per message.
+#
+#   journal   HEADER (magic, version, generation), then events
+#   event     EVENT (kind, payload length, crc32 of the payload) + payload
+#               MESSAGE  protocol.RECORD
+#               FIGHT    winner pid, loser pids (q each)
+#               TICK     fights of the tick, gold they need (TICK_PAYOUT), before those
+#                        fights (ursula.py --tick): they are paid at once, all or nothing
+#
+# Every snapshot_every events the whole state goes to <path>.snap (written to a
+# temporary file, fsync, rename) with the next generation, and the journal is
+# emptied and started again with that generation. A journal older than the
+# snapshot (the crash came between the rename and the truncation) is ignored,
+# so an event is never applied twice and the journal never grows past one
+# snapshot period.
+#
+#   snapshot  SNAP_HEADER (magic, version, generation, treasure, captains, ships)
+#             CAPTAIN per captain, SHIP per ship (in order of arrival), crc32 of it all
+#
+# Recovery reads the snapshot and then the journal until its end or the first
+# torn or corrupt event (a crash in the middle of a write), where the journal is
+# cut before appending again. The journal is read in chunks (EventReader).
+#
+# With keep=True (ursula.py --keep-journal) a journal is not emptied after the
+# snapshot but archived as <path>.<generation>, so the whole game stays on disk
+# for analytics.py.
+
+import os
+import zlib
+import struct
+import protocol
+
+MAGIC = b"URSJ"
+SNAP_MAGIC = b"URSS"
+VERSION = 2     #2: payload length of 4 bytes (a FIGHT of any number of ships) and TICK
+HEADER = struct.Struct("<4sBq")
+EVENT = struct.Struct("<BII")
+SNAP_HEADER = struct.Struct("<4sBqqII")
+CAPTAIN = struct.Struct("<qB")
+SHIP = struct.Struct("<qiiii")
+PID = struct.Struct("<q")
+TICK_PAYOUT = struct.Struct("<Iq")
+CRC = struct.Struct("<I")
+
+MESSAGE, FIGHT, TICK = 1, 2, 3
+SNAPSHOT_EVERY = 100000     #events between two snapshots
+MAX_BUFFERED = 1024 * 1024  #bytes of events before they are written, even in the middle of a wakeup
+CHUNK_SIZE = 16 * 1024 * 1024   #bytes read at a time
+
+
+class Journal:
+    def __init__(self, path, snapshot_every=SNAPSHOT_EVERY, keep=False):
+        self.path = path
+        self.keep = keep    #old generations are archived instead of emptied
+        self.snapshot_path = path + ".snap"
+        self.snapshot_every = snapshot_every
+        self.generation = 0
+        self.fd = None
+        self.buffer = bytearray()
+        self.events = 0     #since the last snapshot
+        self.fsyncs = 0
+
+    # Recovery
+
+    def load_snapshot(self):
+        #the state in the snapshot, None without one:
+        #{"generation", "treasure", "captains": [(pid, alive)], "ships": [(pid, x, y, food, gold)]}
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        body, (crc,) = data[:-CRC.size], CRC.unpack_from(data, len(data) - CRC.size)
+        magic, version, generation, treasure, n_captains, n_ships = SNAP_HEADER.unpack_from(body)
+        if magic == SNAP_MAGIC and version != VERSION:
+            raise ValueError(f"snapshot '{self.snapshot_path}' is version {version}, not {VERSION}")
+        if magic != SNAP_MAGIC or zlib.crc32(body) != crc:
+            raise ValueError(f"corrupt snapshot '{self.snapshot_path}'")
+        offset = SNAP_HEADER.size
+        captains = [(pid, bool(alive)) for pid, alive in CAPTAIN.iter_unpack(body[offset:offset + n_captains * CAPTAIN.size])]
+        offset += n_captains * CAPTAIN.size
+        ships = list(SHIP.iter_unpack(body[offset:offset + n_ships * SHIP.size]))
+        self.generation = generation
+        return {"generation": generation, "treasure": treasure, "captains": captains, "ships": ships}
+
+    def replay(self):
+        #the events of the journal after the snapshot: (MESSAGE, message fields as in
+        #protocol.decode), (FIGHT, (winner, [losers])) or (TICK, (fights, needed)). Leaves the journal open to append,
+        #cut after the last whole event. Call load_snapshot() first
+        reader = EventReader(self.path)
+        end = 0
+        if reader.generation == self.generation:
+            for event in reader:
+                self.events += 1
+                yield event
+            end = reader.end
+        elif reader.generation is not None and self.keep:
+            self.archive(reader.generation)     #the crash came before it was archived
+        self.open(end)
+
+    def archive(self, generation):
+        #keeps the events of a generation as <path>.<generation> (--keep-journal)
+        os.replace(self.path, segment_path(self.path, generation))
+
+    def open(self, end=0):
+        #opens the journal to append after end, a new one (just the header) when end is 0
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if not end:
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, HEADER.pack(MAGIC, VERSION, self.generation))
+            end = HEADER.size
+        else:
+            os.ftruncate(self.fd, end)
+        os.lseek(self.fd, end, os.SEEK_SET)
+        os.fsync(self.fd)
+
+    # Appending
+
+    def message(self, msg_type, arg, pid, x, y, food, gold):
+        self._append(MESSAGE, protocol.RECORD.pack(protocol.MAGIC, protocol.VERSION, msg_type, arg, pid, x, y, food, gold))
+
+    def fight(self, winner, losers):
+        self._append(FIGHT, struct.pack(f"<{1 + len(losers)}q", winner, *losers))
+
+    def tick(self, fights, needed):
+        #the next fights FIGHT events are one payout of needed gold
+        self._append(TICK, TICK_PAYOUT.pack(fights, needed))
+
+    def _append(self, kind, payload):
+        self.buffer += EVENT.pack(kind, len(payload), zlib.crc32(payload))
+        self.buffer += payload
+        self.events += 1
+        if len(self.buffer) >= MAX_BUFFERED:
+            self.commit()
+
+    def commit(self):
+        #group commit: everything appended since the last one, one write and one fsync.
+        #Returns the bytes written
+        if not self.buffer:
+            return 0
+        view = memoryview(self.buffer)
+        written = 0
+        while written < len(view):
+            written += os.write(self.fd, view[written:])
+        view.release()
+        os.fdatasync(self.fd)
+        self.fsyncs += 1
+        self.buffer.clear()
+        return written
+
+    def size(self):
+        return os.lseek(self.fd, 0, os.SEEK_CUR) + len(self.buffer)
+
+    def snapshot_due(self):
+        return self.events >= self.snapshot_every
+
+    # Snapshots
+
+    def snapshot(self, treasure, captains, ships):
+        #captains: [(pid, alive)], ships: [(pid, x, y, food, gold)]. Writes the snapshot of the
+        #next generation and starts the journal again, empty
+        self.commit()
+        generation = self.generation + 1
+        body = bytearray(SNAP_HEADER.pack(SNAP_MAGIC, VERSION, generation, treasure, len(captains), len(ships)))
+        for pid, alive in captains:
+            body += CAPTAIN.pack(pid, alive)
+        for ship in ships:
+            body += SHIP.pack(*ship)
+        body += CRC.pack(zlib.crc32(body))
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.snapshot_path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)     #the rename itself is durable
+        finally:
+            os.close(directory)
+        # from here the old journal is ignored, it can be emptied (or archived)
+        os.close(self.fd)
+        if self.keep:
+            self.archive(self.generation)
+        self.generation = generation
+        self.open()
+        self.events = 0
+        return len(body)
+
+    def close(self):
+        if self.fd is not None:
+            self.commit()
+            os.close(self.fd)
+            self.fd = None
+
+
+class EventReader:
+    #the events of a journal file, read chunk_size bytes at a time, so a journal of any
+    #size is read in bounded memory. After the iteration: generation of the file (None if
+    #it is not a journal), end (offset after the last whole event) and torn (bytes after it)
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.generation = None
+        self.end = 0
+        self.torn = 0
+        try:
+            with open(path, "rb") as f:
+                header = f.read(HEADER.size)
+        except FileNotFoundError:
+            return
+        if len(header) == HEADER.size:
+            magic, version, generation = HEADER.unpack(header)
+            if magic == MAGIC and version != VERSION:
+                #not emptied as if it were not a journal, its events would be lost
+                raise ValueError(f"journal '{path}' is version {version}, not {VERSION}")
+            if magic == MAGIC:
+                self.generation = generation
+                self.end = HEADER.size
+
+    def __iter__(self):
+        if self.generation is None:
+            return
+        record, event, crc32 = protocol.RECORD.unpack_from, EVENT.unpack_from, zlib.crc32
+        with open(self.path, "rb") as f:
+            f.seek(self.end)
+            data = b""
+            pos = 0
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                data = data[pos:] + chunk   #an event cut by the chunk goes on in the next one
+                pos = 0
+                while pos + EVENT.size <= len(data):
+                    kind, length, crc = event(data, pos)
+                    start = pos + EVENT.size
+                    if start + length > len(data):
+                        break   #the rest is in the next chunk
+                    payload = data[start:start + length]
+                    if crc32(payload) != crc:
+                        self.torn = os.fstat(f.fileno()).st_size - self.end
+                        return  #corrupt, the crash came here
+                    if kind == MESSAGE:
+                        yield MESSAGE, record(payload)[2:]
+                    elif kind == FIGHT:
+                        pids = struct.unpack(f"<{length // PID.size}q", payload)
+                        yield FIGHT, (pids[0], list(pids[1:]))
+                    elif kind == TICK:
+                        yield TICK, TICK_PAYOUT.unpack(payload)
+                    else:
+                        self.torn = os.fstat(f.fileno()).st_size - self.end
+                        return
+                    pos = start + length
+                    self.end += EVENT.size + length
+            self.torn = len(data) - pos     #torn, half an event at the end
+
+
+def segment_path(path, generation):
+    return f"{path}.{generation}"
+
+
+def segments(path):
+    #every journal file of a game in order: the archived generations (--keep-journal)
+    #and the current one
+    directory = os.path.dirname(path) or "."
+    prefix = os.path.basename(path) + "."
+    archived = sorted(int(name[len(prefix):]) for name in os.listdir(directory)
+                      if name.startswith(prefix) and name[len(prefix):].isdigit())
+    return [segment_path(path, generation) for generation in archived] + ([path] if os.path.exists(path) else [])
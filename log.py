@@ -0,0 +1,192 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Logging of the captain, the ships and Ursula, on stderr (the stdout of a ship
+# is its pipe to the captain).
+#
+# The old code did print(..., file=sys.stderr) and sys.stderr.flush() for every
+# line: one write system call per line, and Ursula wrote every ship after every
+# MOVE. Here a line is only appended to a queue. A writer thread takes everything
+# queued every INTERVAL seconds and writes it at once. Lines below the level
+# (--log-level, --quiet) are dropped, and a category of lines that repeats a lot
+# (moves, fights...) has a rate limit of --log-rate lines per second, the rest
+# are counted and the count is written with the next line that gets through.
+# If the writer falls behind, more than MAX_QUEUED lines waiting, new lines are
+# dropped and counted too.
+#
+# Signal handlers may log: a call only appends to the queue, it never waits for
+# the writer. Before a fork the writer thread is stopped and the queue written,
+# so the child does not write the parent's lines again and only the thread that
+# forks is copied. The next line starts the thread again, in the parent and in
+# the child. At exit everything still queued is written.
+#
+#   import log
+#   log.add_arguments(ap)
+#   log.configure(ap.parse_args())
+#   log.info(f"Ship {pid} moved to ({x},{y})", "move")
+#   log.write(status)      #always written, whatever the level
+
+import os
+import sys
+import time
+import atexit
+import threading
+from collections import deque
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+INTERVAL = 0.05         #seconds between two writes of the writer thread
+MAX_QUEUED = 100000     #lines waiting, the next ones are dropped
+RATE = 1000             #lines per second of every category, 0 = no limit
+
+
+class Logger:
+    def __init__(self, level=INFO, rate=RATE, interval=INTERVAL):
+        self.level = level
+        self.rate = rate
+        self.interval = interval
+        self.limits = {}        #category -> [tokens, last time, suppressed lines]
+        self.dropped = 0
+        self.closed = False     #after exit lines are written right away
+        self._reset()
+
+    def _reset(self):
+        #also in the child after a fork: nothing of the parent is running here
+        self.queue = deque()
+        self.lock = threading.RLock()   #a signal handler may flush inside a flush
+        self.wake = threading.Event()
+        self.thread = None
+        self.stopping = False
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, message, category=None):
+        if level < self.level:
+            return
+        if category is not None and self.rate and not self._allow(category):
+            return
+        self._put(message + "\n")
+
+    def debug(self, message, category=None):
+        self.log(DEBUG, message, category)
+
+    def info(self, message, category=None):
+        self.log(INFO, message, category)
+
+    def warning(self, message, category=None):
+        self.log(WARNING, message, category)
+
+    def error(self, message, category=None):
+        self.log(ERROR, message, category)
+
+    def write(self, text):
+        #text as it is (many lines at once), whatever the level and the rate limits
+        self._put(text)
+
+    def _allow(self, category):
+        #token bucket: rate lines per second, bursts of up to one second of lines
+        now = time.monotonic()
+        limit = self.limits.get(category)
+        if limit is None:
+            limit = self.limits[category] = [self.rate, now, 0]
+        tokens = min(self.rate, limit[0] + (now - limit[1]) * self.rate)
+        limit[1] = now
+        if tokens < 1:
+            limit[0] = tokens
+            limit[2] += 1
+            return False
+        limit[0] = tokens - 1
+        if limit[2]:
+            self._put(f"({limit[2]} {category} lines suppressed)\n")
+            limit[2] = 0
+        return True
+
+    def _put(self, line):
+        if len(self.queue) >= MAX_QUEUED:
+            self.dropped += 1
+            return
+        self.queue.append(line)
+        if self.closed:
+            self.flush()
+        elif self.thread is None:
+            self._start()
+
+    def _start(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="log writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.flush()
+
+    def flush(self):
+        #writes everything queued, in one write
+        with self.lock:
+            lines = []
+            queue = self.queue
+            while queue:
+                lines.append(queue.popleft())
+            if self.dropped:
+                lines.append(f"({self.dropped} log lines dropped, the writer fell behind)\n")
+                self.dropped = 0
+            if not lines:
+                return
+            try:
+                sys.stderr.write("".join(lines))
+                sys.stderr.flush()
+            except (OSError, ValueError):   #stderr closed
+                pass
+
+    def stop(self):
+        #stops the writer thread and writes what is left
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            self.stopping = True
+            self.wake.set()
+            thread.join()
+            self.wake.clear()
+        self.thread = None
+        self.flush()
+
+    def close(self):
+        #at exit: the suppressed counts, and from now on no thread
+        for category, limit in self.limits.items():
+            if limit[2]:
+                self._put(f"({limit[2]} {category} lines suppressed)\n")
+                limit[2] = 0
+        self.closed = True
+        self.stop()
+
+
+logger = Logger()
+
+enabled = logger.enabled
+debug = logger.debug
+info = logger.info
+warning = logger.warning
+error = logger.error
+write = logger.write
+flush = logger.flush
+
+atexit.register(logger.close)
+os.register_at_fork(before=logger.stop, after_in_child=logger._reset)
+
+
+def add_arguments(ap):
+    ap.add_argument("--log-level", choices=LEVELS, default="info", help="lowest level of the lines written to stderr")
+    ap.add_argument("--quiet", action="store_true", help="same as --log-level warning")
+    ap.add_argument("--log-rate", type=int, default=RATE, help="lines per second of every kind of repeated line, 0 = no limit")
+
+
+def configure(args):
+    logger.level = WARNING if args.quiet else LEVELS[args.log_level]
+    logger.rate = args.log_rate
+
+
+def arguments(args):
+    #the same options for a child process (captain -> ships)
+    return ["--log-level", args.log_level, "--log-rate", str(args.log_rate)] + (["--quiet"] if args.quiet else [])
@@ -12,56 +12,227 @@
 # (x,y) = (0,0) is the top-left corner of the map
 # (x,y) = (width-1,height-1) is the bottom-right corner of the map
 
-  
+# The grid is kept in one flat bytearray, one byte per cell, cell (x,y) is at y * width + x.
+# A list of lists of 1-char strings needs ~70 bytes per cell, this needs 1.
+
+# Compiled map cache: the first time a map file is loaded it is also written next to it
+# as <file>.mapc, a small header (magic, version, width, height, size/mtime and sha256 of
+# the source) followed by the raw cell bytes. Later loads mmap the cells straight from it
+# (copy-on-write, set_ship never changes the file), so loading costs the same for any map
+# size. The cache is rebuilt when the source changes.
+# To build it by hand: python3 map.py map.txt
+
+# Ships, ports and islands near a cell: within_radius, within_box and k_nearest, answered
+# by a spatial index of buckets (spatial.py) built the first time one of them is used
+# and kept up to date by set_ship / remove_ship.
+
+import os
+import sys
+import mmap
+import struct
+import hashlib
+
+from spatial import SpatialIndex
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CACHE_SUFFIX = ".mapc"
+CACHE_MAGIC = b"SEAM"
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct("<4sHHIIQQ32s")   #magic, version, 0, width, height, source size, mtime_ns, sha256
+CACHE_DATA_OFFSET = 4096                        #cells start page aligned, so they can be mmapped alone
+
+
+def parse_map(text):
+    #text of a map file -> (cells, height, width)
+    rows = [line.strip() for line in text.splitlines() if line.strip()]
+    if rows:
+        height = len(rows)
+        width = len(rows[0])
+        for row in rows:
+            if len(row) != width:
+                raise ValueError("All rows in the map must have the same length")
+        return bytearray(b''.join(rows)), height, width
+    return bytearray(), 0, 0
+
+
+def cache_path(filename):
+    return filename + CACHE_SUFFIX
+
+
+def cache_header(width, height, st, digest):
+    return CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, 0, width, height, st.st_size, st.st_mtime_ns, digest)
+
+
+def compile_map(filename):
+    #parses the map file, writes its cache and returns (cells, height, width)
+    with open(filename, 'rb') as f:
+        text = f.read()
+    st = os.stat(filename)
+    cells, height, width = parse_map(text)
+    header = cache_header(width, height, st, hashlib.sha256(text).digest())
+    tmp = f"{cache_path(filename)}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(header.ljust(CACHE_DATA_OFFSET, b'\0'))
+        f.write(cells)
+    os.replace(tmp, cache_path(filename))   #atomic, ships loading at the same time never see half a file
+    return cells, height, width
+
+
+def load_compiled(filename):
+    #(cells, height, width) from the cache, None if there is none or it is stale
+    try:
+        f = open(cache_path(filename), 'rb')
+    except OSError:
+        return None
+    with f:
+        header = f.read(CACHE_HEADER.size)
+        if len(header) != CACHE_HEADER.size:
+            return None
+        magic, version, _, width, height, size, mtime_ns, digest = CACHE_HEADER.unpack(header)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            return None
+        st = os.stat(filename)
+        if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+            # Touched, only hash the source when it may have changed
+            with open(filename, 'rb') as src:
+                if hashlib.sha256(src.read()).digest() != digest:
+                    return None
+            # Same content: the new size/mtime go in the header, the next loads skip the hash
+            try:
+                with open(cache_path(filename), 'r+b') as cache:
+                    cache.write(cache_header(width, height, st, digest))
+            except OSError:     #e.g. read-only directory, the hash is checked every time
+                pass
+        if width * height == 0:
+            return bytearray(), 0, 0
+        if os.fstat(f.fileno()).st_size < CACHE_DATA_OFFSET + width * height:
+            return None
+        if CACHE_DATA_OFFSET % mmap.ALLOCATIONGRANULARITY == 0:
+            cells = mmap.mmap(f.fileno(), width * height, access=mmap.ACCESS_COPY, offset=CACHE_DATA_OFFSET)
+        else:
+            f.seek(CACHE_DATA_OFFSET)
+            cells = bytearray(f.read(width * height))
+        return cells, height, width
+
+
+def find_all(buffer, value):
+    #indexes of every byte equal to value, the scanning is done by bytes.find
+    if not hasattr(buffer, "find"):
+        buffer = bytes(buffer)
+    value = bytes((value,))
+    found = []
+    i = buffer.find(value)
+    while i >= 0:
+        found.append(i)
+        i = buffer.find(value, i + 1)
+    return found
+
 
 class Map:
     WATER, ROCK, PORT, ISLAND, SHIP, HOME, BAR = '.', '#', 'P', 'I', 'S', 'H', 'B'
-    def __init__(self, filename):
+    shared = False      #True for SharedMap, every fleet sees the ships of this map
+    terrain_revision = 0    #changes every time set_terrain changes the map, for caches (pathfinding.py)
+    index = None            #SpatialIndex, once a spatial query has been made
+    ROCK_BYTE = ord(ROCK)
+    # Cell changes when a ship arrives (set_ship) and leaves (remove_ship), as bytes
+    ARRIVE = {ord(WATER): ord(SHIP), ord(PORT): ord(HOME), ord(ISLAND): ord(BAR)}
+    LEAVE = {ord(SHIP): ord(WATER), ord(HOME): ord(PORT), ord(BAR): ord(ISLAND)}
+
+    def __init__(self, filename, use_cache=True):
         self.filename = filename
-        self.map, self.height, self.width = self.load_map()
+        self.use_cache = use_cache
+        self.cells, self.height, self.width = self.load_map()
 
     def load_map(self):
-        with open(self.filename, 'r') as f:
-           map = [list(line.strip()) for line in f if line.strip()]
-           if map:
-               height = len(map)
-               width = len(map[0])
-               for row in map:
-                   if len(row) != width:
-                       raise ValueError("All rows in the map must have the same length")
-               return map, height, width
-        return [], 0, 0
-
-    def can_sail(self, x, y):       
+        if self.use_cache:
+            loaded = load_compiled(self.filename)
+            if loaded is not None:
+                return loaded
+            try:
+                return compile_map(self.filename)
+            except OSError as e:    #e.g. read-only directory, parse the file as before
+                print(f"Map cache not written: {e}", file=sys.stderr)
+        with open(self.filename, 'rb') as f:
+            return parse_map(f.read())
+
+    def can_sail(self, x, y):
         if 0 <= x < self.width and 0 <= y < self.height:
-            return self.map[y][x] != Map.ROCK
+            return self.cells[y * self.width + x] != Map.ROCK_BYTE
         return False
 
     def get_cell_type(self, x, y):
         if 0 <= x < self.width and 0 <= y < self.height:
-            return self.map[y][x]
+            return chr(self.cells[y * self.width + x])
         return None
 
     def set_ship(self, x, y):
         if 0 <= x < self.width and 0 <= y < self.height:
-            if self.map[y][x] == Map.WATER:
-                self.map[y][x] = Map.SHIP
-            elif self.map[y][x] == Map.PORT:
-                self.map[y][x] = Map.HOME
-            elif self.map[y][x] == Map.ISLAND:
-                self.map[y][x] = Map.BAR
+            i = y * self.width + x
+            self.cells[i] = Map.ARRIVE.get(self.cells[i], self.cells[i])
+            if self.index is not None:
+                self.index.add_ship(x, y, 1)
             return True
         return None
 
     def remove_ship(self, x, y):
         if 0 <= x < self.width and 0 <= y < self.height:
-            if self.map[y][x] == Map.SHIP:
-                self.map[y][x] = Map.WATER
-            elif self.map[y][x] == Map.HOME:
-                self.map[y][x] = Map.PORT
-            elif self.map[y][x] == Map.BAR:
-                self.map[y][x] = Map.ISLAND
+            i = y * self.width + x
+            self.cells[i] = Map.LEAVE.get(self.cells[i], self.cells[i])
+            if self.index is not None:
+                self.index.add_ship(x, y, -1)
         return None
 
+    def set_terrain(self, x, y, cell_type):
+        #changes the terrain of a cell (e.g. a new rock), ships are not terrain
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.cells[y * self.width + x] = ord(cell_type)
+            self.terrain_revision += 1
+            return True
+        return None
+
+    def cells_of_type(self, cell_type):
+        #(x, y) of every cell of the given type, e.g. Map.PORT
+        width = self.width
+        return [(i % width, i // width) for i in find_all(self.cells, ord(cell_type))]
+
+    # Spatial queries (spatial.py): kind is "ship", "port" or "island", cells come as (x, y)
+
+    def spatial(self):
+        if self.index is None:
+            self.index = SpatialIndex(self)
+        return self.index
+
+    def within_radius(self, x, y, r, kind):
+        #cells of kind at most r cells (straight line) from (x, y), nearest first
+        return self.spatial().within_radius(x, y, r, kind)
+
+    def within_box(self, x0, y0, x1, y1, kind):
+        #cells of kind in the box, corners included
+        return self.spatial().within_box(x0, y0, x1, y1, kind)
+
+    def k_nearest(self, x, y, k, kind):
+        #the k cells of kind nearest to (x, y)
+        return self.spatial().k_nearest(x, y, k, kind)
+
+    def as_array(self):
+        #zero-copy NumPy view of the grid, shape (height, width), dtype uint8.
+        #writes through the view change the map
+        if np is None:
+            raise ImportError("Map.as_array() needs NumPy")
+        return np.frombuffer(self.cells, dtype=np.uint8).reshape(self.height, self.width)
+
     def __str__(self):
-        return '\n'.join(''.join(row) for row in self.map)
+        width = self.width
+        return '\n'.join(bytes(self.cells[y * width:(y + 1) * width]).decode() for y in range(self.height))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python3 map.py <map file>", file=sys.stderr)
+        sys.exit(1)
+    cells, height, width = compile_map(sys.argv[1])
+    print(f"Compiled {sys.argv[1]} ({width}x{height}) into {cache_path(sys.argv[1])}", file=sys.stderr)
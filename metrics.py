@@ -0,0 +1,129 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Counters, gauges and histograms for Ursula (and anyone else), rendered as
+# JSON or as Prometheus text.
+#
+# Counters only go up (messages handled, fights...), gauges are set to the
+# current value (treasure, ships, bytes waiting...) and histograms count
+# durations in buckets of powers of two from 1 us to 65 ms. A value has a name
+# and optionally one label, e.g. messages{type="MOVE"}.
+#
+#   m = Metrics("ursula")
+#   m.inc("messages", type="MOVE")
+#   m.set("treasure", 90)
+#   m.histogram("handle_seconds").observe(0.000012)
+#   print(m.render("prometheus"))
+
+import json
+from bisect import bisect_left
+
+FORMATS = ("json", "prometheus")
+BUCKETS = tuple(2 ** i / 1e6 for i in range(17))    #seconds, 1 us ... 65.536 ms
+
+
+class Histogram:
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   #the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        #(upper bound, observations <= bound), as Prometheus wants them
+        total = 0
+        for bound, n in zip(self.bounds + (float("inf"),), self.counts):
+            total += n
+            yield bound, total
+
+    def quantile(self, q):
+        #upper bound of the bucket of the q quantile, 0 when empty. Past the last bound
+        #it is the last bound (a lower bound then): +Inf is not valid JSON
+        if not self.count:
+            return 0.0
+        for bound, (_, total) in zip(self.bounds, self.cumulative()):
+            if total >= q * self.count:
+                return bound
+        return self.bounds[-1]
+
+
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.counters = {}      #(name, label) -> value, label is None or (key, value)
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        if len(labels) > 1:
+            raise ValueError("one label per value")
+        return name, next(iter(labels.items()), None)
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def snapshot(self):
+        #plain dict: {name: value} or {name: {label value: value}} for counters and gauges
+        def group(values):
+            out = {}
+            for (name, label), value in sorted(values.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+                if label is None:
+                    out[name] = value
+                else:
+                    out.setdefault(name, {})[label[1]] = value
+            return out
+        return {
+            "counters": group(self.counters),
+            "gauges": group(self.gauges),
+            "histograms": {
+                name: {
+                    "count": h.count,
+                    "sum": h.sum,
+                    "p50": h.quantile(0.5),
+                    "p99": h.quantile(0.99),
+                    "p999": h.quantile(0.999),
+                }
+                for name, h in self.histograms.items()
+            },
+        }
+
+    def to_prometheus(self):
+        lines = []
+        for kind, values, suffix in (("counter", self.counters, "_total"), ("gauge", self.gauges, "")):
+            typed = set()
+            for (name, label), value in sorted(values.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+                metric = f"{self.prefix}_{name}{suffix}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} {kind}")
+                    typed.add(metric)
+                labels = f'{{{label[0]}="{label[1]}"}}' if label else ""
+                lines.append(f"{metric}{labels} {value}")
+        for name, h in sorted(self.histograms.items()):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, total in h.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{metric}_bucket{{le="{le}"}} {total}')
+            lines.append(f"{metric}_sum {h.sum}")
+            lines.append(f"{metric}_count {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def render(self, fmt="json"):
+        if fmt == "prometheus":
+            return self.to_prometheus()
+        return json.dumps(self.snapshot()) + "\n"
@@ -0,0 +1,167 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Route planning on top of Map.can_sail.
+#
+# find_path() plans a route between two cells with A* (Manhattan heuristic),
+# avoiding rocks and, optionally, cells taken by the own fleet. The result is a
+# list of captain commands (up/down/left/right) ready to be sent to a ship.
+#
+# distance_field() is a breadth-first search started at the same time from every
+# PORT (or ISLAND) of the map. It gives, for every cell, the number of moves to
+# the closest one, so nearest() only walks down the field from the ship. Fields
+# are cached per map and recomputed when the terrain changes (Map.set_terrain).
+# A TiledMap is never in memory as a whole, so it gets no field: nearest() does a
+# breadth-first search from the ship, which stops at the closest target and only
+# reads the tiles around it.
+
+import heapq
+import weakref
+from array import array
+from collections import deque
+
+from map import Map
+from tiled_map import TiledMap
+
+# Same directions as the captain's commands (captain5.send_command)
+MOVES = {"up": (0, 1), "down": (0, -1), "right": (1, 0), "left": (-1, 0)}
+
+# A cell with a ship on it is still a port / an island
+TARGETS = {
+    "port": (Map.PORT, Map.HOME),
+    "island": (Map.ISLAND, Map.BAR),
+}
+
+UNREACHABLE = -1
+
+_fields = weakref.WeakKeyDictionary()    #map -> {kind: (terrain_revision, field)}
+
+
+def walk(start, commands):
+    #cell reached from start after the commands
+    x, y = start
+    for command in commands:
+        dx, dy = MOVES[command]
+        x, y = x + dx, y + dy
+    return x, y
+
+
+def find_path(mapa, start, goal, blocked=()):
+    #list of commands from start to goal, None if there is no route.
+    #cells in blocked are avoided (except the goal)
+    if start == goal:
+        return []
+    if not mapa.can_sail(*goal):
+        return None
+    gx, gy = goal
+    counter = 0     #breaks ties in the heap without comparing cells
+    frontier = [(abs(start[0] - gx) + abs(start[1] - gy), 0, counter, start)]
+    came_from = {start: None}
+    cost = {start: 0}
+    while frontier:
+        _, g, _, cell = heapq.heappop(frontier)
+        if cell == goal:
+            break
+        if g > cost[cell]:
+            continue    #already reached with a cheaper route
+        x, y = cell
+        for command, (dx, dy) in MOVES.items():
+            nxt = (x + dx, y + dy)
+            if nxt in cost and cost[nxt] <= g + 1:
+                continue
+            if not mapa.can_sail(*nxt) or (nxt in blocked and nxt != goal):
+                continue
+            cost[nxt] = g + 1
+            came_from[nxt] = (cell, command)
+            counter += 1
+            heapq.heappush(frontier, (g + 1 + abs(nxt[0] - gx) + abs(nxt[1] - gy), g + 1, counter, nxt))
+    if goal not in came_from:
+        return None
+    commands = []
+    cell = goal
+    while came_from[cell] is not None:
+        cell, command = came_from[cell]
+        commands.append(command)
+    commands.reverse()
+    return commands
+
+
+def distance_field(mapa, kind):
+    #moves from every cell to the nearest cell of kind ("port" or "island"),
+    #UNREACHABLE for rocks and cut-off water. Cached until the terrain changes
+    cached = _fields.setdefault(mapa, {})
+    revision = mapa.terrain_revision
+    if kind in cached and cached[kind][0] == revision:
+        return cached[kind][1]
+
+    width, height = mapa.width, mapa.height
+    field = array('i', [UNREACHABLE]) * (width * height)
+    queue = deque()
+    for cell_type in TARGETS[kind]:
+        for x, y in mapa.cells_of_type(cell_type):
+            field[y * width + x] = 0
+            queue.append((x, y))
+    while queue:
+        x, y = queue.popleft()
+        d = field[y * width + x] + 1
+        for dx, dy in MOVES.values():
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < width and 0 <= ny < height and field[ny * width + nx] == UNREACHABLE and mapa.can_sail(nx, ny):
+                field[ny * width + nx] = d
+                queue.append((nx, ny))
+    cached[kind] = (revision, field)
+    return field
+
+
+def nearest(mapa, start, kind, blocked=()):
+    #(target cell, commands) to the nearest port or island, None if none can be reached.
+    #walks down the distance field, so the route is as short as possible
+    if isinstance(mapa, TiledMap):
+        if not any(mapa.cells_of_type(cell_type) for cell_type in TARGETS[kind]):
+            return None     #no need to search the whole sea
+        if mapa.get_cell_type(*start) in TARGETS[kind]:
+            return start, []
+        return _search_nearest(mapa, start, kind, blocked)
+    field = distance_field(mapa, kind)
+    width = mapa.width
+    x, y = start
+    if not (0 <= x < mapa.width and 0 <= y < mapa.height) or field[y * width + x] == UNREACHABLE:
+        return None
+    commands = []
+    while field[y * width + x] > 0:
+        d = field[y * width + x]
+        for command, (dx, dy) in MOVES.items():
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < mapa.width and 0 <= ny < mapa.height and field[ny * width + nx] == d - 1 \
+                    and (nx, ny) not in blocked:
+                x, y = nx, ny
+                commands.append(command)
+                break
+        else:
+            # Every way down is taken by the own fleet, search around it
+            return _search_nearest(mapa, start, kind, blocked)
+    return (x, y), commands
+
+
+def _search_nearest(mapa, start, kind, blocked):
+    #breadth-first search from start that avoids blocked, for when the field cannot be followed
+    targets = {ord(cell_type) for cell_type in TARGETS[kind]}
+    came_from = {start: None}
+    queue = deque([start])
+    while queue:
+        cell = queue.popleft()
+        if cell != start and ord(mapa.get_cell_type(*cell)) in targets:
+            commands = []
+            target = cell
+            while came_from[cell] is not None:
+                cell, command = came_from[cell]
+                commands.append(command)
+            commands.reverse()
+            return target, commands
+        x, y = cell
+        for command, (dx, dy) in MOVES.items():
+            nxt = (x + dx, y + dy)
+            if nxt not in came_from and nxt not in blocked and mapa.can_sail(*nxt):
+                came_from[nxt] = (cell, command)
+                queue.append(nxt)
+    return None
@@ -0,0 +1,235 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Wire protocol between captains, ships and Ursula.
+#
+# Every message is one fixed-size binary record (28 bytes):
+#
+#   magic   B   0xC5, never the first byte of a text line
+#   version B   protocol version (VERSION)
+#   type    B   INIT_CAPT, END_CAPT, INIT, MOVE, TERMINATE, COMMAND, REPLY
+#   arg     B   command code (COMMAND) or reply code (REPLY), 0 otherwise
+#   pid     q   process id of the sender. A ship run by a ship host (ship5.py --host)
+#               shares its process, its id is host_pid << HOST_SHIP_BITS | index
+#   x, y    i   position
+#   food    i
+#   gold    i
+#
+# The old text protocol ("pid,MOVE,x,y,food,gold" lines to Ursula) is still
+# accepted as a debug mode (--wire text). Because of the magic byte a reader can
+# take both kinds of messages from the same stream, so text and binary writers
+# can share Ursula's FIFO.
+#
+# Between captain and ship every command frame carries the ship id, a sequence
+# number and one or more moves (a batch); the ship runs them in order, stops at
+# the first one that fails and answers once with the same ship id and sequence
+# number, how many moves it did and its real position, food and gold. The ship id
+# lets one channel carry the frames of many ships (a ship host):
+#
+#   command  COMMAND_HEAD (magic, version, COMMAND, count, seq, ship id)
+#            followed by count command codes, one byte each
+#   reply    REPLY_FRAME (magic, version, REPLY, status, ship id, seq, done, x, y, food, gold)
+#
+# In text mode they are lines: "id seq up up right" and "id seq OK done x y food gold".
+#
+# Besides moves, a command can be a control message that used to be a signal to
+# the ship process: supply (SIGUSR1), damage (SIGUSR2), quit (SIGQUIT), status (SIGTSTP).
+
+import os
+import struct
+
+MAGIC = 0xC5
+VERSION = 2
+RECORD = struct.Struct("<BBBBqiiii")
+SIZE = RECORD.size
+
+WIRES = ("binary", "text")
+
+# Message types
+INIT_CAPT, END_CAPT, INIT, MOVE, TERMINATE, COMMAND, REPLY = range(1, 8)
+TYPE_NAMES = {
+    INIT_CAPT: "INIT_CAPT",
+    END_CAPT: "END_CAPT",
+    INIT: "INIT",
+    MOVE: "MOVE",
+    TERMINATE: "TERMINATE",
+    COMMAND: "COMMAND",
+    REPLY: "REPLY",
+}
+TYPE_CODES = {name: code for code, name in TYPE_NAMES.items()}
+
+HOST_SHIP_BITS = 20     #ships per host, at most 2**20
+
+# Captain -> ship commands (arg of a COMMAND record)
+COMMANDS = {"up": 1, "down": 2, "left": 3, "right": 4, "exit": 5,
+            "supply": 6, "damage": 7, "quit": 8, "status": 9}
+CONTROLS = ("supply", "damage", "quit", "status")
+COMMAND_NAMES = {code: name for name, code in COMMANDS.items()}
+
+# Ship -> captain replies (arg of a REPLY record)
+REPLIES = {"OK": 1, "NOK": 2, "exit": 3}
+REPLY_NAMES = {code: name for name, code in REPLIES.items()}
+
+# Captain <-> ship frames
+COMMAND_HEAD = struct.Struct("<BBBBII")
+REPLY_FRAME = struct.Struct("<BBBBIIIiiii")
+MAX_BATCH = 255     #moves in one command frame (count is one byte)
+
+
+def pack(msg_type, pid, x=0, y=0, food=0, gold=0, arg=0):
+    return RECORD.pack(MAGIC, VERSION, msg_type, arg, pid, x, y, food, gold)
+
+
+def to_text(msg_type, pid, x=0, y=0, food=0, gold=0):
+    #text form of a message to Ursula, the one used before the binary records
+    if msg_type in (INIT, MOVE):
+        return f"{pid},{TYPE_NAMES[msg_type]},{x},{y},{food},{gold}"
+    return f"{pid},{TYPE_NAMES[msg_type]}"
+
+
+def encode(wire, msg_type, pid, x=0, y=0, food=0, gold=0):
+    #bytes of a message to Ursula in the given wire format
+    if wire == "text":
+        return (to_text(msg_type, pid, x, y, food, gold) + "\n").encode()
+    return pack(msg_type, pid, x, y, food, gold)
+
+
+def parse_text(line):
+    #"pid,TYPE[,x,y,food,gold]" -> (type, arg, pid, x, y, food, gold)
+    #raises ValueError if the line is malformed
+    parts = line.strip().split(',')
+    if len(parts) < 2 or parts[1] not in TYPE_CODES:
+        raise ValueError(f"malformed message {line!r}")
+    msg_type = TYPE_CODES[parts[1]]
+    pid = int(parts[0])
+    if msg_type in (INIT, MOVE):
+        if len(parts) != 6:
+            raise ValueError(f"malformed message {line!r}")
+        return msg_type, 0, pid, int(parts[2]), int(parts[3]), int(parts[4]), int(parts[5])
+    return msg_type, 0, pid, 0, 0, 0, 0
+
+
+def decode(buffer, start=0, limit=None):
+    """Decodes the complete messages in buffer[start:].
+
+    Runs of binary records are unpacked in one go with struct.iter_unpack,
+    text lines are parsed one by one. Returns (messages, end, errors): the
+    messages as (type, arg, pid, x, y, food, gold) tuples, the offset of the
+    first byte not consumed and the number of malformed messages skipped.
+    """
+    messages = []
+    errors = 0
+    pos = start
+    n = len(buffer)
+    with memoryview(buffer) as view:
+        while pos < n and (limit is None or len(messages) < limit):
+            if buffer[pos] == MAGIC:
+                count = (n - pos) // SIZE
+                if limit is not None:
+                    count = min(count, limit - len(messages))
+                if count == 0:
+                    break   #partial record, wait for the rest
+                # Records are back to back as long as each one starts with MAGIC
+                heads = buffer[pos:pos + count * SIZE:SIZE]
+                count -= len(heads.lstrip(bytes((MAGIC,))))
+                for record in RECORD.iter_unpack(view[pos:pos + count * SIZE]):
+                    if record[1] != VERSION:
+                        errors += 1
+                        continue
+                    messages.append(record[2:])
+                pos += count * SIZE
+            else:
+                end = buffer.find(b"\n", pos)
+                if end < 0:
+                    break   #partial line
+                line = bytes(view[pos:end]).decode(errors="replace").strip()
+                pos = end + 1
+                if not line:
+                    continue
+                try:
+                    messages.append(parse_text(line))
+                except ValueError:
+                    errors += 1
+    return messages, pos, errors
+
+
+def pack_command(ship_id, seq, commands):
+    #one command frame with a batch of commands (names)
+    return COMMAND_HEAD.pack(MAGIC, VERSION, COMMAND, len(commands), seq, ship_id) + \
+        bytes(COMMANDS[command] for command in commands)
+
+
+def pack_reply(ship_id, seq, status, done, x, y, food, gold):
+    return REPLY_FRAME.pack(MAGIC, VERSION, REPLY, REPLIES[status], ship_id, seq, done, x, y, food, gold)
+
+
+def command_line(ship_id, seq, commands):
+    return f"{ship_id} {seq} {' '.join(commands)}\n"
+
+
+def reply_line(ship_id, seq, status, done, x, y, food, gold):
+    return f"{ship_id} {seq} {status} {done} {x} {y} {food} {gold}\n"
+
+
+def parse_command_line(line):
+    #"id seq up up right" -> (ship id, seq, [commands]), raises ValueError if malformed
+    parts = line.split()
+    if len(parts) < 3 or any(command not in COMMANDS for command in parts[2:]):
+        raise ValueError(f"malformed command {line!r}")
+    return int(parts[0]), int(parts[1]), parts[2:]
+
+
+def decode_replies(buffer, wire="binary"):
+    #complete replies in buffer as (ship id, seq, status, done, x, y, food, gold)
+    #tuples, and the offset of the first byte not consumed
+    replies = []
+    if wire == "text":
+        end = buffer.rfind(b"\n") + 1
+        for line in bytes(buffer[:end]).decode(errors="replace").splitlines():
+            parts = line.split()
+            if len(parts) != 8 or parts[2] not in REPLIES:
+                raise ValueError(f"malformed reply {line!r}")
+            replies.append((int(parts[0]), int(parts[1]), parts[2]) + tuple(int(part) for part in parts[3:]))
+        return replies, end
+    end = len(buffer) - len(buffer) % REPLY_FRAME.size
+    for magic, version, msg_type, status, ship_id, seq, done, x, y, food, gold in REPLY_FRAME.iter_unpack(buffer[:end]):
+        if magic != MAGIC or version != VERSION or msg_type != REPLY:
+            raise ValueError(f"bad reply (magic {magic:#x}, version {version}, type {msg_type})")
+        replies.append((ship_id, seq, REPLY_NAMES.get(status, ""), done, x, y, food, gold))
+    return replies, end
+
+
+def read_exactly(fd, size):
+    #size bytes from a pipe, None on EOF
+    data = b""
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_command(fd):
+    #reads one command frame, (ship id, seq, [commands]) or None on EOF
+    head = read_exactly(fd, COMMAND_HEAD.size)
+    if head is None:
+        return None
+    magic, version, msg_type, count, seq, ship_id = COMMAND_HEAD.unpack(head)
+    if magic != MAGIC or version != VERSION or msg_type != COMMAND:
+        raise ValueError(f"bad command (magic {magic:#x}, version {version}, type {msg_type})")
+    codes = read_exactly(fd, count)
+    if codes is None:
+        return None
+    return ship_id, seq, [COMMAND_NAMES.get(code, "") for code in codes]
+
+
+def read_record(fd):
+    #reads exactly one record from a pipe, None on EOF
+    data = read_exactly(fd, SIZE)
+    if data is None:
+        return None
+    magic, version, msg_type, arg, pid, x, y, food, gold = RECORD.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"bad record (magic {magic:#x}, version {version})")
+    return msg_type, arg, pid, x, y, food, gold
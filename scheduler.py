@@ -0,0 +1,97 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Timer wheel for the ships that move on their own (ship5.py --random).
+#
+# Time is cut in ticks of TICK seconds and the wheel has SLOTS slots: a timer due
+# at tick t waits in slot t % SLOTS. Adding a timer and finding the ones that are
+# due cost the same for one ship or for the thousands of a ship host, which drives
+# all of them on one wheel. Timers more than SLOTS ticks away stay in their slot
+# until the wheel has turned enough times.
+#
+# Nothing here sleeps or uses signals: the ship's main loop sleeps until
+# next_deadline() and then runs expired(). A periodic timer is scheduled again
+# from the tick it was due, not from when it ran, so a ship with speed 0.25 moves
+# four times a second without drifting. A late timer runs once, it does not pile
+# up like the old SIGALRM handler that slept one second inside.
+#
+# simulation.py turns the same wheel without a clock, jumping from one
+# next_tick() to the next.
+
+import time
+
+TICK = 0.01     #seconds, the shortest speed of a ship
+SLOTS = 1024
+
+
+class TimerWheel:
+    def __init__(self, tick=TICK, slots=SLOTS, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.slots = [[] for _ in range(slots)]     #(due tick, item)
+        self.start = clock()
+        self.current = 0    #last tick processed
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, item, since=None):
+        #item is due delay seconds (at least one tick) after the tick since, now by default.
+        #returns the tick it is due
+        due = (self.current if since is None else since) + max(1, round(delay / self.tick))
+        if due <= self.current:     #already late, as soon as possible
+            due = self.current + 1
+        self.slots[due % len(self.slots)].append((due, item))
+        self.count += 1
+        return due
+
+    def now(self):
+        return int((self.clock() - self.start) / self.tick)
+
+    def expired(self, now=None):
+        #[(due tick, item)] of the timers due until the tick now (the clock's by default),
+        #oldest first, taken out of the wheel
+        if now is None:
+            now = self.now()
+        fired = []
+        if now <= self.current:
+            return fired
+        if self.count:
+            # one turn of the wheel visits every slot
+            for t in range(self.current + 1, min(now, self.current + len(self.slots)) + 1):
+                slot = self.slots[t % len(self.slots)]
+                if slot:
+                    fired += [timer for timer in slot if timer[0] <= now]
+                    slot[:] = [timer for timer in slot if timer[0] > now]
+        self.current = now
+        self.count -= len(fired)
+        fired.sort(key=lambda timer: timer[0])
+        return fired
+
+    def next_tick(self):
+        #tick of the next timer, None if the wheel is empty
+        if not self.count:
+            return None
+        n = len(self.slots)
+        for t in range(self.current + 1, self.current + n + 1):
+            for due, _ in self.slots[t % n]:
+                if due == t:
+                    return due
+        # every timer is more than a turn away
+        return min(due for slot in self.slots for due, _ in slot)
+
+    def next_deadline(self):
+        #clock time of the next timer, None if the wheel is empty
+        due = self.next_tick()
+        return None if due is None else self.start + due * self.tick
+
+    def run(self, fire):
+        #calls fire(due, item) for every timer, on time, until the wheel is empty.
+        #fire may schedule the item again (schedule(speed, item, due))
+        while self.count:
+            delay = self.next_deadline() - self.clock()
+            if delay > 0:
+                time.sleep(delay)   #signals still get in, their handlers run here
+            for due, item in self.expired():
+                fire(due, item)
@@ -0,0 +1,335 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Ursula split by regions of the sea, one process per region:
+#   python3 ursula.py sea_pipe --shards 4 --map map.txt
+#
+# A single Ursula handles every message and every fight of the whole sea, so she
+# keeps one core busy while the others wait. Here the sea is cut into N
+# rectangles (Regions), and each one is owned by a shard. A shard is a forked
+# Ursula that keeps only the ships in its rectangle and settles their fights
+# with the same handle_fight. A fight only involves the ships of one cell, so a
+# shard never needs the ships of another one.
+#
+# The process started as Ursula becomes the router. It reads the FIFO or the
+# socket as before and keeps the captains and the shard of every ship. It
+# forwards every message to the shard of the ship's position, as binary
+# records, with one write per shard and wakeup. When a MOVE crosses into another
+# region the ship is handed off: the old shard drops it (TERMINATE with arg
+# HANDOFF), and the new one takes it with the MOVE (arg HANDOFF). A MOVE carries
+# the whole state of the ship (position, food, gold), so nothing else has to go
+# from one shard to the other.
+#
+# The treasure is one Ledger in shared memory, taken under a lock, so gold is
+# never paid twice. The shard that cannot pay marks the ledger and stops. The
+# router sees the mark after that wakeup, sends SIGUSR1 to the captains (only
+# it knows them) and stops every shard, as in end_of_world. The end of the
+# game, when every captain and ship has terminated, is checked by the router
+# too.
+#
+# The journal (--journal) only works without shards.
+
+import os
+import signal
+import select
+import multiprocessing
+from collections import Counter
+import protocol
+import log
+from ursula import Ursula
+
+HANDOFF = 1     #arg of a TERMINATE (the ship leaves the shard) or a MOVE (it arrives)
+
+
+class Regions:
+    #the sea cut into cols x rows rectangles, as square as possible, one per shard
+    def __init__(self, width, height, shards):
+        self.shards = shards
+        # of the grids with shards cells, the one with the squarest regions
+        self.cols, self.rows = min(((cols, shards // cols) for cols in range(1, shards + 1) if shards % cols == 0),
+                                   key=lambda grid: max(width * grid[1] / (height * grid[0]),
+                                                        height * grid[0] / (width * grid[1])))
+        self.region_width = max(1, -(-width // self.cols))
+        self.region_height = max(1, -(-height // self.rows))
+
+    def shard(self, x, y):
+        #the shard of a cell, cells out of the sea go to the region at that border
+        col = min(self.cols - 1, max(0, x // self.region_width))
+        row = min(self.rows - 1, max(0, y // self.region_height))
+        return row * self.cols + col
+
+    def bounds(self, shard):
+        #first and last x and y of a region
+        row, col = divmod(shard, self.cols)
+        x, y = col * self.region_width, row * self.region_height
+        return x, y, x + self.region_width - 1, y + self.region_height - 1
+
+
+class Ledger:
+    #Ursula's treasure, one for every shard, in shared memory
+    def __init__(self, treasure):
+        self.gold = multiprocessing.Value("q", treasure)
+        self.ended = multiprocessing.Value("b", 0, lock=False)    #set under the lock of gold
+
+    @property
+    def value(self):
+        return self.gold.value
+
+    def pay(self, needed):
+        #takes needed gold, False if there is not enough (the world ends) or it had already ended
+        with self.gold.get_lock():
+            if self.ended.value:
+                return False
+            if self.gold.value < needed:
+                self.ended.value = 1
+                return False
+            self.gold.value -= needed
+            return True
+
+    def world_ended(self):
+        return bool(self.ended.value)
+
+
+class Shard(Ursula):
+    #the Ursula of one region, fed by the router through a pipe
+    def __init__(self, index, bounds, read_fd, ledger, seed=None, status=True, status_interval=5.0, tick=0.0):
+        super().__init__(f"shard {index}", None if seed is None else f"{seed}:{index}", status=status,
+                         status_interval=status_interval, tick=tick)
+        self.index = index
+        self.bounds = bounds    #(x0, y0, x1, y1) of its region
+        self.read_fd = read_fd
+        self.ledger = ledger
+        self.treasure = ledger.value    #last value seen, for the logs and the status
+
+    def pay(self, needed):
+        if not needed:
+            return True
+        paid = self.ledger.pay(needed)
+        self.treasure = self.ledger.value
+        return paid
+
+    def end_of_world(self):
+        #the router signals the captains, only it knows them
+        log.warning(f"Ursula: end of the world in shard {self.index}, no enough gold")
+        self.metrics.inc("end_of_world")
+        self.running = False
+
+    def handle_message(self, msg_type, arg, pid, x, y, food, gold):
+        if arg == HANDOFF:
+            if msg_type == protocol.TERMINATE:
+                # The ship sails into another region, it is not terminated
+                if pid in self.ships:
+                    self.unplace_ship(pid, *self.ships.position(pid))
+                    self.ships.remove(pid)
+                self.moves.pop(pid, None)   #--tick: its last move here is void
+                self.metrics.inc("handoffs", direction="out")
+                return
+            # Comes from another region, from here it is a MOVE like any other
+            self.ships.add(pid, x, y, food, gold)
+            self.place_ship(pid, x, y)
+            self.metrics.inc("handoffs", direction="in")
+        super().handle_message(msg_type, arg, pid, x, y, food, gold)
+
+    def run(self):
+        signal.signal(signal.SIGUSR1, self.request_dump)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)     #Ctrl-C is for the router, it stops the shards
+        x0, y0, x1, y1 = self.bounds
+        log.info(f"Ursula: shard {self.index} (pid {os.getpid()}) owns x {x0}..{x1}, y {y0}..{y1}")
+        buffer = bytearray()
+        while True:
+            try:
+                if self.tick and not select.select([self.read_fd], [], [], self.select_timeout())[0]:
+                    self.run_tick()     #nothing from the router before the end of the tick
+                    continue
+                data = os.read(self.read_fd, 65536)
+            except OSError as e:
+                log.error(f"Error happened: {e}")
+                break
+            if not data:
+                break   #the router closed the pipe, the game is over
+            if not self.running or self.ledger.world_ended():
+                # The world has ended, the rest is read and dropped until the router stops us,
+                # or it could block writing to this pipe
+                self.running = False
+                continue
+            buffer += data
+            self.process_buffer(buffer)
+            self.run_tick()
+            if self.dump_requested:
+                self.dump_stats()
+        os.close(self.read_fd)
+        log.info(f"Ursula: shard {self.index} stopped with {len(self.ships)} ships")
+
+
+class Router(Ursula):
+    #reads the captains and the ships as Ursula does and forwards every message to its shard
+    def __init__(self, ursula_pipe, regions, seed=None, stats=None, stats_format="json", status=True,
+                 status_interval=5.0, tick=0.0):
+        super().__init__(ursula_pipe, seed, stats, stats_format, status=False)
+        self.regions = regions
+        self.ledger = Ledger(self.treasure)
+        self.ships = {}     #pid -> shard that owns the ship, the ships themselves are in the shards
+        self.batches = [bytearray() for _ in range(regions.shards)]     #records of this wakeup per shard
+        self.counts = {}    #messages by type not in the metrics yet
+        self.shards = []    #(pid, write end of its pipe) of every shard
+        self.shard_args = (seed, status, status_interval, tick)     #the shards resolve the ticks
+        self.world_ended = False
+
+    def process_buffer(self, buffer, limit=None, pids=None):
+        messages, end, errors = protocol.decode(buffer, limit=limit)
+        del buffer[:end]
+        if errors:
+            log.error(f"Error processing: {errors} malformed message(s) skipped")
+            self.metrics.inc("parse_errors", errors)
+        return self.route(messages, pids)
+
+    def handle_message(self, msg_type, arg, pid, x, y, food, gold):
+        self.route(((msg_type, arg, pid, x, y, food, gold),))
+
+    def route(self, messages, pids=None):
+        #puts every message in the batch of its shard, returns how many were handled.
+        #The router sees every message of the sea, so this is one loop with everything
+        #inlined and the metrics added once per call: it has to cost much less than a shard
+        regions = self.regions
+        last_col, last_row = regions.cols - 1, regions.rows - 1
+        width, height, cols = regions.region_width, regions.region_height, regions.cols
+        owners, batches, counts = self.ships, self.batches, self.counts
+        pack = protocol.RECORD.pack
+        MAGIC, VERSION = protocol.MAGIC, protocol.VERSION
+        INIT, MOVE, TERMINATE = protocol.INIT, protocol.MOVE, protocol.TERMINATE
+        handled = handoffs = 0
+        for msg_type, arg, pid, x, y, food, gold in messages:
+            handled += 1
+            counts[msg_type] = counts.get(msg_type, 0) + 1
+            if pids is not None:
+                pids.add(pid)
+            if msg_type == MOVE or msg_type == INIT:
+                owner = owners.get(pid)
+                if owner is None and msg_type == MOVE:
+                    continue    #unknown ship, Ursula ignores it too
+                # Regions.shard(x, y), without the calls
+                col, row = x // width, y // height
+                if col > last_col:
+                    col = last_col
+                elif col < 0:
+                    col = 0
+                if row > last_row:
+                    row = last_row
+                elif row < 0:
+                    row = 0
+                shard = row * cols + col
+                arg = 0
+                if owner != shard:
+                    if owner is not None:
+                        batches[owner] += pack(MAGIC, VERSION, TERMINATE, HANDOFF, pid, x, y, food, gold)
+                        handoffs += 1
+                        if msg_type == MOVE:
+                            arg = HANDOFF
+                    owners[pid] = shard
+                batches[shard] += pack(MAGIC, VERSION, msg_type, arg, pid, x, y, food, gold)
+            elif msg_type == TERMINATE:
+                owner = owners.pop(pid, None)
+                if owner is not None:
+                    batches[owner] += pack(MAGIC, VERSION, TERMINATE, 0, pid, x, y, food, gold)
+                    # Only a TERMINATE or an END_CAPT can end the game
+                    self.check_termination()
+            elif msg_type == protocol.INIT_CAPT or msg_type == protocol.END_CAPT:
+                if self.apply_message(msg_type, pid, x, y, food, gold):
+                    log.info(f"Ursula: Captain {pid} {'registered' if msg_type == protocol.INIT_CAPT else 'terminated'}")
+                self.check_termination()
+            if not self.running:
+                break
+        if handoffs:
+            self.metrics.inc("handoffs", handoffs)
+        return handled
+
+    def commit(self):
+        #end of a wakeup: what every shard got, in one write, and a look at the ledger
+        for shard, batch in enumerate(self.batches):
+            if batch:
+                self.send(shard, batch)
+                batch.clear()
+        if self.ledger.world_ended() and not self.world_ended:
+            self.world_ended = True
+            self.treasure = self.ledger.value
+            self.end_of_world()
+
+    def send(self, shard, data):
+        #blocks while the shard is behind, so a fast client cannot fill the router's memory
+        fd = self.shards[shard][1]
+        view = memoryview(data)
+        try:
+            written = 0
+            while written < len(view):
+                written += os.write(fd, view[written:])
+        except OSError as e:
+            log.error(f"Error happened: shard {shard}: {e}")
+            self.running = False
+        finally:
+            view.release()
+
+    def stats_snapshot(self):
+        m = self.metrics
+        for msg_type, count in self.counts.items():
+            m.inc("messages", count, type=protocol.TYPE_NAMES.get(msg_type, "unknown"))
+        self.counts.clear()
+        m.set("treasure", self.ledger.value)
+        m.set("ships", len(self.ships))
+        m.set("captains", sum(1 for status in self.captains.values() if status == "alive"))
+        for shard, ships in sorted(Counter(self.ships.values()).items()):
+            m.set("shard_ships", ships, shard=shard)
+        return m.render(self.stats_format)
+
+    def start_shards(self):
+        #forks one Ursula per region, each one with a pipe from the router
+        for index in range(self.regions.shards):
+            read_fd, write_fd = os.pipe()
+            try:
+                child = os.fork()
+            except OSError as e:
+                log.error(f"Error happened: {e}")
+                os.close(read_fd)
+                os.close(write_fd)
+                self.stop_shards()
+                raise SystemExit(1)
+            if child == 0:
+                code = 0
+                try:
+                    os.close(write_fd)
+                    for _, fd in self.shards:
+                        os.close(fd)    #the pipes of the other shards, or they would never see EOF
+                    Shard(index, self.regions.bounds(index), read_fd, self.ledger, *self.shard_args).run()
+                except Exception as e:
+                    log.error(f"Error happened: shard {index}: {e}")
+                    code = 1
+                log.flush()     #os._exit skips atexit
+                os._exit(code)
+            os.close(read_fd)
+            self.shards.append((child, write_fd))
+        log.info(f"Ursula: {self.regions.shards} shards, regions of {self.regions.region_width}x"
+                 f"{self.regions.region_height} ({self.regions.cols}x{self.regions.rows})")
+
+    def stop_shards(self):
+        #EOF on every pipe, a shard ends after handling what it was sent
+        for child, fd in self.shards:
+            os.close(fd)
+        for child, fd in self.shards:
+            try:
+                os.waitpid(child, 0)
+            except ChildProcessError:
+                pass
+        self.shards = []
+        if self.ledger.world_ended() and not self.world_ended:
+            # The world ended with the last messages of the game
+            self.world_ended = True
+            self.treasure = self.ledger.value
+            self.end_of_world()
+        log.info(f"Ursula: shards stopped, treasure {self.ledger.value} gold")
+
+    def run(self):
+        self.start_shards()
+        try:
+            super().run()
+        finally:
+            self.commit()
+            self.stop_shards()
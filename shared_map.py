@@ -0,0 +1,196 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Map shared by every captain and ship playing on the same map file.
+#
+# The terrain and an occupancy layer live in one multiprocessing.shared_memory
+# segment. The first captain creates it from the map file, the other captains
+# and the ships attach to it by name, so nobody else parses the file and all of
+# them see the set_ship / remove_ship of every fleet.
+#
+# Segment layout:
+#   header     magic b"SEAS", width, height (struct HEADER)
+#   terrain    width * height bytes, the cells of the file (. # P I), never changes
+#   occupancy  width * height bytes, number of ships in each cell
+#
+# Reading a cell is a plain memory read. Changing the occupancy of a cell takes
+# an fcntl lock on that one byte of a lock file, so two ships updating the same
+# cell at once never lose an update, and cells far apart never wait on each other.
+#
+# Every process using the segment (captains of every fleet and their ships) holds
+# a shared lock on the byte after the cells of the lock file. close() removes the
+# segment and the lock file only if it gets that byte exclusively, i.e. it is the
+# last user, whoever created it. The kernel drops the locks of a process that
+# dies, a crashed ship never keeps the segment alive. Before removing it the last
+# user clears the magic, so a process that attached meanwhile knows it is gone.
+
+import os
+import sys
+import fcntl
+import struct
+import hashlib
+import tempfile
+from multiprocessing import shared_memory, resource_tracker
+
+from map import Map, find_all
+
+HEADER = struct.Struct("<4sII")
+MAGIC = b"SEAS"
+OCCUPIED = bytes([0] + [1] * 255)   #translate table, number of ships -> 0/1
+
+
+def segment_name(filename):
+    #same name for every process that opens the same map file
+    digest = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:16]
+    return f"sea_{digest}"
+
+
+def _lock_path(name):
+    return os.path.join(tempfile.gettempdir(), name + ".lock")
+
+
+def _attach_segment(name):
+    #attach without registering the segment in this process' resource tracker,
+    #otherwise it would be unlinked as soon as the first ship or captain that attached
+    #exits, even with other fleets still on it. Only the last user unlinks it (close)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:   #Python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SharedMap(Map):
+    shared = True
+
+    def __init__(self, name, owner=False, shm=None):
+        #attaches to an existing segment, use SharedMap.create() to make one
+        self.name = name
+        self.owner = owner
+        self.shm = shm or _attach_segment(name)
+        magic, self.width, self.height = HEADER.unpack_from(self.shm.buf)
+        if magic != MAGIC:
+            self.shm.close()
+            raise ValueError(f"Shared memory '{name}' is not a map")
+        self.filename = None
+        size = self.width * self.height
+        self.cells = self.shm.buf[HEADER.size:HEADER.size + size]                    #terrain
+        self.occupancy = self.shm.buf[HEADER.size + size:HEADER.size + 2 * size]
+        self.lock_fd = os.open(_lock_path(name), os.O_RDWR | os.O_CREAT, 0o600)
+        if not self.attach():
+            self.cells.release()
+            self.occupancy.release()
+            self.shm.close()
+            os.close(self.lock_fd)
+            raise FileNotFoundError(f"Shared memory '{name}' was removed by its last user")
+
+    @classmethod
+    def create(cls, filename, name=None):
+        #loads the map file into a new segment
+        mapa = Map(filename)
+        size = mapa.width * mapa.height
+        name = name or segment_name(filename)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=HEADER.size + 2 * size)
+        HEADER.pack_into(shm.buf, 0, MAGIC, mapa.width, mapa.height)
+        shm.buf[HEADER.size:HEADER.size + size] = mapa.cells
+        #the creator keeps the segment tracked until it closes it, it is removed if the
+        #captain crashes
+        return cls(name, owner=True, shm=shm)
+
+    @classmethod
+    def open(cls, filename, name=None):
+        #attaches to the segment of this map file, creating it if it is the first
+        name = name or segment_name(filename)
+        try:
+            return cls(name)
+        except FileNotFoundError:
+            pass
+        try:
+            return cls.create(filename, name)
+        except FileExistsError:     #another captain created it meanwhile
+            return cls(name)
+
+    def attach(self):
+        #this process uses the segment until close(). A forked ship calls it again, the
+        #locks of its parent are not inherited. False if the last user removed it meanwhile
+        users = self.width * self.height    #the byte after the cells of the lock file
+        fcntl.lockf(self.lock_fd, fcntl.LOCK_SH, 1, users)
+        if HEADER.unpack_from(self.shm.buf)[0] != MAGIC:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_UN, 1, users)
+            return False
+        return True
+
+    def _add_ship(self, i, delta):
+        #byte i of the lock file is the lock of cell i
+        fcntl.lockf(self.lock_fd, fcntl.LOCK_EX, 1, i)
+        try:
+            self.occupancy[i] = min(255, max(0, self.occupancy[i] + delta))
+        finally:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_UN, 1, i)
+
+    def get_cell_type(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            i = y * self.width + x
+            cell = self.cells[i]
+            if self.occupancy[i]:
+                cell = Map.ARRIVE.get(cell, cell)
+            return chr(cell)
+        return None
+
+    def ships_at(self, x, y):
+        #number of ships of every fleet in the cell
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.occupancy[y * self.width + x]
+        return 0
+
+    def set_ship(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self._add_ship(y * self.width + x, 1)
+            return True
+        return None
+
+    def remove_ship(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self._add_ship(y * self.width + x, -1)
+        return None
+
+    def cells_of_type(self, cell_type):
+        #S, H and B are the occupied W, P and I cells, the rest are the free ones
+        kind = ord(cell_type)
+        occupied = bytes(self.occupancy).translate(OCCUPIED)
+        if kind in Map.LEAVE:
+            indexes = [i for i in find_all(self.cells, Map.LEAVE[kind]) if occupied[i]]
+        else:
+            indexes = [i for i in find_all(self.cells, kind) if not occupied[i]]
+        width = self.width
+        return [(i % width, i // width) for i in indexes]
+
+    def close(self):
+        #the last user (of any fleet) also removes the segment and its lock file
+        self.cells.release()
+        self.occupancy.release()
+        try:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.width * self.height)
+            last = True
+        except OSError:     #other processes still use it
+            last = False
+        try:
+            if last:
+                self.shm.buf[:len(MAGIC)] = bytes(len(MAGIC))
+                os.unlink(_lock_path(self.name))   #first, a new segment never shares the old lock file
+                if not self.owner and not hasattr(self.shm, "_track"):
+                    #Python < 3.13 unregisters on unlink what _attach_segment already unregistered
+                    resource_tracker.register(self.shm._name, "shared_memory")
+                self.shm.unlink()
+            elif self.owner:
+                #the creator's resource tracker would remove it when the captain exits
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        except OSError as e:
+            print(f"Error happened: {e}", file=sys.stderr)
+        self.shm.close()
+        os.close(self.lock_fd)     #drops this process' locks
+
+    def __str__(self):
+        width = self.width
+        return '\n'.join(''.join(self.get_cell_type(x, y) for x in range(width)) for y in range(self.height))
@@ -11,21 +11,43 @@
 #   --map <file>         Path to map file (default: map.txt)
 #   --pos x y            Initial position
 #   --food N             Initial food (default: 100)
-#   --random N s1        Random movement: N steps, s1 seconds between moves
+#   --random N s1        Random movement: N steps, s1 seconds between moves (0.25 is 4 moves a second)
 #   --captain            Follow captain’s orders (not implemented yet in Step 2)
 #   --pipe <fd>          File descriptor (write end) of the pipe to send messages to the captain
+#   --ursula <target>    Ursula FIFO path or unix:<socket path>
+#   --tile-budget MB     Memory for the tiles of a .tiles map (default: 64)
+#   --shm <name>         Attach to the shared memory map of the captain instead of reading --map
+#   --wire binary|text   Format of the messages to the captain and Ursula (text for debugging)
+#   --host               Run many ships in this process (ship host), one --ship per ship
+#   --ship id x y [s1]   A ship of the host, s1 its seconds between moves with --random
 #
-# All output is sent to stderr (to show logs on the terminal)
+# A ship host reads the command frames of all its ships from one stdin and answers
+# on one stdout, the frames carry the ship id. Its ships get control messages
+# (supply, damage, quit, status) instead of signals, which would hit every ship
+# of the process.
+#
+# Random moves are driven by a timer wheel (scheduler.py) instead of SIGALRM:
+# os.alarm only had whole seconds and the handler slept inside. A ship host moves
+# all its ships on the same wheel.
+#
+# All output is sent to stderr (to show logs on the terminal), through log.py:
+#   --log-level debug|info|warning|error, --quiet, --log-rate lines/s
 # Messages to the captain (real-time updates) go through the pipe
         
 
 import os
 import sys
-import time
 import signal
 import random
+import atexit
 import argparse
+import protocol
+import transport
+import scheduler
+import log
 from map import Map
+from shared_map import SharedMap
+from tiled_map import open_map
 
 ursula_pipe = None
 
@@ -35,7 +57,7 @@ class Ship:
     # DIRECTIONS: Possible moves → right, down, left, up
     DIRECTIONS = [(0, 1), (1, 0), (0, -1), (-1, 0)]
 
-    def __init__(self, shipId, mapa, pos, food, pipe_fd=None):
+    def __init__(self, shipId, mapa, pos, food, pipe_fd=None, pid=None):
         # Stores all the attributes of the ship
         self.shipId = shipId           # Ship unique ID (provided by captain)
         self.mapa = mapa               # Map object (shared map between ships)
@@ -44,8 +66,11 @@ class Ship:
         self.food = food               # Food supply (decreases every move)
         self.gold = 0                  # Gold collected by visiting islands
         self.pipe_fd = pipe_fd         # File descriptor of pipe to captain (write end)
-        self.pid = os.getpid()         # Process ID of this ship
-        self.speed = 0                 # Movement interval in seconds (used by SIGALRM)
+        self.pid = pid or os.getpid()  # Process ID of this ship (its id for Ursula in a host)
+        self.speed = 0                 # Movement interval in seconds (random mode)
+        self.seq = 0                   # Sequence number of the command being answered
+        self.done = 0                  # Moves of that command already done
+        self.rng = random              # Random moves, ship_rng() to repeat them
 
  
     # Function to send a message both to stderr and to the captain via pipe
@@ -55,11 +80,28 @@ class Ship:
         and everything else to stderr for local debugging.
         """
         if msg in ["OK", "NOK", "exit"]:
-            print(msg, flush=True)  # this goes to the captain
+            self.reply(msg)  # this goes to the captain
         else:
-            print(msg, file=sys.stderr, flush=True)  # debug output only
+            log.info(msg, "ship")  # debug output only
 
  
+    # Reply to the captain through stdout: the sequence number of the command,
+    # how many of its moves were done and the real position, food and gold
+    def reply(self, status):
+        state = (self.shipId, self.seq, status, self.done, self.pos[0], self.pos[1], self.food, self.gold)
+        if transport.wire == "text":
+            os.write(sys.stdout.fileno(), protocol.reply_line(*state).encode())
+        else:
+            os.write(sys.stdout.fileno(), protocol.pack_reply(*state))
+
+    # Next command frame from the captain through stdin: (seq, [moves])
+    def read_command(self):
+        frame = read_frame()
+        if frame is None:
+            log.info(f"Ship {self.shipId}: captain closed the pipe.")
+            sys.exit(self.gold)
+        return frame[1:]
+
     # Default string representation of the ship (used in debugging)
   
     def __str__(self):
@@ -83,7 +125,7 @@ class Ship:
             self.speak(f"Ship {self.shipId}: Not enough food to move.")
             return
         # Pick a random direction (dx, dy)
-        dx, dy = random.choice(Ship.DIRECTIONS)
+        dx, dy = self.rng.choice(Ship.DIRECTIONS)
         # Check if the destination cell is navigable
         if self.mapa.can_sail(self.pos[0] + dx, self.pos[1] + dy):
             self.mapa.remove_ship(self.pos[0], self.pos[1])  # Remove from old cell
@@ -101,10 +143,10 @@ class Ship:
                 self.speak(f"Ship {self.shipId}: Reached port {self.pos}, food={self.food}")
             else:
                 self.speak(f"Ship {self.shipId}: Moved to {self.pos}, food={self.food}")
+            if ursula_pipe:
+                send_to_ursula(ursula_pipe, protocol.MOVE, self.pid, self.pos[0], self.pos[1], self.food, self.gold)
         else:
             self.speak(f"Ship {self.shipId}: Cannot sail there.")
-        # Delay for realism
-        time.sleep(1)
 
    
     # CAPTAIN MODE: waits for commands from captain via stdin (Step 3)
@@ -114,86 +156,238 @@ class Ship:
         #self.speak(f"Ship {self.shipId} (PID {self.pid}) in Captain Mode")
         while True:
             try:
-                movement = sys.stdin.readline().strip()
-                if not movement:
+                seq, movements = self.read_command()
+                if not movements:
                     continue  # sigue esperando si no hay comando
-
-                if movement == "exit":
-                    self.speak("exit")
-                    print(f"Ship {self.shipId} exiting with gold {self.gold}.", file=sys.stderr)
+                if self.handle_command(seq, movements) == "exit":
+                    log.info(f"Ship {self.shipId} exiting with gold {self.gold}.")
                     sys.exit(self.gold)
 
-                if self.food < 5:
-                    self.speak("NOK")
-                    print(f"Ship {self.shipId}: Not enough food.", file=sys.stderr)
-                    continue
-
-                # current position
-                x, y = self.pos
-                new_x, new_y = x, y
-                if movement == "up": new_y += 1
-                elif movement == "down": new_y -= 1
-                elif movement == "right": new_x += 1
-                elif movement == "left": new_x -= 1
-
-                # check destination
-                if self.mapa.can_sail(new_x, new_y):
-                    self.mapa.remove_ship(x, y)
-                    self.pos = (new_x, new_y)
-                    self.mapa.set_ship(new_x, new_y)
-                    self.food -= 5
-                    self.speak("OK")
-                    #print(f"Ship {self.shipId} moved to {self.pos}", file=sys.stderr)
-                    if ursula_pipe:
-                        try:
-                            move_msg = f"{self.pid},MOVE,{self.pos[0]},{self.pos[1]},{self.food},{self.gold}"
-                            send_to_ursula(move_msg, ursula_pipe)
-                        except OSError as e:
-                            print(f"Ship {self.shipId}: Error sending MOVE to Ursula: {e}", file=sys.stderr)
-                    
+            except ValueError as e:     # malformed frame, nothing to answer to
+                log.error(f"Ship {self.shipId} exception: {e}")
+
+    # One command frame: a batch of moves (or control messages) in order until
+    # one fails, then one reply for all of them. Returns the reply status
+    def handle_command(self, seq, movements):
+        self.seq = seq
+        self.done = 0
+        status = "OK"
+        for movement in movements:
+            status = self.move_once(movement)
+            if status != "OK":
+                break
+            self.done += 1
+        self.speak(status)
+        return status
+
+    # CONTROL MESSAGES: what the signals do, for ships that share a process
+
+    def supply(self):
+        self.food += 10
+        self.speak(f"Ship {self.shipId}: Food increased → {self.food}")
+        return "OK"
+
+    def damage(self):
+        self.food = max(0, self.food - 10)
+        self.gold = max(0, self.gold - 10)
+        self.speak(f"Ship {self.shipId}: Food/Gold decreased → {self.food}/{self.gold}")
+        if self.food == 0:
+            self.speak(f"Ship {self.shipId}: Out of food → exiting ({self.gold})")
+            return "exit"
+        return "OK"
+
+    def report_status(self):
+        log.write(self.get_status_message() + "\n")    # asked for, whatever the log level
+        return "OK"
+
+    # One move of a command, returns the reply status
+    def move_once(self, movement):
+        if movement in ("exit", "quit"):
+            return "exit"
+        if movement == "supply":
+            return self.supply()
+        if movement == "damage":
+            return self.damage()
+        if movement == "status":
+            return self.report_status()
+
+        if self.food < 5:
+            log.info(f"Ship {self.shipId}: Not enough food.", "move")
+            return "NOK"
+
+        # current position
+        x, y = self.pos
+        new_x, new_y = x, y
+        if movement == "up": new_y += 1
+        elif movement == "down": new_y -= 1
+        elif movement == "right": new_x += 1
+        elif movement == "left": new_x -= 1
+
+        # check destination
+        if not self.mapa.can_sail(new_x, new_y):
+            log.info(f"Ship {self.shipId}: Cannot sail there", "move")
+            return "NOK"
+        self.mapa.remove_ship(x, y)
+        self.pos = (new_x, new_y)
+        self.mapa.set_ship(new_x, new_y)
+        self.food -= 5
+        #print(f"Ship {self.shipId} moved to {self.pos}", file=sys.stderr)
+        if ursula_pipe:
+            send_to_ursula(ursula_pipe, protocol.MOVE, self.pid, self.pos[0], self.pos[1], self.food, self.gold)
+        return "OK"
+
+
+# Random moves of one ship for a seed (--seed), the same ones in simulation.py
+def ship_rng(seed, shipId):
+    return random.Random(f"{seed}:{shipId}")
+
+
+# RANDOM MODE: every ship moves every ship.speed seconds, steps times, all of them on
+# one timer wheel. finished(ship) is called when a ship has done its steps
+def run_random(ships, steps, finished=None):
+    wheel = scheduler.TimerWheel()
+    left = {}
+    for ship in ships:
+        left[ship.shipId] = steps
+        wheel.schedule(ship.speed, ship)
+
+    def move(due, ship):
+        ship.move_randomly()
+        left[ship.shipId] -= 1
+        if left[ship.shipId] > 0:
+            wheel.schedule(ship.speed, ship, due)
+        elif finished:
+            finished(ship)
+
+    wheel.run(move)
+
+
+# Next command frame from stdin, for a ship or a ship host: (ship id, seq, [moves]),
+# None when the captain closed the pipe
+def read_frame():
+    if transport.wire == "text":
+        line = sys.stdin.readline()
+        if line and not line.strip():
+            return 0, 0, []     # empty line, keep waiting
+        return protocol.parse_command_line(line) if line else None
+    return protocol.read_command(sys.stdin.fileno())
+
+
+# SHIP HOST: many ships in one process, addressed by ship id
+
+class ShipHost:
+    def __init__(self, mapa):
+        self.mapa = mapa
+        self.ships = {}     # ship id -> Ship
+        self.added = 0
+
+    def add(self, shipId, pos, food):
+        # the ships share the pid of the host, Ursula tells them apart by this id
+        pid = (os.getpid() << protocol.HOST_SHIP_BITS) | self.added
+        self.added += 1
+        ship = Ship(shipId, self.mapa, pos, food, pid=pid)
+        self.ships[shipId] = ship
+        return ship
+
+    def remove(self, shipId):
+        ship = self.ships.pop(shipId)
+        self.mapa.remove_ship(ship.pos[0], ship.pos[1])
+        if ursula_pipe:
+            send_to_ursula(ursula_pipe, protocol.TERMINATE, ship.pid)
+        log.info(f"Ship {shipId} exiting with gold {ship.gold}.", "ship")
+
+    def remove_all(self):
+        for shipId in list(self.ships):
+            self.remove(shipId)
+
+    def run(self):
+        # until the captain closes the pipe or every ship has exited
+        while self.ships:
+            try:
+                frame = read_frame()
+            except ValueError as e:     # malformed frame, nothing to answer to
+                log.error(f"Ship host {os.getpid()} exception: {e}")
+                continue
+            if frame is None:
+                log.info(f"Ship host {os.getpid()}: captain closed the pipe.")
+                return
+            shipId, seq, movements = frame
+            if not movements:
+                continue
+            ship = self.ships.get(shipId)
+            if ship is None:
+                # not here (anymore), the captain has to forget it
+                log.warning(f"Ship host {os.getpid()}: no ship {shipId}.")
+                gone = (shipId, seq, "exit", 0, 0, 0, 0, 0)
+                if transport.wire == "text":
+                    os.write(sys.stdout.fileno(), protocol.reply_line(*gone).encode())
                 else:
-                    self.speak("NOK")
-                    print(f"Ship {self.shipId}: Cannot sail there", file=sys.stderr)
+                    os.write(sys.stdout.fileno(), protocol.pack_reply(*gone))
+                continue
+            if ship.handle_command(seq, movements) == "exit":
+                self.remove(shipId)
+
+    def report_status(self):
+        for ship in self.ships.values():
+            ship.report_status()
 
-            except Exception as e:
-                self.speak(f"Error happened: {e}")
-                print(f"Ship {self.shipId} exception: {e}", file=sys.stderr)
+
+def run_host(args, mapa):
+    host = ShipHost(mapa)
+    for spec in args.ship:
+        try:
+            shipId, x, y = (int(value) for value in spec[:3])
+            speed = float(spec[3]) if len(spec) > 3 else args.random[1] if args.random else 0
+            if len(spec) not in (3, 4):
+                raise ValueError
+        except ValueError:
+            sys.exit(f"Invalid --ship {' '.join(spec)}, expected: id x y [speed]")
+        if not mapa.can_sail(x, y):
+            log.warning(f"Ship {shipId}: invalid initial position ({x},{y}).")
+            continue
+        ship = host.add(shipId, (x, y), args.food)
+        ship.speed = speed
+        if args.seed is not None:
+            ship.rng = ship_rng(args.seed, shipId)
+        if ursula_pipe:
+            send_to_ursula(ursula_pipe, protocol.INIT, ship.pid, x, y, ship.food, ship.gold)
+    # ships still in the host when it exits leave the map (the other fleets see it)
+    atexit.register(host.remove_all)    # runs before mapa.close (registered by main)
+
+    # SIGQUIT ends every ship of the host, SIGTSTP shows all of them.
+    # Per ship there are the control messages
+    signal.signal(signal.SIGQUIT, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGTSTP, lambda signum, frame: host.report_status())
+    log.info(f"Ship host {os.getpid()} started with {len(host.ships)} ships")
+    if args.random:
+        run_random(list(host.ships.values()), args.random[0], lambda ship: host.remove(ship.shipId))
+    else:
+        host.run()
+    sys.exit(0)
 
 
-def send_to_ursula(message, ursula_pipe):
+def send_to_ursula(ursula_pipe, msg_type, pid, x=0, y=0, food=0, gold=0):
+    #the connection stays open for the whole life of the ship (see transport.py)
     if ursula_pipe:
         try:
-            with open(ursula_pipe, "w") as fifo:
-                fifo.write(message + "\n")
-                fifo.flush()
-            print(f"Captain: sent message to Ursula: {message}", file=sys.stderr)
+            transport.send_record(ursula_pipe, msg_type, pid, x, y, food, gold)
+            log.info(f"Ship: sent message to Ursula: {protocol.to_text(msg_type, pid, x, y, food, gold)}", "ursula")
         except OSError as e:
-            print(f"Ship {ship.pid} failed to notify Ursula on terminate: {e}", file=sys.stderr)
+            log.error(f"Ship {os.getpid()} failed to notify Ursula: {e}")
 
-    sys.exit(ship.gold)
 # SIGNAL HANDLERS
 
 # They manage how the ship reacts to external signals sent by the captain
 
-def handler_sigalrm(signum, frame):
-    global current_ship
-    current_ship.move_randomly()
-    os.alarm(current_ship.speed)  # Set next timer
-
 def handler_sigusr1(signum, frame):
    
     global current_ship
-    current_ship.food += 10
-    current_ship.speak(f"Ship {current_ship.shipId}: Food increased → {current_ship.food}")
+    current_ship.supply()
 
 def handler_sigusr2(signum, frame):
    
     global current_ship
-    current_ship.food = max(0, current_ship.food - 10)
-    current_ship.gold = max(0, current_ship.gold - 10)
-    current_ship.speak(f"Ship {current_ship.shipId}: Food/Gold decreased → {current_ship.food}/{current_ship.gold}")
-    if current_ship.food == 0:
-        current_ship.speak(f"Ship {current_ship.shipId}: Out of food → exiting ({current_ship.gold})")
+    if current_ship.damage() == "exit":
         sys.exit(current_ship.gold)
 
 def handler_sigquit(signum, frame):
@@ -205,65 +399,86 @@ def handler_sigquit(signum, frame):
 def handler_sigtstp(signum, frame):
    
     global current_ship
-    current_ship.speak(current_ship.get_status_message())
+    current_ship.report_status()
 
 
 
 # MAIN FUNCTION
 
-if __name__ == "__main__":
+def main(argv=None, mapa=None):
+    # argv: the ship's arguments (sys.argv[1:] by default)
+    # mapa: an already loaded map, when the captain forks the ship without exec (--spawn fork)
     # Argument parser: reads command-line parameters sent by the captain
     ap = argparse.ArgumentParser(description="Pirate Ship (Step 4)")
-    ap.add_argument("--id", type=int, required=True, help="Ship ID assigned by captain")
+    ap.add_argument("--id", type=int, help="Ship ID assigned by captain")
     ap.add_argument("--map", type=str, default="map.txt", help="Map file path")
     ap.add_argument("--pos", type=int, nargs=2, metavar=("x", "y"), default=(0, 0), help="Initial position")
     ap.add_argument("--food", type=int, default=100, help="Initial food amount")
-    ap.add_argument("--random", type=int, nargs=2, metavar=("N", "s1"), help="Random mode (N steps, s1 seconds)")
+    ap.add_argument("--random", type=float, nargs=2, metavar=("N", "s1"), help="Random mode (N steps, s1 seconds)")
     ap.add_argument("--captain", action="store_true", help="Captain controls the ship")
     ap.add_argument("--pipe", type=int, help="Pipe file descriptor from captain (for IPC)")
     ap.add_argument("--ursula", type=str, help="Pipe for ursula.py,ursula_pipe")
+    ap.add_argument("--tile-budget", type=int, default=64, help="MB of map tiles kept in memory (.tiles maps)")
+    ap.add_argument("--shm", type=str, help="name of the shared memory map created by the captain")
+    ap.add_argument("--wire", choices=protocol.WIRES, default="binary", help="message format, text is for debugging")
+    ap.add_argument("--host", action="store_true", help="run the --ship ships in this process")
+    ap.add_argument("--ship", nargs="+", action="append", default=[], metavar="id x y [s1]", help="ship of the host")
+    ap.add_argument("--seed", type=str, help="random moves repeatable (and the same as simulation.py)")
+    log.add_arguments(ap)
+
+    args = ap.parse_args(argv)
+    if args.random:
+        args.random = (int(args.random[0]), args.random[1])
+    if args.id is None and not args.host:
+        ap.error("--id is required (or --host with --ship)")
 
-    args = ap.parse_args()
-    
+    global ursula_pipe
     ursula_pipe = args.ursula
+    transport.wire = args.wire
+    log.configure(args)
 
     # Prevent invalid combination of captain and random mode
     if args.captain and args.random:
         sys.exit("Cannot use --captain and --random together.")
 
     # Load map and validate starting position
-    mapa = Map(args.map)
+    if mapa is not None:
+        pass    # Forked by the captain without exec, the map it loaded is ours (copy-on-write)
+    elif args.shm:
+        mapa = SharedMap(args.shm)  # Attach to the captain's map, no file parsing
+    else:
+        mapa = open_map(args.map, args.tile_budget * 2**20)   # .tiles maps are read lazily
+    if mapa.shared:
+        # Released on every exit from here on, even before the ship is placed
+        atexit.register(mapa.close)
+    if args.host:
+        run_host(args, mapa)
     if not mapa.can_sail(args.pos[0], args.pos[1]):
         sys.exit("Invalid initial position.")
 
     # Create the ship object
     ship = Ship(args.id, mapa, args.pos, args.food, args.pipe)
+    if mapa.shared:
+        # The other fleets must stop seeing this ship when it exits (before mapa.close)
+        atexit.register(lambda: mapa.remove_ship(ship.pos[0], ship.pos[1]))
     global current_ship
     current_ship = ship
     if args.random:
-        ship.speed = args.random[1]
+        ship.speed = args.random[1]     # seconds, fractions too
+    if args.seed is not None:
+        ship.rng = ship_rng(args.seed, ship.shipId)
 
     # Starting message
-    print(f"Ship {ship.shipId} started with PID {ship.pid}", file=sys.stderr, flush=True)
-    # if ursula_pipe:
-    #     send_to_ursula(f"{ship.pid},INIT,{ship.pos[0]},{ship.pos[1]},{ship.food},{ship.gold}", ursula_pipe)
+    log.info(f"Ship {ship.shipId} started with PID {ship.pid}")
     if ursula_pipe:
-        init_msg = f"{ship.pid},INIT,{ship.pos[0]},{ship.pos[1]},{ship.food},{ship.gold}"
-        send_to_ursula(init_msg, ursula_pipe)
-        print("PRUEBA")
-        # print(f"mensaje de {ship.pid} :{init_msg}")
-        # try:
-        #     with open(ursula_pipe, "w") as fifo:
-        #         fifo.write(init_msg + "\n")
-        #         fifo.flush()
-        #         print("enviado ship")
-        # except OSError as e:
-        #     print(f"Error happened: {e}", file=sys.stderr)
+        send_to_ursula(ursula_pipe, protocol.INIT, ship.pid, ship.pos[0], ship.pos[1], ship.food, ship.gold)
+        # Whatever ends the ship (exit, SIGQUIT, no food, captain gone), Ursula stops counting it.
+        # Runs before transport.close_all, which flushes it
+        atexit.register(send_to_ursula, ursula_pipe, protocol.TERMINATE, ship.pid)
 
    
     # INSTALLATION OF SIGNAL HANDLERS
     
-    signal.signal(signal.SIGALRM, handler_sigalrm)  # For periodic movement
     signal.signal(signal.SIGUSR1, handler_sigusr1)  # Add food
     signal.signal(signal.SIGUSR2, handler_sigusr2)  # Subtract food/gold
     signal.signal(signal.SIGQUIT, handler_sigquit)  # Quit ship
@@ -276,30 +491,14 @@ if __name__ == "__main__":
         # Step 3: Captain sends commands manually
         ship.move_captain()
     elif args.random:
-        # Step 4: Automatic mode – move periodically by SIGALRM
-        os.alarm(ship.speed)  # Start periodic timer
-        while True:
-            try:
-                # Wait for signals (SIGALRM, SIGQUIT, etc.)
-                signal.pause()
-            except SystemExit:
-                break  # When the ship exits normally
+        # Step 4: Automatic mode – N moves, one every s1 seconds (timer wheel, no SIGALRM).
+        # The other signals (SIGQUIT, etc.) still arrive while it waits
+        run_random([ship], args.random[0])
 
     # Ship terminates and returns gold as exit code
     ship.speak(f"Ship {ship.shipId} (PID {ship.pid}) finished with {ship.gold} gold.")
     sys.exit(ship.gold)
-    
-    if ursula_pipe:
-        term_msg = f"{ship.pid},TERMINATE"
-        send_to_ursula(term_msg, ursula_pipe)
-        # try:
-        #     term_msg = f"{ship.pid},TERMINATE\n"
-        #     with open(ursula_pipe, "w") as fifo:
-        #         fifo.write(term_msg)
-        #         fifo.flush()
-        # except OSError as e:
-        #     print(f"Error happened: {e}", file=sys.stderr)
-           
-    sys.exit(ship.gold)
 
- 
\ No newline at end of file
+
+if __name__ == "__main__":
+    main()
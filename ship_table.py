@@ -0,0 +1,139 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Ship state of Ursula stored as columns (struct of arrays) instead of one dict
+# per ship. Each ship gets a row; pid -> row is kept in a dict and the rows of
+# terminated ships go to a free list to be reused by the next INIT.
+#
+# The columns are NumPy arrays when NumPy is installed, so fleet-wide totals
+# are vectorized reductions. Without NumPy they are array.array columns, which
+# still take 8 bytes per value instead of a Python object per field.
+
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+COLUMNS = ("pid", "x", "y", "food", "gold", "captain_pid", "alive")
+STARVING_FOOD = 5   #a ship with less food than this cannot move any more
+
+
+class ShipTable:
+    def __init__(self, capacity=1024):
+        self.capacity = 0
+        self.size = 0       #rows ever used, the free ones are below this too
+        self.rows = {}      #pid -> row
+        self.free = []      #rows of terminated ships, reused first
+        for name in COLUMNS:
+            setattr(self, name, self._column(0))
+        self._grow(capacity)
+
+    @staticmethod
+    def _column(n):
+        if np is not None:
+            return np.zeros(n, dtype=np.int64)
+        return array('q', bytes(8 * n))
+
+    def _grow(self, capacity):
+        for name in COLUMNS:
+            old = getattr(self, name)
+            if np is not None:
+                new = np.zeros(capacity, dtype=np.int64)
+                new[:self.capacity] = old
+            else:
+                new = old
+                new.extend(array('q', bytes(8 * (capacity - self.capacity))))
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, pid):
+        return pid in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def add(self, pid, x, y, food, gold, captain_pid=0):
+        #adds (or resets) a ship and returns its row
+        row = self.rows.get(pid)
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+            else:
+                if self.size == self.capacity:
+                    self._grow(self.capacity * 2)
+                row = self.size
+                self.size += 1
+            self.rows[pid] = row
+        self.pid[row] = pid
+        self.x[row] = x
+        self.y[row] = y
+        self.food[row] = food
+        self.gold[row] = gold
+        self.captain_pid[row] = captain_pid
+        self.alive[row] = 1
+        return row
+
+    def update(self, pid, x, y, food, gold):
+        row = self.rows[pid]
+        self.x[row] = x
+        self.y[row] = y
+        self.food[row] = food
+        self.gold[row] = gold
+        return row
+
+    def remove(self, pid):
+        row = self.rows.pop(pid)
+        self.alive[row] = 0
+        self.pid[row] = 0
+        self.free.append(row)
+        return row
+
+    def position(self, pid):
+        row = self.rows[pid]
+        return int(self.x[row]), int(self.y[row])
+
+    def get(self, pid):
+        #(x, y, food, gold) of a ship
+        row = self.rows[pid]
+        return int(self.x[row]), int(self.y[row]), int(self.food[row]), int(self.gold[row])
+
+    def items(self):
+        #(pid, (x, y, food, gold)) of every ship, in order of arrival
+        for pid in self.rows:
+            yield pid, self.get(pid)
+
+    # Fleet-wide totals
+
+    def _alive_mask(self):
+        return self.alive[:self.size] == 1
+
+    def total_gold(self):
+        #gold in circulation, in the hands of the ships
+        if np is not None:
+            return int(self.gold[:self.size][self._alive_mask()].sum())
+        gold = self.gold
+        return sum(gold[row] for row in self.rows.values())
+
+    def total_food(self):
+        if np is not None:
+            return int(self.food[:self.size][self._alive_mask()].sum())
+        food = self.food
+        return sum(food[row] for row in self.rows.values())
+
+    def starving(self, threshold=STARVING_FOOD):
+        #number of ships that cannot move any more
+        if np is not None:
+            return int(np.count_nonzero(self._alive_mask() & (self.food[:self.size] < threshold)))
+        food = self.food
+        return sum(1 for row in self.rows.values() if food[row] < threshold)
+
+    def nbytes(self):
+        #memory of the columns (not counting the pid -> row dict)
+        if np is not None:
+            return sum(getattr(self, name).nbytes for name in COLUMNS)
+        return sum(getattr(self, name).itemsize * len(getattr(self, name)) for name in COLUMNS)
@@ -0,0 +1,363 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Headless simulation of a fleet in one process: no Ursula, captain or ship
+# processes, no pipes and no sleeps. Good to try strategies on many seeds.
+#
+# Simulation (the exact engine) applies the same rules as the processes, one
+# move at a time:
+#   - random moves as Ship.move_randomly (5 food per move, 10 gold on an island,
+#     20 food on a port), each ship with the random stream of ship5.py --seed
+#     (ship_rng), driven by the same timer wheel (scheduler.py) without a clock
+#   - captain commands as send_command + Ship.move_once (command())
+#   - every move is a MOVE for Ursula's view of the fleet, fights and end of the
+#     world as Ursula.handle_fight / end_of_world, with the seed of ursula.py <pipe> <seed>
+#   - a ship that has done its steps leaves the map and Ursula's view, as the
+#     TERMINATE of the ship host
+# Ships due in the same tick move in the order of the wheel (the ships file at
+# the start), and the winner of a fight is drawn from the ships of the cell in
+# order of arrival, as Ursula does. For the same seed, map and ships file it ends
+# with the same gold, food and treasure as captain5.py --random --seed --hosts 1:
+# one ship host moves the whole fleet on one wheel and its MOVEs reach Ursula in
+# that order (benchmarks/check_simulation.py compares both). With a process per
+# ship the kernel decides which of the ships due in a tick Ursula hears first,
+# so the fights, and the treasure, can differ.
+#
+# BatchSimulation (needs NumPy) moves every ship that is due in a tick at once,
+# with vectorized arrays, for random walks of large fleets. It follows the same
+# rules but draws its own random numbers (numpy) and has one fight per crowded
+# cell per tick, so it is repeatable for a seed but not move by move equal to
+# the exact engine.
+#
+#   python3 simulation.py --map map.txt --ships ships.txt --steps 100 --seed 1 [--batch]
+
+import json
+import random
+import argparse
+
+import scheduler
+from map import Map
+from ship_table import ShipTable
+from ship5 import Ship, ship_rng
+from ursula import settle_fight
+from captain5 import read_ship_info
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+TREASURE = 100      #Ursula's gold at the start
+FOOD = 100          #food of a new ship
+MOVE_FOOD = 5       #food per move, a ship with less cannot move
+ISLAND_GOLD = 10
+PORT_FOOD = 20
+COMMANDS = {"up": (0, 1), "down": (0, -1), "right": (1, 0), "left": (-1, 0)}
+
+
+class SimShip:
+    __slots__ = ("shipId", "x", "y", "food", "gold", "speed", "rng")
+
+    def __init__(self, shipId, x, y, food, speed, rng):
+        self.shipId = shipId
+        self.x = x
+        self.y = y
+        self.food = food
+        self.gold = 0
+        self.speed = speed
+        self.rng = rng
+
+
+class Simulation:
+    def __init__(self, mapa, fleet, seed=0, treasure=TREASURE, food=FOOD):
+        #mapa: a Map of its own, the ships are set on it. fleet: [(shipId, x, y, speed)]
+        self.mapa = mapa
+        self.seed = seed
+        self.rng = random.Random(str(seed)) #Ursula's (ursula.py <pipe> <seed>), who wins the fights
+        self.treasure = treasure
+        self.running = True                 #False after the end of the world
+        self.table = ShipTable()            #Ursula's view of the fleet
+        self.cells = {}                     #(x, y) -> {ship id: None} in order of arrival, as Ursula.cells
+        self.ships = {}
+        self.moves = 0
+        self.fights = 0
+        for shipId, x, y, speed in fleet:
+            if not mapa.can_sail(x, y):
+                raise ValueError(f"Ship {shipId}: invalid initial position ({x},{y})")
+            ship = self.ships[shipId] = SimShip(shipId, x, y, food, speed, ship_rng(seed, shipId))
+            mapa.set_ship(x, y)
+            self.table.add(shipId, x, y, food, 0)      #INIT
+            self.cells.setdefault((x, y), {})[shipId] = None
+
+    # Ursula
+
+    def report_move(self, ship):
+        #MOVE of a ship: Ursula takes its food and gold and checks for a fight
+        if not self.running:
+            return
+        shipId = ship.shipId
+        self.unplace(shipId)
+        self.cells.setdefault((ship.x, ship.y), {})[shipId] = None
+        self.table.update(shipId, ship.x, ship.y, ship.food, ship.gold)
+        self.fight(shipId, ship.x, ship.y)
+
+    def report_terminate(self, ship):
+        #TERMINATE of a ship: no more fights in its cell
+        if self.running:
+            self.unplace(ship.shipId)
+            self.table.remove(ship.shipId)
+
+    def unplace(self, shipId):
+        old = self.table.position(shipId)
+        cell = self.cells[old]
+        cell.pop(shipId)
+        if not cell:
+            del self.cells[old]
+
+    def fight(self, shipId, x, y):
+        #Ursula.handle_fight without the messages
+        others = [pid for pid in self.cells.get((x, y), ()) if pid != shipId]
+        if not others:
+            return
+        fighters = others + [shipId]
+        winner = self.rng.choice(fighters)
+        rows = self.table.rows
+        _, needed = settle_fight(self.table.food, self.table.gold, rows[winner],
+                                 [rows[pid] for pid in fighters if pid != winner])
+        self.fights += 1
+        if needed > 0:
+            if self.treasure >= needed:
+                self.treasure -= needed
+            else:
+                self.running = False    #end of the world, Ursula stops listening
+
+    # Ships
+
+    def move_randomly(self, ship):
+        #Ship.move_randomly
+        if ship.food < MOVE_FOOD:
+            return
+        dx, dy = ship.rng.choice(Ship.DIRECTIONS)
+        x, y = ship.x + dx, ship.y + dy
+        if not self.mapa.can_sail(x, y):
+            return
+        self.mapa.remove_ship(ship.x, ship.y)
+        ship.x, ship.y = x, y
+        self.mapa.set_ship(x, y)
+        ship.food -= MOVE_FOOD
+        where = self.mapa.get_cell_type(x, y)
+        if where == Map.BAR:
+            ship.gold += ISLAND_GOLD
+        elif where == Map.HOME:
+            ship.food += PORT_FOOD
+        self.moves += 1
+        self.report_move(ship)
+
+    def command(self, shipId, *commands):
+        #a command frame of the captain (send_command): checked as dispatch does,
+        #then the moves one by one as Ship.move_once. OK, NOK, or None if not sent
+        ship = self.ships.get(shipId)
+        if ship is None or any(command not in COMMANDS for command in commands):
+            return None
+        x, y = ship.x, ship.y
+        taken = {(other.x, other.y) for other in self.ships.values() if other is not ship}
+        for command in commands:
+            dx, dy = COMMANDS[command]
+            x, y = x + dx, y + dy
+            if self.mapa.get_cell_type(x, y) == Map.ROCK or (x, y) in taken:
+                return None
+        for command in commands:
+            if ship.food < MOVE_FOOD:
+                return "NOK"
+            dx, dy = COMMANDS[command]
+            x, y = ship.x + dx, ship.y + dy
+            if not self.mapa.can_sail(x, y):
+                return "NOK"
+            self.mapa.remove_ship(ship.x, ship.y)
+            ship.x, ship.y = x, y
+            self.mapa.set_ship(x, y)
+            ship.food -= MOVE_FOOD
+            self.moves += 1
+            self.report_move(ship)
+        return "OK"
+
+    def finish(self, ship):
+        #ShipHost.remove, once a ship has done its steps
+        self.mapa.remove_ship(ship.x, ship.y)
+        self.report_terminate(ship)
+
+    def run(self, steps):
+        #every ship makes steps random moves, one every ship.speed seconds (virtual time),
+        #then leaves
+        wheel = scheduler.TimerWheel()
+        left = {}
+        for ship in self.ships.values():
+            left[ship.shipId] = steps
+            wheel.schedule(ship.speed, ship)
+        ticks = 0
+        while len(wheel):
+            ticks = wheel.next_tick()
+            for due, ship in wheel.expired(ticks):
+                self.move_randomly(ship)
+                left[ship.shipId] -= 1
+                if left[ship.shipId] > 0:
+                    wheel.schedule(ship.speed, ship, due)
+                else:
+                    self.finish(ship)
+        return self.result(ticks)
+
+    def result(self, ticks=0):
+        ships = {shipId: {"x": s.x, "y": s.y, "food": s.food, "gold": s.gold} for shipId, s in self.ships.items()}
+        return {
+            "seconds": ticks * scheduler.TICK,
+            "moves": self.moves,
+            "fights": self.fights,
+            "treasure": self.treasure,
+            "end_of_world": not self.running,
+            "gold": sum(s["gold"] for s in ships.values()),
+            "food": sum(s["food"] for s in ships.values()),
+            "ships": ships,
+        }
+
+
+class BatchSimulation:
+    #random walks of the whole fleet with NumPy, every ship due in a tick moves at once
+    def __init__(self, mapa, fleet, seed=0, treasure=TREASURE, food=FOOD):
+        if np is None:
+            raise ImportError("BatchSimulation needs NumPy")
+        grid = mapa.as_array()
+        self.width, self.height = mapa.width, mapa.height
+        self.rock = grid == ord(Map.ROCK)
+        self.island = np.isin(grid, (ord(Map.ISLAND), ord(Map.BAR)))
+        self.port = np.isin(grid, (ord(Map.PORT), ord(Map.HOME)))
+        self.dx = np.array([dx for dx, dy in Ship.DIRECTIONS])
+        self.dy = np.array([dy for dx, dy in Ship.DIRECTIONS])
+        self.rng = np.random.default_rng(random.Random(str(seed)).getrandbits(64))
+        self.treasure = treasure
+        self.running = True
+        self.moves = 0
+        self.fights = 0
+
+        self.ids = [shipId for shipId, x, y, speed in fleet]
+        self.x = np.array([x for _, x, _, _ in fleet], dtype=np.int64)
+        self.y = np.array([y for _, _, y, _ in fleet], dtype=np.int64)
+        if np.any(self.rock[self.y, self.x]):
+            raise ValueError("a ship starts on a rock")
+        self.food = np.full(len(fleet), food, dtype=np.int64)
+        self.gold = np.zeros(len(fleet), dtype=np.int64)
+        self.ursula_food = self.food.copy()     #Ursula's view, as in Simulation.table
+        self.ursula_gold = self.gold.copy()
+        self.period = np.array([max(1, round(speed / scheduler.TICK)) for _, _, _, speed in fleet], dtype=np.int64)
+
+    def tick(self, movers):
+        idx = movers[self.food[movers] >= MOVE_FOOD]
+        d = self.rng.integers(0, len(self.dx), idx.size)
+        nx, ny = self.x[idx] + self.dx[d], self.y[idx] + self.dy[d]
+        ok = (nx >= 0) & (nx < self.width) & (ny >= 0) & (ny < self.height)
+        ok[ok] = ~self.rock[ny[ok], nx[ok]]
+        idx, nx, ny = idx[ok], nx[ok], ny[ok]
+        self.x[idx], self.y[idx] = nx, ny
+        self.food[idx] -= MOVE_FOOD
+        self.gold[idx] += ISLAND_GOLD * self.island[ny, nx]
+        self.food[idx] += PORT_FOOD * self.port[ny, nx]
+        self.moves += idx.size
+        if self.running and idx.size:
+            self.ursula_food[idx] = self.food[idx]
+            self.ursula_gold[idx] = self.gold[idx]
+            self.fight(idx)
+
+    def fight(self, moved):
+        #one fight in every cell with more than one ship where a ship has arrived.
+        #a ship is in one cell only, so all the fights of the tick are settled at once
+        cells = self.y * self.width + self.x
+        order = np.argsort(cells, kind="stable")
+        sorted_cells = cells[order]
+        starts = np.flatnonzero(np.concatenate(([True], sorted_cells[1:] != sorted_cells[:-1])))
+        lengths = np.diff(np.append(starts, len(cells)))
+        arrived = np.zeros(len(cells), dtype=bool)
+        arrived[moved] = True
+        run_of = np.repeat(np.arange(len(starts)), lengths)     #run of every position of order
+        crowded = (lengths > 1) & (np.bincount(run_of, weights=arrived[order], minlength=len(starts)) > 0)
+        if not crowded.any():
+            return
+        crowded_runs = np.flatnonzero(crowded)
+        in_fight = crowded[run_of]
+        fighters = order[in_fight]
+        fight_of = np.searchsorted(crowded_runs, run_of[in_fight])     #fight of every fighter
+        winners = order[starts[crowded_runs] + self.rng.integers(0, lengths[crowded_runs])]
+        losers = fighters != winners[fight_of]
+        # settle_fight in every cell. Ursula pays fight after fight, the first one she
+        # cannot pay is still settled and then it is the end of the world
+        gold_lost = np.minimum(10, self.ursula_gold[fighters])
+        needed = np.bincount(fight_of[losers], weights=(10 - gold_lost)[losers], minlength=len(crowded_runs))
+        paid = np.cumsum(needed.astype(np.int64))
+        settled = len(crowded_runs)
+        if paid[-1] > self.treasure:
+            settled = int(np.searchsorted(paid, self.treasure, "right")) + 1
+            self.running = False
+        losers &= fight_of < settled
+        self.ursula_gold[winners[:settled]] += 10
+        self.ursula_food[fighters[losers]] = np.maximum(0, self.ursula_food[fighters[losers]] - 10)
+        self.ursula_gold[fighters[losers]] -= gold_lost[losers]
+        paid_fights = settled if self.running else settled - 1
+        if paid_fights:
+            self.treasure -= int(paid[paid_fights - 1])
+        self.fights += settled
+
+    def run(self, steps):
+        groups = {int(p): np.flatnonzero(self.period == p) for p in np.unique(self.period)}
+        t = 0
+        while True:
+            due = [(t // p + 1) * p for p in groups if t // p + 1 <= steps]
+            if not due:
+                break
+            t = min(due)
+            self.tick(np.concatenate([idx for p, idx in groups.items() if t % p == 0]))
+        return self.result(t)
+
+    def result(self, ticks=0):
+        ships = {shipId: {"x": int(self.x[i]), "y": int(self.y[i]), "food": int(self.food[i]), "gold": int(self.gold[i])}
+                 for i, shipId in enumerate(self.ids)}
+        return {
+            "seconds": ticks * scheduler.TICK,
+            "moves": int(self.moves),
+            "fights": self.fights,
+            "treasure": int(self.treasure),
+            "end_of_world": not self.running,
+            "gold": int(self.gold.sum()),
+            "food": int(self.food.sum()),
+            "ships": ships,
+        }
+
+
+def load_fleet(path):
+    #[(shipId, x, y, speed)] from a ships file, as the captain reads it
+    return [(int(shipId), int(x), int(y), float(speed)) for shipId, x, y, speed in read_ship_info(path)]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Headless, repeatable simulation of a fleet in random mode")
+    ap.add_argument("--map", type=str, default="map.txt", help="map file path")
+    ap.add_argument("--ships", type=str, default="ships.txt", help="ship info file path")
+    ap.add_argument("--steps", type=int, default=100, help="random moves of every ship")
+    ap.add_argument("--seed", type=str, default="0", help="same seed as captain5.py --seed / ursula.py")
+    ap.add_argument("--treasure", type=int, default=TREASURE, help="Ursula's gold at the start")
+    ap.add_argument("--batch", action="store_true", help="vectorized engine (NumPy), not move by move equal")
+    ap.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = ap.parse_args()
+
+    fleet = load_fleet(args.ships)
+    engine = BatchSimulation if args.batch else Simulation
+    result = engine(Map(args.map), fleet, args.seed, args.treasure).run(args.steps)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    for shipId, ship in result["ships"].items():
+        print(f"Ship {shipId}: pos=({ship['x']},{ship['y']}), food={ship['food']}, gold={ship['gold']}")
+    print(f"Moves: {result['moves']}, fights: {result['fights']}, {result['seconds']:.2f} s of sea time")
+    print(f"Treasure: {result['treasure']}, gold: {result['gold']}, food: {result['food']}"
+          + (", end of the world" if result["end_of_world"] else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Spatial index of a Map: which ships, ports and islands are near a cell,
+# without scanning the whole grid or the whole fleet.
+#
+# The sea is cut into square buckets of BUCKET x BUCKET cells. Every bucket
+# keeps its ports and islands (built once from the terrain, again when
+# set_terrain changes it) and its ships, with how many share a cell. The ships
+# are kept up to date by Map.set_ship / remove_ship. A query only looks at the
+# buckets that touch its box. A TiledMap has its ports and islands in the tile
+# file, so building the buckets reads no tiles.
+#
+# A SharedMap has the ships of every fleet in its occupancy layer, changed by
+# other processes, so there the ships are not kept in buckets. A query reads the
+# occupancy bytes of the rows of its box instead.
+#
+# Distances are straight lines (Euclidean), ties go by y and then x.
+#
+#   mapa.within_radius(x, y, r, "island")     #[(x, y), ...] nearest first
+#   mapa.within_box(x0, y0, x1, y1, "ship")
+#   mapa.k_nearest(x, y, 3, "port")
+#
+# The captain asks them with near x y r, box x0 y0 x1 y1 and closest x y k kind.
+
+BUCKET = 16     #cells per side of a bucket
+KINDS = ("ship", "port", "island")
+
+
+class SpatialIndex:
+    def __init__(self, mapa, bucket=BUCKET):
+        self.mapa = mapa
+        self.bucket = bucket
+        self.revision = None    #terrain_revision of the features
+        self.features = {}      #"port"/"island" -> {(bx, by): [(x, y), ...]}
+        self.ships = {}         #(bx, by) -> {(x, y): ships in the cell}
+        if not mapa.shared:
+            for cell_type in (mapa.SHIP, mapa.HOME, mapa.BAR):
+                for x, y in mapa.cells_of_type(cell_type):
+                    self.add_ship(x, y, 1)
+
+    def _load_features(self):
+        #ports and islands, with or without a ship on them (as pathfinding.TARGETS)
+        mapa = self.mapa
+        size = self.bucket
+        self.features = {}
+        for kind, cell_types in (("port", (mapa.PORT, mapa.HOME)), ("island", (mapa.ISLAND, mapa.BAR))):
+            buckets = self.features[kind] = {}
+            for cell_type in cell_types:
+                for x, y in mapa.cells_of_type(cell_type):
+                    buckets.setdefault((x // size, y // size), []).append((x, y))
+        self.revision = mapa.terrain_revision
+
+    def add_ship(self, x, y, delta):
+        #a ship arrives (delta 1) or leaves (delta -1) the cell, from Map.set_ship / remove_ship
+        key = (x // self.bucket, y // self.bucket)
+        cells = self.ships.get(key)
+        if cells is None:
+            if delta <= 0:
+                return
+            cells = self.ships[key] = {}
+        count = cells.get((x, y), 0) + delta
+        if count > 0:
+            cells[(x, y)] = count
+        else:
+            cells.pop((x, y), None)
+            if not cells:
+                del self.ships[key]
+
+    # Queries
+
+    def within_box(self, x0, y0, x1, y1, kind):
+        #cells of kind with x0 <= x <= x1 and y0 <= y <= y1, in order of y and x
+        if kind not in KINDS:
+            raise ValueError(f"unknown kind '{kind}', one of {', '.join(KINDS)}")
+        mapa = self.mapa
+        if x0 > x1:
+            x0, x1 = x1, x0
+        if y0 > y1:
+            y0, y1 = y1, y0
+        x0, y0, x1, y1 = max(0, x0), max(0, y0), min(mapa.width - 1, x1), min(mapa.height - 1, y1)
+        if x0 > x1 or y0 > y1:
+            return []
+        if kind == "ship" and mapa.shared:
+            return self._scan_ships(x0, y0, x1, y1)
+        if kind == "ship":
+            buckets = self.ships
+        else:
+            if self.revision != mapa.terrain_revision:
+                self._load_features()
+            buckets = self.features[kind]
+        size = self.bucket
+        found = []
+        for by in range(y0 // size, y1 // size + 1):
+            for bx in range(x0 // size, x1 // size + 1):
+                cells = buckets.get((bx, by))
+                if cells:
+                    found += [(x, y) for x, y in cells if x0 <= x <= x1 and y0 <= y <= y1]
+        found.sort(key=lambda cell: (cell[1], cell[0]))
+        return found
+
+    def _scan_ships(self, x0, y0, x1, y1):
+        #ships of every fleet of a SharedMap, one row of its occupancy layer at a time
+        from shared_map import OCCUPIED     #here, shared_map imports map, which imports this module
+        occupancy, width = self.mapa.occupancy, self.mapa.width
+        found = []
+        for y in range(y0, y1 + 1):
+            row = bytes(occupancy[y * width + x0:y * width + x1 + 1]).translate(OCCUPIED)
+            x = row.find(1)
+            while x >= 0:
+                found.append((x0 + x, y))
+                x = row.find(1, x + 1)
+        return found
+
+    def within_radius(self, x, y, r, kind):
+        #cells of kind at a distance of at most r from (x, y), nearest first
+        found = []
+        for cx, cy in self.within_box(x - r, y - r, x + r, y + r, kind):
+            distance = (cx - x) ** 2 + (cy - y) ** 2
+            if distance <= r * r:
+                found.append((distance, cy, cx))
+        found.sort()
+        return [(cx, cy) for _, cy, cx in found]
+
+    def k_nearest(self, x, y, k, kind):
+        #the k cells of kind nearest to (x, y), nearest first. The radius doubles until it
+        #holds k cells (nothing outside it can be nearer) or the whole map
+        if k <= 0:
+            return []
+        mapa = self.mapa
+        farthest = max(x, mapa.width - 1 - x) ** 2 + max(y, mapa.height - 1 - y) ** 2
+        r = self.bucket
+        while True:
+            found = self.within_radius(x, y, r, kind)
+            if len(found) >= k or r * r >= farthest:
+                return found[:k]
+            r *= 2
+
+    def ships_at(self, x, y):
+        #ships in the cell, of every fleet on a SharedMap
+        if self.mapa.shared:
+            return self.mapa.ships_at(x, y)
+        return self.ships.get((x // self.bucket, y // self.bucket), {}).get((x, y), 0)
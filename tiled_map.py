@@ -0,0 +1,321 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Map for seas larger than RAM.
+#
+# The sea is stored in a tile file (.tiles): a header followed by fixed-size
+# square tiles of tile_size x tile_size cells, one after the other. Tiles are
+# read the first time can_sail / get_cell_type touch them and kept in an LRU
+# cache limited by a memory budget. Tiles changed by set_terrain are written
+# back to the file when they are evicted (or on flush). Hits and misses are
+# counted so the budget can be sized.
+#
+# Ships are not terrain: set_ship / remove_ship only change an occupancy layer
+# in memory (cell -> number of ships, as the occupancy layer of SharedMap), so
+# the file never keeps the ships of a fleet that is gone.
+#
+# Only one process should open the file writable (the captain). Ships open it
+# read-only: tiles they change with set_terrain stay pinned in memory instead
+# of being written.
+#
+# After the tiles the file keeps the ports and islands (FEATURES, then one CELL
+# each), found while building it and rewritten by flush when set_terrain changes
+# them. They are few, so they are loaded whole: the spatial index and route
+# planning get them without reading every tile.
+#
+# Building the tile file from a text map reads tile_size rows at a time, so it
+# also works with maps that do not fit in memory:
+#   python3 tiled_map.py build map.txt sea.tiles --tile-size 256
+#   python3 captain5.py --map sea.tiles ...
+
+import os
+import sys
+import struct
+import argparse
+from collections import OrderedDict
+
+from map import Map, find_all
+
+TILE_SUFFIX = ".tiles"
+TILE_MAGIC = b"SEAT"
+TILE_VERSION = 2    #2: ports and islands after the tiles
+TILE_HEADER = struct.Struct("<4sHHIII")     #magic, version, 0, width, height, tile_size
+FEATURES = struct.Struct("<II")             #number of ports, number of islands
+CELL = struct.Struct("<II")                 #x, y
+FEATURE_TYPES = (ord(Map.PORT), ord(Map.ISLAND))
+TILE_DATA_OFFSET = 4096
+DEFAULT_BUDGET = 64 * 1024 * 1024           #bytes of tiles kept in memory
+
+
+def build_tiles(src_filename, path, tile_size=256):
+    #converts a text map file into a tile file, tile_size rows at a time
+    with open(src_filename, 'rb') as src:
+        rows = (line.strip() for line in src)
+        rows = (row for row in rows if row)
+        first = next(rows, b'')
+        width = len(first)
+        height = 0
+        tiles_x = -(-width // tile_size) if width else 0
+        features = {kind: [] for kind in FEATURE_TYPES}
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as out:
+            out.write(b'\0' * TILE_DATA_OFFSET)
+            band = [first] if first else []
+            for row in rows:
+                band.append(row)
+                if len(band) == tile_size:
+                    height += _write_band(out, band, width, tile_size, tiles_x, height, features)
+                    band = []
+            if band:
+                height += _write_band(out, band, width, tile_size, tiles_x, height, features)
+            _write_features(out, features)
+            out.seek(0)
+            out.write(TILE_HEADER.pack(TILE_MAGIC, TILE_VERSION, 0, width, height, tile_size))
+    os.replace(tmp, path)
+    return width, height
+
+
+def _write_band(out, band, width, tile_size, tiles_x, y0, features):
+    #writes one row of tiles, cells outside the map are rocks. Adds its ports and islands
+    for y, row in enumerate(band, y0):
+        if len(row) != width:
+            raise ValueError("All rows in the map must have the same length")
+        for kind, cells in features.items():
+            cells += [(x, y) for x in find_all(row, kind)]
+    padded = [row.ljust(tiles_x * tile_size, Map.ROCK.encode()) for row in band]
+    padded += [Map.ROCK.encode() * (tiles_x * tile_size)] * (tile_size - len(band))
+    for tx in range(tiles_x):
+        start = tx * tile_size
+        out.write(b''.join(row[start:start + tile_size] for row in padded))
+    return len(band)
+
+
+def _write_features(out, features):
+    #at the current position, the end of the file
+    cells = [features[kind] for kind in FEATURE_TYPES]
+    out.write(FEATURES.pack(*map(len, cells)))
+    out.write(b''.join(CELL.pack(x, y) for group in cells for x, y in sorted(group, key=lambda c: (c[1], c[0]))))
+    out.truncate()
+
+
+class TiledMap(Map):
+    def __init__(self, filename, budget=DEFAULT_BUDGET, writable=False):
+        self.filename = filename
+        self.writable = writable
+        self.file = open(filename, 'r+b' if writable else 'rb')
+        magic, version, _, self.width, self.height, self.tile_size = TILE_HEADER.unpack(self.file.read(TILE_HEADER.size))
+        if magic != TILE_MAGIC:
+            self.file.close()
+            raise ValueError(f"'{filename}' is not a tile map")
+        if version != TILE_VERSION:
+            self.file.close()
+            raise ValueError(f"'{filename}' is a version {version} tile map, build it again (version {TILE_VERSION})")
+        self.tiles_x = -(-self.width // self.tile_size)
+        self.tile_bytes = self.tile_size * self.tile_size
+        self.features = self._read_features()   #P/I byte -> {(x, y), ...}
+        self.features_dirty = False
+        self.max_tiles = max(1, budget // self.tile_bytes)
+        self.tiles = OrderedDict()  #(tx, ty) -> bytearray, least recently used first
+        self.dirty = set()          #tiles changed by set_terrain, not written yet
+        self.occupancy = {}         #(x, y) -> ships in the cell
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    def _tile(self, tx, ty):
+        key = (tx, ty)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return tile
+        self.misses += 1
+        tile = self._read_tile(tx, ty)
+        self.tiles[key] = tile
+        while len(self.tiles) > self.max_tiles:
+            # Least recently used first; read-only maps cannot drop a changed tile
+            old_key = next((k for k in self.tiles if self.writable or k not in self.dirty), None)
+            if old_key is None:
+                break
+            old_tile = self.tiles.pop(old_key)
+            self.evictions += 1
+            if old_key in self.dirty:
+                self._write_tile(old_key, old_tile)
+        return tile
+
+    def _offset(self, tx, ty):
+        return TILE_DATA_OFFSET + (ty * self.tiles_x + tx) * self.tile_bytes
+
+    def _features_offset(self):
+        return self._offset(0, -(-self.height // self.tile_size))
+
+    def _read_features(self):
+        self.file.seek(self._features_offset())
+        counts = FEATURES.unpack(self.file.read(FEATURES.size))
+        features = {}
+        for kind, count in zip(FEATURE_TYPES, counts):
+            data = self.file.read(count * CELL.size)
+            features[kind] = set(CELL.iter_unpack(data))
+        return features
+
+    def _read_tile(self, tx, ty):
+        self.file.seek(self._offset(tx, ty))
+        return bytearray(self.file.read(self.tile_bytes))
+
+    def _write_tile(self, key, tile):
+        self.file.seek(self._offset(*key))
+        self.file.write(tile)
+        self.dirty.discard(key)
+        self.writebacks += 1
+
+    def _cell(self, x, y):
+        #(tile, index in the tile) of a cell inside the map
+        size = self.tile_size
+        return self._tile(x // size, y // size), (y % size) * size + x % size
+
+    def can_sail(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            tile, i = self._cell(x, y)
+            return tile[i] != Map.ROCK_BYTE
+        return False
+
+    def get_cell_type(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            tile, i = self._cell(x, y)
+            cell = tile[i]
+            if (x, y) in self.occupancy:
+                cell = Map.ARRIVE.get(cell, cell)
+            return chr(cell)
+        return None
+
+    def set_ship(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.occupancy[(x, y)] = self.occupancy.get((x, y), 0) + 1
+            if self.index is not None:
+                self.index.add_ship(x, y, 1)
+            return True
+        return None
+
+    def remove_ship(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            count = self.occupancy.pop((x, y), 0) - 1
+            if count > 0:
+                self.occupancy[(x, y)] = count
+            if self.index is not None:
+                self.index.add_ship(x, y, -1)
+        return None
+
+    def set_terrain(self, x, y, cell_type):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            tile, i = self._cell(x, y)
+            if tile[i] in self.features:
+                self.features[tile[i]].discard((x, y))
+                self.features_dirty = True
+            tile[i] = ord(cell_type)
+            if tile[i] in self.features:
+                self.features[tile[i]].add((x, y))
+                self.features_dirty = True
+            self.dirty.add((x // self.tile_size, y // self.tile_size))
+            self.terrain_revision += 1
+            return True
+        return None
+
+    def cells_of_type(self, cell_type):
+        #S, H and B are the occupied W, P and I cells, from the occupancy layer. Ports and
+        #islands come from the features. Water and rocks scan every tile (tiles not in the
+        #cache are read but not cached), minus the occupied
+        kind = ord(cell_type)
+        if kind in Map.LEAVE:
+            terrain = Map.LEAVE[kind]
+            if terrain in self.features:
+                found = [cell for cell in self.occupancy if cell in self.features[terrain]]
+            else:
+                found = [(x, y) for x, y in self.occupancy if self._terrain(x, y) == terrain]
+        elif kind in self.features:
+            found = [cell for cell in self.features[kind] if cell not in self.occupancy]
+        else:
+            found = [cell for cell in self._scan(kind) if cell not in self.occupancy]
+        found.sort(key=lambda cell: (cell[1], cell[0]))
+        return found
+
+    def _terrain(self, x, y):
+        tile, i = self._cell(x, y)
+        return tile[i]
+
+    def _scan(self, kind):
+        size = self.tile_size
+        for ty in range(-(-self.height // size)):
+            for tx in range(self.tiles_x):
+                tile = self.tiles.get((tx, ty)) or self._read_tile(tx, ty)
+                for i in find_all(tile, kind):
+                    x, y = tx * size + i % size, ty * size + i // size
+                    if x < self.width and y < self.height:
+                        yield x, y
+
+    def as_array(self):
+        raise TypeError("a tiled map is never in memory as a whole, it has no array view")
+
+    def flush(self):
+        #writes every modified tile back to the file
+        if not self.writable:
+            return
+        for key in sorted(self.dirty):
+            self._write_tile(key, self.tiles[key])
+        if self.features_dirty:
+            self.file.seek(self._features_offset())
+            _write_features(self.file, self.features)
+            self.features_dirty = False
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "tiles_cached": len(self.tiles),
+            "max_tiles": self.max_tiles,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "writebacks": self.writebacks,
+        }
+
+    def __str__(self):
+        return '\n'.join(''.join(self.get_cell_type(x, y) for x in range(self.width)) for y in range(self.height))
+
+
+def open_map(filename, budget=DEFAULT_BUDGET, writable=False):
+    #TiledMap for a .tiles file, the in-memory Map for anything else
+    if filename.endswith(TILE_SUFFIX):
+        return TiledMap(filename, budget, writable)
+    return Map(filename)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Tile maps for seas larger than RAM")
+    sub = ap.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="convert a text map into a tile file")
+    build.add_argument("source", help="text map file")
+    build.add_argument("tiles", help="tile file to write (.tiles)")
+    build.add_argument("--tile-size", type=int, default=256, help="cells per tile side")
+    info = sub.add_parser("info", help="show the header of a tile file")
+    info.add_argument("tiles", help="tile file")
+    args = ap.parse_args()
+
+    if args.command == "build":
+        width, height = build_tiles(args.source, args.tiles, args.tile_size)
+        print(f"Built {args.tiles}: {width}x{height} in tiles of {args.tile_size}x{args.tile_size}", file=sys.stderr)
+    else:
+        mapa = TiledMap(args.tiles)
+        ports, islands = (len(mapa.features[kind]) for kind in FEATURE_TYPES)
+        print(f"{args.tiles}: {mapa.width}x{mapa.height}, tiles of {mapa.tile_size}x{mapa.tile_size}, "
+              f"{ports} ports, {islands} islands")
+        mapa.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# Design of Telematics Systems 2025-26
+# Universidad Carlos III de Madrid
+#
+# Connections from captains and ships to Ursula.
+#
+# The old code opened the named pipe, wrote one line and closed it for every
+# message. Each close could leave Ursula without writers, so her reader hit EOF
+# and had to reopen the FIFO. Here every process keeps one writer open for its
+# whole life and sends many messages through it.
+#
+# Writes to a FIFO are only atomic up to PIPE_BUF bytes, so the buffer is
+# flushed before it would go over that size. That way the messages of
+# different captains and ships never get mixed.
+#
+# Messages go in the binary records of protocol.py, or as text lines when the
+# module variable wire is "text" (set from the --wire argument).
+#
+# The --ursula argument chooses the transport:
+#   --ursula sea_pipe             named pipe (FIFO), the original transport
+#   --ursula unix:/tmp/sea.sock   Unix domain socket, one connection per process
+
+import os
+import atexit
+import select
+import socket
+import protocol
+import log
+
+PIPE_BUF = getattr(select, "PIPE_BUF", 512)
+SOCKET_PREFIX = "unix:"
+
+wire = "binary"     #"binary" or "text" (debug)
+
+
+def socket_path(target):
+    #returns the socket path of a unix: target, None for a FIFO
+    if target.startswith(SOCKET_PREFIX):
+        return target[len(SOCKET_PREFIX):]
+    return None
+
+
+class FifoWriter:
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.buffer = bytearray()
+
+    def open(self):
+        #blocks until Ursula has the FIFO open for reading
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_WRONLY)
+        return self
+
+    def send(self, message, flush=True):
+        #queues one text line, flush=False lets the caller batch several messages
+        self.send_bytes((message + "\n").encode(), flush)
+
+    def send_bytes(self, data, flush=True):
+        #data is one whole message, it is never split between two writes
+        if len(self.buffer) + len(data) > PIPE_BUF:
+            self.flush()
+        self.buffer += data
+        if flush:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        try:
+            self._write_buffer()
+        except BrokenPipeError:
+            #Ursula closed her end (restart), reopen once and retry
+            self.close(flush=False)
+            self._write_buffer()
+
+    def _write_buffer(self):
+        #the buffer is never bigger than PIPE_BUF, so this write is atomic
+        self.open()
+        written = os.write(self.fd, self.buffer)
+        del self.buffer[:written]
+
+    def close(self, flush=True):
+        if flush:
+            try:
+                self.flush()
+            except OSError as e:
+                log.error(f"Error happened: {e}")
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+
+class SocketWriter:
+    #same interface as FifoWriter, over a Unix domain socket connection.
+    #there is no PIPE_BUF limit here, every connection is its own stream
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.buffer = bytearray()
+
+    def open(self):
+        if self.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self.sock = sock
+        return self
+
+    def send(self, message, flush=True):
+        self.send_bytes((message + "\n").encode(), flush)
+
+    def send_bytes(self, data, flush=True):
+        self.buffer += data
+        if flush or len(self.buffer) >= SocketWriter.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self.open()
+        #sendall blocks while Ursula's receive buffer is full (backpressure)
+        self.sock.sendall(self.buffer)
+        self.buffer.clear()
+
+    def close(self, flush=True):
+        if flush:
+            try:
+                self.flush()
+            except OSError as e:
+                log.error(f"Error happened: {e}")
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+_writers = {}   #one writer per Ursula target and process
+
+
+def get_writer(target):
+    writer = _writers.get(target)
+    if writer is None:
+        path = socket_path(target)
+        if path is not None:
+            writer = SocketWriter(path)
+        else:
+            writer = FifoWriter(target)
+        _writers[target] = writer
+    return writer
+
+
+def send_to_ursula(message, target, flush=True):
+    #sends a text line as it is, whatever the wire format
+    get_writer(target).send(message, flush)
+
+
+def send_record(target, msg_type, pid, x=0, y=0, food=0, gold=0, flush=True):
+    #sends one message to Ursula in the current wire format
+    get_writer(target).send_bytes(protocol.encode(wire, msg_type, pid, x, y, food, gold), flush)
+
+
+def after_fork():
+    #in a child forked without exec: the connections belong to the parent, the
+    #child drops its copies (nothing is flushed twice) and opens its own ones
+    for writer in _writers.values():
+        writer.buffer.clear()
+        writer.close(flush=False)
+    _writers.clear()
+
+
+@atexit.register
+def close_all():
+    for writer in _writers.values():
+        writer.close()
+    _writers.clear()
+
+
+def open_fifo_reader(path):
+    #opens the FIFO for reading and keeps a dummy writer of our own, so the
+    #reader never sees EOF when the last captain or ship closes its end
+    read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    dummy_fd = os.open(path, os.O_WRONLY)
+    os.set_blocking(read_fd, True)
+    return read_fd, dummy_fd
@@ -1,152 +1,457 @@
+# Ursula, the sea witch: keeps the state of every ship, settles the fights and pays
+# from her treasure.
+#
+# Metrics: counters of messages by type, parse errors, fights, payouts, the time to
+# handle every message (histogram) and the bytes waiting to be handled (queue).
+# They are written on SIGUSR1 to stderr and, with --stats unix:<path>, to every
+# connection to that socket, as JSON or Prometheus text (--stats-format):
+#   python3 ursula.py sea_pipe --stats unix:/tmp/ursula-stats.sock --no-status
+#   nc -U /tmp/ursula-stats.sock
+# --no-status drops the dump of every ship after every MOVE.
+#
+# Logs go through log.py: --log-level, --quiet and --log-rate lines/s of moves,
+# fights... With --quiet the ships are dumped every --status-interval seconds
+# instead of after every MOVE.
+#
+# With --journal <path> every message that changes the state and every fight
+# outcome is appended to a journal (journal.py), one fsync per wakeup, with a
+# snapshot every --snapshot-every events. A new Ursula with the same --journal
+# starts from where the old one died:
+#   python3 ursula.py sea_pipe --journal /var/tmp/ursula.journal
+# --keep-journal archives the old journals instead of emptying them, the whole
+# game for analytics.py.
+#
+# With --shards N --map <map> the sea is split into N regions, each one with its
+# own Ursula process, behind a router (shards.py).
+#
+# With --tick <seconds> the fights are not settled as every MOVE arrives but once
+# per tick: only the last MOVE of every ship in the tick is applied, the cells
+# with ships that moved are the fights, settled in order of cell and pid (so the
+# arrival order of the messages does not matter), the treasure pays all of them
+# at once and there is one status dump per tick instead of one per MOVE.
+
 import os
 import sys
+import time
 import random
 import signal
+import socket
+import argparse
+import protocol
+import selectors
+import transport
+import metrics
+import log
+from journal import Journal, SNAPSHOT_EVERY, MESSAGE, TICK
+from ship_table import ShipTable
+
+MAX_MESSAGE = 64 * 1024     #a client with a longer partial message is dropped
+MAX_BUFFERED = 1024 * 1024  #unprocessed bytes per client before we stop reading it
+MESSAGES_PER_WAKEUP = 256   #messages handled per client before serving the others
+
+
+def settle_fight(food, gold, winner, losers):
+    #rules of a fight, on the food and gold columns (rows of a ShipTable): the winner
+    #gets 10 gold, every loser loses 10 food and up to 10 gold. Returns the gold lost by
+    #each loser and the gold Ursula has to put from her treasure (simulation.py too)
+    gold[winner] += 10
+    lost = []
+    needed = 0
+    for row in losers:
+        food[row] = max(0, food[row] - 10)
+        gold_lost = int(min(10, gold[row]))     #a NumPy column gives np.int64, the treasure stays an int (JSON)
+        gold[row] -= gold_lost
+        needed += 10 - gold_lost    #compensación que tiene que poner Ursula si no tiene uno suficiente gold
+        lost.append(gold_lost)
+    return lost, needed
+
+
+class Client:
+    #state of one socket connection: unread bytes and the pids that used it
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.pids = set()
+        self.paused = False
+
 
 class Ursula:
-    def __init__(self, ursula_pipe):
+    def __init__(self, ursula_pipe, seed=None, stats=None, stats_format="json", status=True, status_interval=5.0,
+                 journal=None, snapshot_every=SNAPSHOT_EVERY, keep_journal=False, tick=0.0):
         self.ursula_pipe = ursula_pipe
+        self.rng = random.Random(seed)  #who wins the fights, a seed makes a run repeatable
         self.treasure = 100
         self.captains = {} 
-        self.ships = {}    
+        self.ships = ShipTable()    #columns x, y, food, gold... with one row per ship
+        self.cells = {}    #(x, y) -> {pid: None} of the ships in that cell, so fights don't scan every ship
         self.running = True
+        self.status = status        #status dump after every MOVE
+        self.status_interval = status_interval  #seconds between dumps with --quiet
+        self.next_status = 0.0
+        self.metrics = metrics.Metrics("ursula")
+        self.handle_time = self.metrics.histogram("handle_seconds")
+        self.stats = stats          #unix:<path> that answers with the metrics
+        self.stats_format = stats_format
+        self.dump_requested = False #SIGUSR1, written by the main loop, not in the handler
+        self.journal = Journal(journal, snapshot_every, keep_journal) if journal else None
+        self.tick = tick            #seconds between fight resolutions, 0 = after every MOVE
+        self.next_tick = time.monotonic() + tick
+        self.moves = {}             #pid -> (x, y, food, gold) of its last MOVE in this tick
         
     def create_named_pipe(self):
         #si no existe el named pipe, fifo, lo crea
         try:
             if not os.path.exists(self.ursula_pipe):
                 os.mkfifo(self.ursula_pipe)
-                print(f"Created named pipe '{self.ursula_pipe}'", file=sys.stderr)
+                log.info(f"Created named pipe '{self.ursula_pipe}'")
             else:
-                print(f"Named pipe '{self.ursula_pipe}' already exists", file=sys.stderr)
+                log.info(f"Named pipe '{self.ursula_pipe}' already exists")
         except OSError as e:
-            print(f"Error happened: {e}", file=sys.stderr)
+            log.error(f"Error happened: {e}")
             sys.exit(1)
     
+    def place_ship(self, pid, x, y):
+        #adds the ship to the occupancy index of its cell. A dict keeps the order of
+        #arrival, a set would order the pids by their value: the same messages would
+        #give another winner with other pids (simulation.py draws from the same list)
+        self.cells.setdefault((x, y), {})[pid] = None
+
+    def unplace_ship(self, pid, x, y):
+        #removes the ship from the occupancy index, dropping empty cells
+        cell = self.cells.get((x, y))
+        if cell is not None:
+            cell.pop(pid, None)
+            if not cell:
+                del self.cells[(x, y)]
+
     def handle_fight(self, ship_pid, x, y):
         #handle fights between ships, when two ships are in the same position
-        ships_in_cell = []
-        for pid, ship_data in self.ships.items():
-            if pid != ship_pid and ship_data['x'] == x and ship_data['y'] == y:
-                ships_in_cell.append(pid)
+        #only the ships indexed in the cell are looked at, not the whole fleet
+        ships_in_cell = [pid for pid in self.cells.get((x, y), ()) if pid != ship_pid]
         
         if not ships_in_cell:
             return  #no fight, only one ship in the cell
         
-        # Include the ship that just moved
+        # Include the ship that just moved, in order of arrival to the cell
         all_ships_in_fight = ships_in_cell + [ship_pid]
-        print(f"Fight detected at ({x},{y}) between ships: {all_ships_in_fight}", file=sys.stderr)
+        log.info(f"Fight detected at ({x},{y}) between ships: {all_ships_in_fight}", "fight")
         # Randomly select a winner
-        winner_pid = random.choice(all_ships_in_fight)
+        winner_pid = self.rng.choice(all_ships_in_fight)
         losers = [pid for pid in all_ships_in_fight if pid != winner_pid]
         
-        print(f"Ursula: Winner is ship {winner_pid}", file=sys.stderr)
-        # Winner gets 10 gold
-        self.ships[winner_pid]['gold'] += 10
-        print(f"Ursula: Ship {winner_pid} gains 10 gold (now: {self.ships[winner_pid]['gold']})", file=sys.stderr)
-        
-        # Handle losers
-        total_gold_needed = 0
-        for loser_pid in losers:
-            # Losers lose 10 food and 10 gold
-            self.ships[loser_pid]['food'] = max(0, self.ships[loser_pid]['food'] - 10)
-            gold_lost = min(10, self.ships[loser_pid]['gold'])
-            self.ships[loser_pid]['gold'] -= gold_lost
-            total_gold_needed += (10 - gold_lost) #compensación que tiene que poner Ursula si no tiene uno suficiente gold
-            
-            print(f"Ursula: Ship {loser_pid} loses 10 food (now: {self.ships[loser_pid]['food']}) and {gold_lost} gold (now: {self.ships[loser_pid]['gold']})", file=sys.stderr)
+        log.info(f"Ursula: Winner is ship {winner_pid}", "fight")
+        if self.journal is not None:
+            self.journal.fight(winner_pid, losers)
+        self.metrics.inc("fights")
+        lost, total_gold_needed, paid = self.apply_fight(winner_pid, losers)
+        ships = self.ships
+        food, gold = ships.food, ships.gold
+        log.info(f"Ursula: Ship {winner_pid} gains 10 gold (now: {gold[ships.rows[winner_pid]]})", "fight")
+        for loser_pid, gold_lost in zip(losers, lost):
+            row = ships.rows[loser_pid]
+            log.info(f"Ursula: Ship {loser_pid} loses 10 food (now: {food[row]}) and {gold_lost} gold (now: {gold[row]})", "fight")
         
         # Handle gold
         if total_gold_needed > 0:
-            if self.treasure >= total_gold_needed:
-                self.treasure -= total_gold_needed
-                print(f"Ursula: Paid {total_gold_needed} gold from treasure (remaining: {self.treasure})", file=sys.stderr)
+            if paid:
+                self.metrics.inc("payouts")
+                self.metrics.inc("gold_paid", total_gold_needed)
+                log.info(f"Ursula: Paid {total_gold_needed} gold from treasure (remaining: {self.treasure})", "fight")
             else:       
                 # End of the world 
-                print(f"Ursula: Not enough gold. Only {self.treasure} available, need {total_gold_needed}", file=sys.stderr)
+                log.warning(f"Ursula: Not enough gold. Only {self.treasure} available, need {total_gold_needed}")
                 self.end_of_world()
+
+    def apply_fight(self, winner_pid, losers):
+        #the outcome of a fight, also when the journal is replayed: winner gets 10 gold,
+        #losers lose 10 food and 10 gold, Ursula pays what they could not.
+        #Returns (gold lost by each loser, gold needed from the treasure, paid)
+        ships = self.ships
+        lost, needed = settle_fight(ships.food, ships.gold, ships.rows[winner_pid], [ships.rows[pid] for pid in losers])
+        return lost, needed, self.pay(needed)
+
+    def pay(self, needed):
+        #takes needed gold from the treasure, False if there is not enough
+        #(a shard takes it from the treasure shared by all, shards.py)
+        if self.treasure < needed:
+            return False
+        self.treasure -= needed
+        return True
        
     def end_of_world(self):
         #ends all captains for the end of the world
-        print("Ursula: end of the world, no enough food", file=sys.stderr)
+        log.warning("Ursula: end of the world, no enough food")
+        self.metrics.inc("end_of_world")
         for captain_pid in self.captains.keys():
             try:
                 os.kill(captain_pid, signal.SIGUSR1)  
-                print(f"Ursula: Sent emergency signal to captain {captain_pid}", file=sys.stderr)
+                log.warning(f"Ursula: Sent emergency signal to captain {captain_pid}")
             except OSError as e:
-                print(f"Error happened: {e}", file=sys.stderr)
+                log.error(f"Error happened: {e}")
         
         self.running = False
     
     def process_message(self, message):
-        #procesa los mensajes del captain
+        #procesa los mensajes del captain en texto ("pid,TYPE,...", debug mode)
         try:
-            parts = message.strip().split(',')
-            pid = int(parts[0])
-            msg_type = parts[1]
-            
-            if msg_type == "INIT_CAPT":
+            msg = protocol.parse_text(message)
+        except ValueError as e:
+            log.error(f"Error processing: {e}")
+            self.metrics.inc("parse_errors")
+            return
+        self.handle_message(*msg)
+
+    def process_buffer(self, buffer, limit=None, pids=None):
+        #decodes and handles every complete message (binary or text) in buffer,
+        #removes them from it and returns how many were handled
+        messages, end, errors = protocol.decode(buffer, limit=limit)
+        del buffer[:end]
+        if errors:
+            log.error(f"Error processing: {errors} malformed message(s) skipped")
+            self.metrics.inc("parse_errors", errors)
+        handled = 0
+        for msg in messages:
+            if pids is not None:
+                pids.add(msg[2])
+            self.handle_message(*msg)
+            handled += 1
+            if not self.running:
+                break
+        return handled
+
+    def apply_message(self, msg_type, pid, x, y, food, gold):
+        #the change of state of one message, also when the journal is replayed.
+        #Returns False if the message changed nothing (unknown captain or ship)
+        if msg_type == protocol.INIT_CAPT:
+            self.captains[pid] = "alive"
+        elif msg_type == protocol.END_CAPT:
+            if pid not in self.captains:
+                return False
+            self.captains[pid] = "terminated"
+        elif msg_type == protocol.INIT:
+            if pid in self.ships:
+                # Re-initialization, forget the old cell
+                self.unplace_ship(pid, *self.ships.position(pid))
+            self.ships.add(pid, x, y, food, gold)
+            self.place_ship(pid, x, y)
+        elif msg_type == protocol.MOVE:
+            if pid not in self.ships:
+                return False
+            self.unplace_ship(pid, *self.ships.position(pid))
+            self.place_ship(pid, x, y)
+            self.ships.update(pid, x, y, food, gold)
+        elif msg_type == protocol.TERMINATE:
+            if pid not in self.ships:
+                return False
+            self.unplace_ship(pid, *self.ships.position(pid))
+            self.ships.remove(pid)
+        else:
+            return False
+        return True
+
+    def handle_message(self, msg_type, arg, pid, x, y, food, gold):
+        #one decoded message, fields as in protocol.RECORD
+        start = time.perf_counter()
+        self.metrics.inc("messages", type=protocol.TYPE_NAMES.get(msg_type, "unknown"))
+        try:
+            if self.tick:
+                if msg_type == protocol.MOVE:
+                    # Kept until the end of the tick, a later MOVE of the same ship replaces it
+                    if pid in self.ships:
+                        self.moves[pid] = (x, y, food, gold)
+                    self.handle_time.observe(time.perf_counter() - start)
+                    return
+                if msg_type == protocol.INIT or msg_type == protocol.TERMINATE:
+                    self.moves.pop(pid, None)   #the ship starts again or leaves, its move is void
+            accepted = self.apply_message(msg_type, pid, x, y, food, gold)
+            if accepted and self.journal is not None:
+                self.journal.message(msg_type, arg, pid, x, y, food, gold)
+
+            if msg_type == protocol.INIT_CAPT:
                 # Captain initialization
-                self.captains[pid] = "alive"
-                print(f"Ursula: Captain {pid} registered", file=sys.stderr)
+                log.info(f"Ursula: Captain {pid} registered")
                 
-            elif msg_type == "END_CAPT":
+            elif msg_type == protocol.END_CAPT and accepted:
                 # Captain termination
-                if pid in self.captains:
-                    self.captains[pid] = "terminated"
-                    print(f"Ursula: Captain {pid} terminated", file=sys.stderr)
+                log.info(f"Ursula: Captain {pid} terminated")
                 
-            elif msg_type == "INIT":
+            elif msg_type == protocol.INIT:
                 # Ship initialization
-                x, y, food, gold = int(parts[2]), int(parts[3]), int(parts[4]), int(parts[5])
-                self.ships[pid] = {
-                    'x': x, 
-                    'y': y, 
-                    'food': food, 
-                    'gold': gold,
-                    'captain_pid': None
-                }
-                print(f"Ursula: Ship {pid} initialized at ({x},{y}) with food={food}, gold={gold}", file=sys.stderr)
+                log.info(f"Ursula: Ship {pid} initialized at ({x},{y}) with food={food}, gold={gold}", "ship")
                 
-            elif msg_type == "MOVE":
+            elif msg_type == protocol.MOVE and accepted:
                 # Ship movement
-                x, y, food, gold = int(parts[2]), int(parts[3]), int(parts[4]), int(parts[5])
-                if pid in self.ships:
-                    self.ships[pid].update({
-                        'x': x, 
-                        'y': y, 
-                        'food': food, 
-                        'gold': gold
-                    })
-                    print(f"Ursula: Ship {pid} moved to ({x},{y}) with food={food}, gold={gold}", file=sys.stderr)
+                log.info(f"Ursula: Ship {pid} moved to ({x},{y}) with food={food}, gold={gold}", "move")
                     
-                    # Check for fights
-                    self.handle_fight(pid, x, y)
+                # Check for fights
+                self.handle_fight(pid, x, y)
                     
-                    # Print status of all ships
-                    self.print_ship_status()
+                # Print status of all ships
+                if self.status:
+                    self.show_status()
                 
-            elif msg_type == "TERMINATE":
+            elif msg_type == protocol.TERMINATE and accepted:
                 # Ship termination
-                if pid in self.ships:
-                    del self.ships[pid]
-                    print(f"Ursula: Ship {pid} terminated", file=sys.stderr)
+                log.info(f"Ursula: Ship {pid} terminated", "ship")
             
             # Check if all captains and ships have terminated
             self.check_termination()
             
         except OSError as e:
-            print(f"Error processing: {e}", file=sys.stderr)
+            log.error(f"Error processing: {e}")
+        self.handle_time.observe(time.perf_counter() - start)
     
+    def show_status(self):
+        #after every MOVE, or with --quiet (level above info) a snapshot every status_interval seconds
+        if log.enabled(log.INFO):
+            self.print_ship_status()
+            return
+        now = time.monotonic()
+        if now >= self.next_status:
+            self.next_status = now + self.status_interval
+            self.print_ship_status()
+
     def print_ship_status(self):
-        #printea el status de los ships
-        print("\n--- URSULA'S SHIP STATUS ---", file=sys.stderr)
-        print(f"Treasure: {self.treasure} gold", file=sys.stderr)
-        for pid, ship_data in self.ships.items():
-            print(f"Ship {pid}: pos=({ship_data['x']},{ship_data['y']}), food={ship_data['food']}, gold={ship_data['gold']}", file=sys.stderr)
-        print("--- END STATUS ---\n", file=sys.stderr)
-        sys.stderr.flush()
+        #printea el status de los ships, written as one block
+        lines = ["\n--- URSULA'S SHIP STATUS ---",
+                 f"Treasure: {self.treasure} gold",
+                 f"Ships: {len(self.ships)}, gold in circulation: {self.ships.total_gold()}, starving: {self.ships.starving()}"]
+        lines += [f"Ship {pid}: pos=({x},{y}), food={food}, gold={gold}" for pid, (x, y, food, gold) in self.ships.items()]
+        lines.append("--- END STATUS ---\n\n")
+        log.write("\n".join(lines))
     
+    # TICKS
+
+    def select_timeout(self, timeout=1.0):
+        #how long the loop may wait for messages, never past the end of the tick
+        if not self.tick:
+            return timeout
+        return max(0.0, min(timeout, self.next_tick - time.monotonic()))
+
+    def run_tick(self):
+        #called by the loops after every wakeup, resolves the tick once it is over
+        if self.tick and time.monotonic() >= self.next_tick:
+            self.resolve_tick()
+            self.next_tick = time.monotonic() + self.tick
+
+    def resolve_tick(self):
+        #the last MOVE of every ship in the tick, then every fight at once: the ships are
+        #grouped by cell (the cells index), the cells and the pids in a cell are taken in
+        #order, so the outcome does not depend on the order the messages arrived in
+        moves, self.moves = self.moves, {}
+        self.metrics.inc("ticks")
+        if not moves:
+            return
+        journal = self.journal
+        moved = set()
+        for pid, (x, y, food, gold) in moves.items():
+            self.apply_message(protocol.MOVE, pid, x, y, food, gold)
+            if journal is not None:
+                journal.message(protocol.MOVE, 0, pid, x, y, food, gold)
+            log.info(f"Ursula: Ship {pid} moved to ({x},{y}) with food={food}, gold={gold}", "move")
+            moved.add((x, y))
+
+        ships = self.ships
+        rows, food, gold = ships.rows, ships.food, ships.gold
+        outcomes = []   #(winner, losers) of every fight
+        needed = 0
+        for cell in sorted(moved):
+            group = sorted(self.cells.get(cell, ()))
+            if len(group) < 2:
+                continue
+            winner_pid = self.rng.choice(group)
+            losers = [pid for pid in group if pid != winner_pid]
+            outcomes.append((winner_pid, losers))
+            needed += settle_fight(food, gold, rows[winner_pid], [rows[pid] for pid in losers])[1]
+            log.info(f"Fight detected at ({cell[0]},{cell[1]}) between ships: {group}, winner is ship {winner_pid}", "fight")
+        fights = len(outcomes)
+        if fights:
+            self.metrics.inc("fights", fights)
+            if journal is not None:
+                # The payout first, recovery pays the fights after it at once, as here
+                journal.tick(fights, needed)
+                for winner_pid, losers in outcomes:
+                    journal.fight(winner_pid, losers)
+        log.debug(f"Ursula: tick of {len(moves)} moves and {fights} fights")
+
+        # One payout for every fight of the tick
+        if needed > 0:
+            if self.pay(needed):
+                self.metrics.inc("payouts")
+                self.metrics.inc("gold_paid", needed)
+                log.info(f"Ursula: Paid {needed} gold from treasure for {fights} fights (remaining: {self.treasure})", "fight")
+            else:
+                log.warning(f"Ursula: Not enough gold. Only {self.treasure} available, need {needed}")
+                self.end_of_world()
+                return
+        if self.status:
+            self.show_status()
+
+    # METRICS
+
+    def stats_snapshot(self):
+        #the metrics with the gauges up to date, in the stats format
+        m = self.metrics
+        m.set("treasure", self.treasure)
+        m.set("ships", len(self.ships))
+        m.set("captains", sum(1 for status in self.captains.values() if status == "alive"))
+        m.set("gold_in_circulation", self.ships.total_gold())
+        m.set("starving", self.ships.starving())
+        return m.render(self.stats_format)
+
+    def request_dump(self, signum, frame):
+        self.dump_requested = True
+
+    def dump_stats(self):
+        self.dump_requested = False
+        log.write(self.stats_snapshot())
+
+    def open_stats(self, sel):
+        #listening socket for the metrics, registered in the event loop
+        if not self.stats:
+            return None
+        path = transport.socket_path(self.stats)
+        if path is None:
+            log.warning(f"Ursula: --stats must be unix:<path>, not '{self.stats}'")
+            return None
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen(16)
+            server.setblocking(False)
+        except OSError as e:
+            log.error(f"Error happened: {e}")
+            return None
+        sel.register(server, selectors.EVENT_READ, "stats")
+        log.info(f"Ursula: metrics on '{path}'")
+        return server
+
+    def serve_stats(self, server):
+        #every connection gets one snapshot and is closed
+        while True:
+            try:
+                conn, _ = server.accept()
+            except (BlockingIOError, OSError):
+                return
+            try:
+                conn.settimeout(1.0)
+                conn.sendall(self.stats_snapshot().encode())
+            except OSError as e:
+                log.error(f"Error happened: {e}")
+            finally:
+                conn.close()
+
+    def close_stats(self, server):
+        if server is None:
+            return
+        server.close()
+        try:
+            os.unlink(transport.socket_path(self.stats))
+        except OSError:
+            pass
+
     def check_termination(self):
         #check if all the captains have been ended
         if not self.captains:
@@ -156,72 +461,283 @@ class Ursula:
         no_ships_remaining = len(self.ships) == 0
         
         if all_captains_terminated and no_ships_remaining:
-            print("Ursula: All captains and ships have terminated.", file=sys.stderr)
+            log.info("Ursula: All captains and ships have terminated.")
             self.running = False
     
-    # def run(self):
-    #     #to read the named pipe
-    #     self.create_named_pipe()
-        
-    #     print(f"Ursula: Waiting for messages on '{self.ursula_pipe}'...", file=sys.stderr)
-    #     print(f"Ursula: Initial gold: {self.treasure} ", file=sys.stderr)
-                 
-    #     try:
-    #         pipe=open(self.ursula_pipe, 'r')
-    #         while (self.running):
-    #             print("open pipe", file=sys.stderr)
-    #             message = pipe.readline()
-                
-    #             if not message:
-    #                 continue
-    #             print(f"mensaje recibido:{message}")
-    #             if message:
-    #                 self.process_message(message)
-    #         pipe.close(pipe)
-    #         print("Ursula: Shutting down.", file=sys.stderr)
-    #     except OSError as e:
-    #         print(f"Error happened: {e}", file=sys.stderr)
-    #         try:
-    #             if os.path.exists(self.ursula_pipe):
-    #                 os.unlink(self.ursula_pipe)
-    #                 print(f"Ursula: Removed named pipe '{self.ursula_pipe}'", file=sys.stderr)
-    #         except OSError as e:
-    #             print(f"Error happened: {e}", file=sys.stderr)
+    # JOURNAL
+
+    def recover(self):
+        #state of the snapshot plus the events of the journal after it
+        start = time.perf_counter()
+        state = self.journal.load_snapshot()
+        if state is not None:
+            self.treasure = state["treasure"]
+            self.captains = {pid: "alive" if alive else "terminated" for pid, alive in state["captains"]}
+            for pid, x, y, food, gold in state["ships"]:
+                self.ships.add(pid, x, y, food, gold)
+                self.place_ship(pid, x, y)
+        # Only the last MOVE of a ship counts, unless a fight needs its food and gold
+        # before: the moves wait in moved and are applied once
+        moved = {}      #pid -> (x, y, food, gold) of its last MOVE, not applied yet
+        tick_fights = 0     #fights left of a tick, already paid by its TICK
+        events = 0
+        for kind, event in self.journal.replay():
+            events += 1
+            if kind == MESSAGE:
+                msg_type, _, pid, x, y, food, gold = event
+                if msg_type == protocol.MOVE:
+                    moved[pid] = (x, y, food, gold)
+                    continue
+                if pid in moved:
+                    self.apply_message(protocol.MOVE, pid, *moved.pop(pid))
+                self.apply_message(msg_type, pid, x, y, food, gold)
+            elif kind == TICK:
+                # One payout for the fights of the tick, all or nothing (resolve_tick)
+                tick_fights, needed = event
+                if needed > 0 and not self.pay(needed):
+                    self.running = False
+            else:
+                winner, losers = event
+                for pid in (winner, *losers):
+                    if pid in moved:
+                        self.apply_message(protocol.MOVE, pid, *moved.pop(pid))
+                if tick_fights:
+                    tick_fights -= 1
+                    ships = self.ships
+                    settle_fight(ships.food, ships.gold, ships.rows[winner], [ships.rows[pid] for pid in losers])
+                elif not self.apply_fight(winner, losers)[2]:
+                    self.running = False    #the world had ended
+        for pid, ship in moved.items():
+            self.apply_message(protocol.MOVE, pid, *ship)
+        if state is not None or events:
+            log.info(f"Ursula: recovered {len(self.ships)} ships, {len(self.captains)} captains and {self.treasure} gold "
+                     f"(snapshot {self.journal.generation} + {events} events) in {time.perf_counter() - start:.2f} s")
+
+    def commit(self):
+        #group commit of the events of this wakeup, and a snapshot every snapshot_every events
+        journal = self.journal
+        if journal is None:
+            return
+        try:
+            if journal.commit():
+                self.metrics.inc("journal_fsyncs")
+            if journal.snapshot_due():
+                journal.snapshot(self.treasure, [(pid, status == "alive") for pid, status in self.captains.items()],
+                                 [(pid, *ship) for pid, ship in self.ships.items()])
+                self.metrics.inc("snapshots")
+            self.metrics.set("journal_bytes", journal.size())
+        except OSError as e:
+            log.error(f"Error happened: {e}")
+
     def run(self):
-        self.create_named_pipe()
-        print(f"Ursula: Waiting for messages on '{self.ursula_pipe}'...", file=sys.stderr)
-        print(f"Ursula: Initial gold: {self.treasure}", file=sys.stderr)
+        signal.signal(signal.SIGUSR1, self.request_dump)
+        if self.journal is not None:
+            try:
+                self.recover()
+            except (OSError, ValueError) as e:
+                log.error(f"Error happened: {e}")
+                sys.exit(1)
+        path = transport.socket_path(self.ursula_pipe)
+        if path is not None:
+            self.run_socket(path)
+        else:
+            self.run_fifo()
+        if self.journal is not None:
+            self.commit()
+            self.journal.close()
+
+    def run_socket(self, path):
+        #event loop: many captains and ships connected at once on a Unix socket
+        try:
+            if os.path.exists(path):
+                os.unlink(path)     #stale socket from a previous run
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen(socket.SOMAXCONN)
+            server.setblocking(False)
+        except OSError as e:
+            log.error(f"Error happened: {e}")
+            sys.exit(1)
 
+        log.info(f"Ursula: Waiting for connections on '{path}'...")
+        log.info(f"Ursula: Initial gold: {self.treasure}")
+
+        sel = selectors.DefaultSelector()
+        sel.register(server, selectors.EVENT_READ, None)
+        stats_server = self.open_stats(sel)
+        pending = []    #clients with data still waiting to be processed
         while self.running:
+            for key, mask in sel.select(timeout=0 if pending else self.select_timeout()):
+                if key.data is None:
+                    self.accept_clients(sel, server)
+                elif key.data == "stats":
+                    self.serve_stats(stats_server)
+                else:
+                    self.read_client(sel, key.data, pending)
+            self.metrics.set("queue_bytes", sum(len(client.buffer) for client in pending))
+            self.metrics.set("clients", len(sel.get_map()) - 1 - (stats_server is not None))
+            if self.dump_requested:
+                self.dump_stats()
+            # Round robin, a busy client cannot starve the others
+            for client in pending[:]:
+                more = self.process_client(client)
+                if not more:
+                    pending.remove(client)
+                    if len(client.buffer) > MAX_MESSAGE:
+                        # Only a partial message left and it is far too long
+                        log.warning(f"Ursula: dropping client {sorted(client.pids)}, message too long")
+                        self.close_client(sel, client)
+                        continue
+                if client.paused and len(client.buffer) < MAX_BUFFERED // 2:
+                    client.paused = False
+                    sel.register(client.sock, selectors.EVENT_READ, client)
+                if not self.running:
+                    break
+            self.run_tick()
+            self.commit()
+
+        for key in list(sel.get_map().values()):
+            if key.data != "stats":
+                key.fileobj.close()
+        self.close_stats(stats_server)
+        sel.close()
+        try:
+            os.unlink(path)
+            log.info(f"Ursula: Removed socket '{path}'")
+        except OSError as e:
+            log.error(f"Error happened: {e}")
+
+    def accept_clients(self, sel, server):
+        while True:
             try:
-                # Blocks here until some writer opens the FIFO
-                with open(self.ursula_pipe, "r") as pipe:
-                    for line in pipe:              # reads until EOF (all writers closed)
-                        line = line.strip()
-                        if not line:
-                            continue
-                        # print(f"Ursula: received: {line}", file=sys.stderr)  # optional debug
-                        self.process_message(line)
-                # Reaching here means EOF (all writers closed). Loop will reopen and block again.
+                conn, _ = server.accept()
+            except BlockingIOError:
+                return
             except OSError as e:
-                print(f"Error happened: {e}", file=sys.stderr)
+                log.error(f"Error happened: {e}")
+                return
+            conn.setblocking(False)
+            sel.register(conn, selectors.EVENT_READ, Client(conn))
+
+    def read_client(self, sel, client, pending):
+        try:
+            data = client.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            log.error(f"Error happened: {e}")
+            data = b""
+        if data:
+            client.buffer += data
+            if client not in pending:
+                pending.append(client)
+        if not data:
+            # EOF, any complete messages left are still handled
+            self.process_client(client, limit=None)
+            if client in pending:
+                pending.remove(client)
+            self.close_client(sel, client)
+        elif len(client.buffer) > MAX_BUFFERED:
+            # Backpressure: stop reading a client that is far ahead of us, the kernel
+            # buffer fills up and its sendall() blocks until we catch up
+            client.paused = True
+            sel.unregister(client.sock)
+
+    def close_client(self, sel, client):
+        log.info(f"Ursula: Connection closed (pids: {sorted(client.pids)})", "client")
+        if not client.paused:
+            sel.unregister(client.sock)
+        client.sock.close()
+
+    def process_client(self, client, limit=MESSAGES_PER_WAKEUP):
+        #handles up to limit messages of a client, returns True if more are waiting
+        handled = self.process_buffer(client.buffer, limit, client.pids)
+        return self.running and limit is not None and handled == limit
+
+    def run_fifo(self):
+        self.create_named_pipe()
+        log.info(f"Ursula: Waiting for messages on '{self.ursula_pipe}'...")
+        log.info(f"Ursula: Initial gold: {self.treasure}")
+
+        try:
+            # The FIFO is opened once; Ursula holds a dummy writer of her own so the
+            # pipe never reaches EOF when captains and ships come and go
+            read_fd, dummy_fd = transport.open_fifo_reader(self.ursula_pipe)
+        except OSError as e:
+            log.error(f"Error happened: {e}")
+            return
+
+        # The selector lets the metrics socket and SIGUSR1 be served while the FIFO is quiet
+        sel = selectors.DefaultSelector()
+        sel.register(read_fd, selectors.EVENT_READ, None)
+        stats_server = self.open_stats(sel)
+        buffer = bytearray()
+        while self.running:
+            for key, mask in sel.select(timeout=self.select_timeout()):
+                if key.data == "stats":
+                    self.serve_stats(stats_server)
+                    continue
+                try:
+                    data = os.read(read_fd, 65536)
+                except OSError as e:
+                    log.error(f"Error happened: {e}")
+                    self.running = False
+                    break
+                buffer += data
+                # The whole read is decoded in one pass, a partial message stays in the buffer
+                self.process_buffer(buffer)
+                self.metrics.set("queue_bytes", len(buffer))    #what is left for the next read
+            self.run_tick()
+            self.commit()
+            if self.dump_requested:
+                self.dump_stats()
+        self.close_stats(stats_server)
+        sel.close()
+        os.close(read_fd)
+        os.close(dummy_fd)
 
         # Optional cleanup when self.running becomes False
         try:
             if os.path.exists(self.ursula_pipe):
                 os.unlink(self.ursula_pipe)
-                print(f"Ursula: Removed named pipe '{self.ursula_pipe}'", file=sys.stderr)
+                log.info(f"Ursula: Removed named pipe '{self.ursula_pipe}'")
         except OSError as e:
-            print(f"Error happened: {e}", file=sys.stderr)
+            log.error(f"Error happened: {e}")
 
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python3 ursula.py <ursula_pipe>", file=sys.stderr)
-        sys.exit(1)
-    
-    ursula_pipe = sys.argv[1]
-    ursula = Ursula(ursula_pipe)
+    ap = argparse.ArgumentParser(description="Ursula, the sea witch")
+    ap.add_argument("ursula_pipe", help="named pipe, or unix:<socket path>")
+    ap.add_argument("seed", nargs="?", help="who wins the fights, repeatable runs")
+    ap.add_argument("--stats", type=str, help="unix:<socket path> that answers every connection with the metrics")
+    ap.add_argument("--stats-format", choices=metrics.FORMATS, default="json", help="metrics as JSON or Prometheus text")
+    ap.add_argument("--no-status", action="store_true", help="no dump of every ship after every MOVE")
+    ap.add_argument("--status-interval", type=float, default=5.0, help="seconds between status dumps with --quiet")
+    ap.add_argument("--journal", type=str, help="journal file, the state is recovered from it (and <journal>.snap) on restart")
+    ap.add_argument("--snapshot-every", type=int, default=SNAPSHOT_EVERY, help="journal events between snapshots")
+    ap.add_argument("--keep-journal", action="store_true", help="archive the journal of every snapshot as <journal>.<n> (for analytics.py)")
+    ap.add_argument("--tick", type=float, default=0.0, help="seconds between fight resolutions, 0 = one per MOVE")
+    ap.add_argument("--shards", type=int, default=1, help="regions of the sea, one Ursula process each (shards.py)")
+    ap.add_argument("--map", type=str, help="map of the sea, its size gives the regions of --shards")
+    log.add_arguments(ap)
+    args = ap.parse_args()
+    log.configure(args)
+
+    if args.shards > 1:
+        if not args.map:
+            ap.error("--shards needs --map")
+        if args.journal:
+            ap.error("--journal does not work with --shards")
+        from shards import Regions, Router  #shards.py imports this module
+        from tiled_map import open_map
+        mapa = open_map(args.map)
+        regions = Regions(mapa.width, mapa.height, args.shards)
+        Router(args.ursula_pipe, regions, args.seed, args.stats, args.stats_format, not args.no_status,
+               args.status_interval, args.tick).run()
+        return
+
+    ursula = Ursula(args.ursula_pipe, args.seed, args.stats, args.stats_format, not args.no_status, args.status_interval,
+                    args.journal, args.snapshot_every, args.keep_journal, args.tick)
     ursula.run()
 
 if __name__ == "__main__":